@@ -0,0 +1,193 @@
+"""
+A compact, memory-mappable file format for card data, so card searches can look at single fields without decoding entire cards.
+
+File layout (all numbers are little-endian unsigned 32-bit integers):
+- A header with the file type, the format version, the number of cards, the number of set rows, and the length of the layout description
+- The layout description, a JSON object with where each table starts, padded to a multiple of 4 bytes
+- The set row starts table: for each card the number of its first set row, plus one extra entry with the total set row count.
+   A card's set rows go from its own entry up to the next card's entry
+- For each card field, a table with a (string start, string length) pair per card. The start is relative to the string pool
+- For each set field, the same kind of table, but with a pair per set row. The set name is stored in the set field '_setname'
+- The string pool, with all the UTF-8 encoded field values. Values that occur more than once (set names, rarities) are only stored once
+Missing values have a length of MISSING_VALUE_LENGTH. Values that aren't strings (numbers, lists) are stored as JSON, and have JSON_VALUE_FLAG set in their length,
+so 'getCard' can turn them back into what they were
+"""
+
+import array, json, mmap, os, struct, sys
+
+FILE_TYPE = 'DRCS'
+FORMAT_VERSION = 2
+MISSING_VALUE_LENGTH = 0xFFFFFFFF
+JSON_VALUE_FLAG = 0x80000000
+_MISSING = object()  #Used to tell missing values apart from stored 'None' values
+HEADER = struct.Struct('<4sIIII')
+UINT_PAIR = struct.Struct('<II')  #Used for the (string start, string length) pairs, and to read two consecutive set row starts
+
+
+class BinaryCardStoreWriter(object):
+	"""Collects card data with 'addCard', and writes it to a binary card store file with 'save'"""
+
+	def __init__(self):
+		self.cardCount = 0
+		self.setRowCount = 0
+		self.setRowStarts = array.array('I', [0])
+		self.cardFields = {}  #Keys are field names, values are arrays with the string start and length of each card's value for that field
+		self.setFields = {}  #Same as 'cardFields', but for each set row instead of each card
+		self.stringPool = []
+		self.stringPoolLength = 0
+		self.stringPoolOffsets = {}  #Keys are encoded strings, values are where they start in the string pool, so repeated values are only stored once
+
+	def storeString(self, value):
+		"""Adds the value to the string pool if it isn't in there already, and returns where it starts and how long it is, with 'JSON_VALUE_FLAG' added if it had to be stored as JSON"""
+		lengthFlag = 0
+		if isinstance(value, unicode):
+			value = value.encode('utf-8')
+		elif not isinstance(value, str):
+			value = json.dumps(value)
+			lengthFlag = JSON_VALUE_FLAG
+		offset = self.stringPoolOffsets.get(value, None)
+		if offset is None:
+			offset = self.stringPoolLength
+			self.stringPoolOffsets[value] = offset
+			self.stringPool.append(value)
+			self.stringPoolLength += len(value)
+		return offset, len(value) | lengthFlag
+
+	def addRow(self, fields, rowNumber, rowData):
+		for fieldName, value in rowData.iteritems():
+			if fieldName not in fields:
+				#Rows that were added before this field was first seen don't have a value for it
+				fields[fieldName] = array.array('I', (0, MISSING_VALUE_LENGTH) * rowNumber)
+			fields[fieldName].extend(self.storeString(value))
+		#Every field table needs an entry for every row, even if this row doesn't have that field
+		for fieldTable in fields.itervalues():
+			if len(fieldTable) < (rowNumber + 1) * 2:
+				fieldTable.extend((0, MISSING_VALUE_LENGTH))
+
+	def addCard(self, gamewideCardData, setSpecificCardData):
+		"""
+		Adds a card to the store. Cards are numbered in the order they're added
+		:param gamewideCardData: A dictionary with the card's fields that are the same in every set
+		:param setSpecificCardData: A dictionary with set names as keys, and dictionaries with the card's fields in that set as values
+		"""
+		self.addRow(self.cardFields, self.cardCount, gamewideCardData)
+		self.cardCount += 1
+		for setname, setdata in setSpecificCardData.iteritems():
+			setRow = dict(setdata)
+			setRow['_setname'] = setname
+			self.addRow(self.setFields, self.setRowCount, setRow)
+			self.setRowCount += 1
+		self.setRowStarts.append(self.setRowCount)
+
+	def save(self, filename):
+		#Work out where each table will be, relative to the end of the layout description
+		tables = [self.setRowStarts]
+		layout = {'setRowStarts': 0, 'cardFields': {}, 'setFields': {}}
+		tableOffset = len(self.setRowStarts) * 4
+		for layoutKey, fields in (('cardFields', self.cardFields), ('setFields', self.setFields)):
+			for fieldName, fieldTable in fields.iteritems():
+				layout[layoutKey][fieldName] = tableOffset
+				tables.append(fieldTable)
+				tableOffset += len(fieldTable) * 4
+		layout['stringPool'] = tableOffset
+		encodedLayout = json.dumps(layout)
+		#Pad the layout with spaces so the tables are aligned, that's still valid JSON
+		encodedLayout += ' ' * (-len(encodedLayout) % 4)
+
+		with open(filename, 'wb') as storeFile:
+			storeFile.write(HEADER.pack(FILE_TYPE, FORMAT_VERSION, self.cardCount, self.setRowCount, len(encodedLayout)))
+			storeFile.write(encodedLayout)
+			for table in tables:
+				if sys.byteorder == 'big':
+					table = array.array('I', table)
+					table.byteswap()
+				table.tofile(storeFile)
+			for string in self.stringPool:
+				storeFile.write(string)
+
+
+class BinaryCardStore(object):
+	"""
+	Reads a file written by 'BinaryCardStoreWriter'. The file is memory-mapped, so only the parts that are actually looked at get loaded.
+	Card numbers are the order in which cards were added. Set rows are numbered across all cards, use 'getSetRows' to get the ones of a card
+	"""
+
+	def __init__(self, filename):
+		with open(filename, 'rb') as storeFile:
+			self.data = mmap.mmap(storeFile.fileno(), 0, access=mmap.ACCESS_READ)
+		fileType, formatVersion, self.cardCount, self.setRowCount, layoutLength = HEADER.unpack_from(self.data, 0)
+		if fileType != FILE_TYPE or formatVersion != FORMAT_VERSION:
+			self.data.close()
+			raise ValueError("'{}' is not a binary card store file of format version {}".format(filename, FORMAT_VERSION))
+		layout = json.loads(self.data[HEADER.size:HEADER.size + layoutLength])
+		dataStart = HEADER.size + layoutLength
+		self.setRowStartsOffset = dataStart + layout['setRowStarts']
+		self.cardFieldOffsets = {fieldName: dataStart + offset for fieldName, offset in layout['cardFields'].iteritems()}
+		self.setFieldOffsets = {fieldName: dataStart + offset for fieldName, offset in layout['setFields'].iteritems()}
+		self.stringPoolOffset = dataStart + layout['stringPool']
+
+	@staticmethod
+	def isStoreFile(filename):
+		"""Checks whether the file exists and is a store file of the current format version, without loading it"""
+		if not os.path.isfile(filename):
+			return False
+		with open(filename, 'rb') as storeFile:
+			header = storeFile.read(HEADER.size)
+		return len(header) == HEADER.size and HEADER.unpack(header)[0:2] == (FILE_TYPE, FORMAT_VERSION)
+
+	def getString(self, tableOffset, rowNumber, shouldDecodeJson=False, missingValue=None):
+		"""Returns the stored value as a unicode string, or 'missingValue' if it's missing. Values that were stored as JSON are returned as JSON text, unless 'shouldDecodeJson' is True"""
+		stringStart, stringLength = UINT_PAIR.unpack_from(self.data, tableOffset + rowNumber * 8)
+		if stringLength == MISSING_VALUE_LENGTH:
+			return missingValue
+		isJsonValue = stringLength & JSON_VALUE_FLAG
+		stringLength &= ~JSON_VALUE_FLAG
+		stringStart += self.stringPoolOffset
+		value = self.data[stringStart:stringStart + stringLength].decode('utf-8')
+		if isJsonValue and shouldDecodeJson:
+			return json.loads(value)
+		return value
+
+	def getCardField(self, cardNumber, fieldName):
+		"""Returns the value of the field for the provided card as a unicode string, or None if the card doesn't have that field"""
+		tableOffset = self.cardFieldOffsets.get(fieldName, None)
+		if tableOffset is None:
+			return None
+		return self.getString(tableOffset, cardNumber)
+
+	def getSetRows(self, cardNumber):
+		"""Returns the numbers of the set rows of the provided card, for use with 'getSetField'"""
+		return xrange(*UINT_PAIR.unpack_from(self.data, self.setRowStartsOffset + cardNumber * 4))
+
+	def getSetField(self, setRowNumber, fieldName):
+		"""Returns the value of the field for the provided set row as a unicode string, or None if the set row doesn't have that field"""
+		tableOffset = self.setFieldOffsets.get(fieldName, None)
+		if tableOffset is None:
+			return None
+		return self.getString(tableOffset, setRowNumber)
+
+	def getCard(self, cardNumber):
+		"""Returns all the data of a card, as a list with the gamewide card data dictionary and the set-specific card data dictionary"""
+		gamewideCardData = {}
+		for fieldName, tableOffset in self.cardFieldOffsets.iteritems():
+			value = self.getString(tableOffset, cardNumber, True, _MISSING)
+			if value is not _MISSING:
+				gamewideCardData[fieldName] = value
+		setSpecificCardData = {}
+		for setRowNumber in self.getSetRows(cardNumber):
+			setData = {}
+			for fieldName, tableOffset in self.setFieldOffsets.iteritems():
+				value = self.getString(tableOffset, setRowNumber, True, _MISSING)
+				if value is not _MISSING:
+					setData[fieldName] = value
+			setSpecificCardData[setData.pop('_setname')] = setData
+		return [gamewideCardData, setSpecificCardData]
+
+	def close(self):
+		self.data.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, excType, excValue, traceback):
+		self.close()
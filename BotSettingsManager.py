@@ -9,6 +9,11 @@ class BotSettingsManager(object):
 		self._logger = logging.getLogger("DideRobot")
 		self.settings = {}
 		self.loadedSuccessfully = False
+		#Lowercase sets of the user and command lists, so checking whether something is in them is fast. Filled in by 'parseSettings'
+		self.adminsSet = frozenset()
+		self.userIgnoreSet = frozenset()
+		self.commandWhitelistSet = None  #'None' means there is no whitelist
+		self.commandBlacklistSet = None  #'None' means there is no blacklist
 
 		self.serverfolder = serverfolder
 		self._settingsPath = os.path.join(GlobalStore.scriptfolder, "serverSettings", self.serverfolder, "settings.json")
@@ -68,6 +73,23 @@ class BotSettingsManager(object):
 		for key, value in self.settings.iteritems():
 			if isinstance(value, unicode):
 				self.settings[key] = value.encode('utf-8')
+		#User and command lists are checked for every message, turn them into sets for quick lookup
+		self.adminsSet = self.createLookupSet(self.settings.get('admins', None))
+		self.userIgnoreSet = self.createLookupSet(self.settings.get('userIgnoreList', None))
+		self.commandWhitelistSet = self.createLookupSet(self.settings.get('commandWhitelist', None), None)
+		self.commandBlacklistSet = self.createLookupSet(self.settings.get('commandBlacklist', None), None)
+
+	@staticmethod
+	def createLookupSet(listToConvert, valueIfNone=frozenset()):
+		"""Turns the provided settings list into a frozenset with all the entries lowercased, or returns 'valueIfNone' if there is no list"""
+		if listToConvert is None:
+			return valueIfNone
+		lookupSet = set()
+		for entry in listToConvert:
+			if isinstance(entry, unicode):
+				entry = entry.encode('utf-8')
+			lookupSet.add(entry.lower())
+		return frozenset(lookupSet)
 
 	def saveSettings(self):
 		#First get only the keys that are different from the globalsettings
@@ -0,0 +1,183 @@
+import collections, logging
+
+import gevent
+
+from ChannelMembership import casefoldNick
+
+
+class ChannelJoinScheduler(object):
+	"""
+	Joins channels with as few JOIN lines as the server allows, by putting multiple channels in one comma-separated JOIN line,
+	and asks for the user lists of channels (with WHO or NAMES) only a few at a time, so joining a lot of channels at once doesn't trip the server's flood protection.
+	Joining waits until the server told us its limits in RPL_ISUPPORT, which it does after it welcomed us
+	"""
+	MAX_LINE_LENGTH = 510  #512 bytes minus the closing '\r\n'
+	MAX_WAIT_FOR_SERVER_LIMITS = 10.0  #If the server doesn't finish sending its welcome messages within this many seconds, start joining anyway
+
+	def __init__(self, queueLineFunction, getJoinedChannelsFunction, serverfolder):
+		"""
+		:param queueLineFunction: The function that sends or queues a line to the server
+		:param getJoinedChannelsFunction: A function that returns the channels we're currently in, to check the server's limit on how many channels we can be in
+		:param serverfolder: The name of the server this scheduler is for, used in log messages
+		"""
+		self.logger = logging.getLogger('DideRobot')
+		self.queueLine = queueLineFunction
+		self.getJoinedChannels = getJoinedChannelsFunction
+		self.serverfolder = serverfolder
+		self.maxConcurrentUserListRequests = 3  #How many channels we can be waiting on a WHO or NAMES reply for at once
+		self.userListRequestTimeout = 30.0  #If a WHO or NAMES reply takes longer than this many seconds, stop waiting for it so other requests can go
+		self.isReadyToJoin = False
+		self.readyWaitGreenlet = None
+		self.channelsToJoin = []
+		self.maxChannelsPerJoin = None  #From the 'TARGMAX' RPL_ISUPPORT token. 'None' means only the line length limits how many channels fit in a JOIN line
+		self.channelLimits = []  #From the 'CHANLIMIT' RPL_ISUPPORT token, a list of (channel prefixes, maximum number of channels with those prefixes) tuples
+		self.userListRequestQueue = collections.deque()  #(casefolded channel, request line) tuples of the WHO or NAMES requests that are waiting for their turn
+		self.pendingUserListRequests = {}  #Keys are the casefolded channels we're waiting on a user list reply for, values are the greenlets that will stop the wait if it takes too long
+
+	def updateSettings(self, maxConcurrentUserListRequests=3, userListRequestTimeout=30.0):
+		self.maxConcurrentUserListRequests = max(1, maxConcurrentUserListRequests)
+		self.userListRequestTimeout = userListRequestTimeout
+
+	def clear(self):
+		"""Forgets everything that was waiting. Called when the connection is closed, since we'll have to rejoin everything and the server limits may change"""
+		if self.readyWaitGreenlet:
+			self.readyWaitGreenlet.kill()
+			self.readyWaitGreenlet = None
+		for timeoutGreenlet in self.pendingUserListRequests.itervalues():
+			timeoutGreenlet.kill()
+		self.pendingUserListRequests = {}
+		self.userListRequestQueue.clear()
+		self.channelsToJoin = []
+		self.isReadyToJoin = False
+		self.maxChannelsPerJoin = None
+		self.channelLimits = []
+
+	#JOINING
+	def queueJoin(self, channel):
+		"""Joins the channel, or if we're not ready to join yet, remembers it so it gets joined once we are"""
+		if channel not in self.channelsToJoin:
+			self.channelsToJoin.append(channel)
+		if self.isReadyToJoin:
+			self.sendJoins()
+
+	def waitForServerLimits(self):
+		"""Called when the server welcomed us. Starts joining once the server limits are known, or after a while if they never arrive"""
+		if not self.readyWaitGreenlet and not self.isReadyToJoin:
+			self.readyWaitGreenlet = gevent.spawn_later(self.MAX_WAIT_FOR_SERVER_LIMITS, self.setReadyToJoin, None)
+
+	def setReadyToJoin(self, serverSupport):
+		"""
+		Starts joining the queued channels
+		:param serverSupport: A dictionary with the RPL_ISUPPORT tokens the server sent, or None if the server didn't send them in time
+		"""
+		if self.readyWaitGreenlet and self.readyWaitGreenlet is not gevent.getcurrent():
+			self.readyWaitGreenlet.kill()
+		self.readyWaitGreenlet = None
+		if serverSupport:
+			self.maxChannelsPerJoin = self.parseMaxTargets(serverSupport, 'JOIN')
+			self.channelLimits = self.parseChannelLimits(serverSupport)
+		else:
+			self.logger.warning("|{}| Server didn't tell us its limits in time, joining channels without knowing them".format(self.serverfolder))
+		self.isReadyToJoin = True
+		self.sendJoins()
+
+	@staticmethod
+	def parseMaxTargets(serverSupport, command):
+		"""Returns how many targets the command can have according to the 'TARGMAX' RPL_ISUPPORT token (like 'JOIN:,PRIVMSG:4'), or None if there's no limit"""
+		for commandLimit in serverSupport.get('TARGMAX', "").split(','):
+			limitCommand, limit = commandLimit.split(':', 1) if ':' in commandLimit else (commandLimit, "")
+			if limitCommand.upper() == command:
+				return int(limit) if limit.isdigit() and int(limit) > 0 else None
+		return None
+
+	@staticmethod
+	def parseChannelLimits(serverSupport):
+		"""Returns a list of (channel prefixes, max channels) tuples from the 'CHANLIMIT' RPL_ISUPPORT token (like '#&:50,+:10'), or the older 'MAXCHANNELS' token"""
+		channelLimits = []
+		if 'CHANLIMIT' in serverSupport:
+			for prefixesAndLimit in serverSupport['CHANLIMIT'].split(','):
+				if ':' not in prefixesAndLimit:
+					continue
+				prefixes, limit = prefixesAndLimit.split(':', 1)
+				#No limit means there isn't one for these prefixes
+				if limit.isdigit():
+					channelLimits.append((prefixes, int(limit)))
+		elif serverSupport.get('MAXCHANNELS', "").isdigit():
+			channelLimits.append((None, int(serverSupport['MAXCHANNELS'])))
+		return channelLimits
+
+	def getChannelLimitIndex(self, channel):
+		"""Returns the index of the limit in 'channelLimits' that applies to the channel, or None if no limit applies"""
+		for index, (prefixes, limit) in enumerate(self.channelLimits):
+			if prefixes is None or channel[0] in prefixes:
+				return index
+		return None
+
+	def sendJoins(self):
+		"""Sends JOIN lines for all the queued channels, with as many channels per line as fit"""
+		if not self.channelsToJoin:
+			return
+		#Count how many channels we're already in for each channel limit, so we don't try to join more than the server allows
+		channelCountsPerLimit = [0] * len(self.channelLimits)
+		if self.channelLimits:
+			for joinedChannel in self.getJoinedChannels():
+				limitIndex = self.getChannelLimitIndex(joinedChannel)
+				if limitIndex is not None:
+					channelCountsPerLimit[limitIndex] += 1
+		joinLineChannels = []
+		joinLineLength = len("JOIN ")
+		for channel in self.channelsToJoin:
+			limitIndex = self.getChannelLimitIndex(channel)
+			if limitIndex is not None:
+				if channelCountsPerLimit[limitIndex] >= self.channelLimits[limitIndex][1]:
+					self.logger.warning("|{}| Not joining '{}', the server doesn't allow us to be in more than {:,} channels like that".format(self.serverfolder, channel, self.channelLimits[limitIndex][1]))
+					continue
+				channelCountsPerLimit[limitIndex] += 1
+			#The channel length plus the comma before it, if it's not the first channel in the line
+			channelLength = len(channel) + (1 if joinLineChannels else 0)
+			if joinLineChannels and (joinLineLength + channelLength > self.MAX_LINE_LENGTH or (self.maxChannelsPerJoin and len(joinLineChannels) >= self.maxChannelsPerJoin)):
+				self.queueLine("JOIN " + ",".join(joinLineChannels))
+				joinLineChannels = []
+				joinLineLength = len("JOIN ")
+				channelLength = len(channel)
+			joinLineChannels.append(channel)
+			joinLineLength += channelLength
+		if joinLineChannels:
+			self.queueLine("JOIN " + ",".join(joinLineChannels))
+		self.channelsToJoin = []
+
+	#USER LISTS
+	def requestUserList(self, channel, requestLine=None):
+		"""
+		Sends the request for the user list of the channel if not too many other requests are waiting for a reply, and otherwise queues it
+		:param requestLine: The WHO or NAMES line to send. If it's None, the server will send the user list without being asked (it does that when we join a channel), so there's only the reply to wait for
+		"""
+		foldedChannel = casefoldNick(channel)
+		if requestLine is None:
+			self.addPendingUserListRequest(foldedChannel)
+		elif foldedChannel not in self.pendingUserListRequests and not any(queuedChannel == foldedChannel for queuedChannel, queuedLine in self.userListRequestQueue):
+			self.userListRequestQueue.append((foldedChannel, requestLine))
+			self.sendQueuedUserListRequests()
+
+	def addPendingUserListRequest(self, foldedChannel):
+		if foldedChannel in self.pendingUserListRequests:
+			self.pendingUserListRequests[foldedChannel].kill()
+		self.pendingUserListRequests[foldedChannel] = gevent.spawn_later(self.userListRequestTimeout, self.userListRequestTimedOut, foldedChannel)
+
+	def sendQueuedUserListRequests(self):
+		while self.userListRequestQueue and len(self.pendingUserListRequests) < self.maxConcurrentUserListRequests:
+			foldedChannel, requestLine = self.userListRequestQueue.popleft()
+			self.addPendingUserListRequest(foldedChannel)
+			self.queueLine(requestLine)
+
+	def userListReceived(self, channel):
+		"""Called when the server finished sending the user list of the channel, so the next request can go"""
+		timeoutGreenlet = self.pendingUserListRequests.pop(casefoldNick(channel), None)
+		if timeoutGreenlet:
+			timeoutGreenlet.kill()
+		self.sendQueuedUserListRequests()
+
+	def userListRequestTimedOut(self, foldedChannel):
+		self.logger.warning("|{}| Didn't get the user list of channel '{}' within {} seconds, not waiting for it anymore".format(self.serverfolder, foldedChannel, self.userListRequestTimeout))
+		self.pendingUserListRequests.pop(foldedChannel, None)
+		self.sendQueuedUserListRequests()
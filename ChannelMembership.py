@@ -0,0 +1,183 @@
+import collections, string
+
+
+#IRC nicks are case-insensitive, and by default servers also consider '[]\~' to be the uppercase versions of '{}|^'
+_NICK_CASEFOLD_TABLE = string.maketrans(string.ascii_uppercase + "[]\\~", string.ascii_lowercase + "{}|^")
+
+def casefoldNick(nick):
+	"""Returns the nick in the form a server uses to compare nicks, so nicks that differ only in case are seen as the same nick"""
+	#Nicks from the server are byte strings, but nicks typed in by users can be unicode, which can't use a byte translation table
+	if isinstance(nick, unicode):
+		nick = nick.encode('utf-8')
+	return nick.translate(_NICK_CASEFOLD_TABLE)
+
+
+class ChannelUser(object):
+	"""What we know about a user that's in one or more of the channels we're in"""
+	__slots__ = ('nick', 'userAndHost', 'account', 'isAway')
+
+	def __init__(self, nick, userAndHost, account=None, isAway=False):
+		self.nick = nick
+		self.userAndHost = userAndHost  #The 'user@host' part of the user address. Interned, since many users share them after a reconnect
+		self.account = account  #The services account the user is logged in to, or None if that's unknown or they're not logged in
+		self.isAway = isAway
+
+	@property
+	def address(self):
+		"""The full 'nick!user@host' address of the user, or just the nick if we don't know the rest"""
+		return "{}!{}".format(self.nick, self.userAndHost) if self.userAndHost else self.nick
+
+
+class ChannelMembership(object):
+	"""
+	Keeps track of which users are in which channels, in both directions, so joins, parts, quits and nick changes only have to update what's actually affected.
+	Users are stored once, however many channels they're in, by their casefolded nick
+	"""
+
+	def __init__(self):
+		self.usersByNick = {}  #Keys are casefolded nicks, values are ChannelUser instances
+		self.channelsByNick = {}  #Keys are casefolded nicks, values are sets of the channels that user is in
+		self.nicksByChannel = {}  #Keys are the channels we're in, values are sets of the casefolded nicks of the users in that channel
+
+	def clear(self):
+		self.usersByNick = {}
+		self.channelsByNick = {}
+		self.nicksByChannel = {}
+
+	def hasChannel(self, channel):
+		return channel in self.nicksByChannel
+
+	def getChannels(self):
+		return self.nicksByChannel.keys()
+
+	def addChannel(self, channel):
+		if channel not in self.nicksByChannel:
+			self.nicksByChannel[channel] = set()
+
+	def removeChannel(self, channel):
+		"""Forgets the channel and who's in it, for instance because we left it. Users that aren't in any other channel we're in are forgotten too"""
+		for foldedNick in self.nicksByChannel.pop(channel, ()):
+			self._removeChannelFromUser(foldedNick, channel)
+
+	def _removeChannelFromUser(self, foldedNick, channel):
+		userChannels = self.channelsByNick.get(foldedNick, None)
+		if userChannels is None:
+			return
+		userChannels.discard(channel)
+		if not userChannels:
+			del self.channelsByNick[foldedNick]
+			del self.usersByNick[foldedNick]
+
+	def addUser(self, channel, userAddress, account=None, isAway=None):
+		"""
+		Adds a user to a channel. If the channel isn't known yet, it's added too
+		:param userAddress: The full user address, 'nick!user@host'. If it's just the nick, the rest of the address we already know (if any) is kept
+		:param account: The services account the user is logged in to, if known
+		:param isAway: Whether the user is away, or None if that's unknown
+		"""
+		nick, userAndHost = userAddress.split('!', 1) if '!' in userAddress else (userAddress, None)
+		foldedNick = casefoldNick(nick)
+		user = self.usersByNick.get(foldedNick, None)
+		if user is None:
+			self.usersByNick[foldedNick] = ChannelUser(nick, intern(userAndHost) if userAndHost else "", account, bool(isAway))
+			self.channelsByNick[foldedNick] = {channel}
+		else:
+			#Make sure the stored info is up to date, the user could be someone else by now if we missed a quit
+			user.nick = nick
+			if userAndHost and user.userAndHost != userAndHost:
+				user.userAndHost = intern(userAndHost)
+			if account:
+				user.account = account
+			if isAway is not None:
+				user.isAway = isAway
+			self.channelsByNick[foldedNick].add(channel)
+		if channel not in self.nicksByChannel:
+			self.nicksByChannel[channel] = {foldedNick}
+		else:
+			self.nicksByChannel[channel].add(foldedNick)
+
+	def removeUser(self, channel, nick):
+		"""Removes the user from the channel. Returns whether the user was in that channel"""
+		foldedNick = casefoldNick(nick)
+		channelNicks = self.nicksByChannel.get(channel, None)
+		if channelNicks is None or foldedNick not in channelNicks:
+			return False
+		channelNicks.remove(foldedNick)
+		self._removeChannelFromUser(foldedNick, channel)
+		return True
+
+	def removeUserFromAllChannels(self, nick):
+		"""Removes the user from every channel, for instance because they quit. Returns a list of the channels the user was in"""
+		foldedNick = casefoldNick(nick)
+		self.usersByNick.pop(foldedNick, None)
+		channels = self.channelsByNick.pop(foldedNick, ())
+		for channel in channels:
+			self.nicksByChannel[channel].discard(foldedNick)
+		return list(channels)
+
+	def renameUser(self, oldNick, newNick):
+		"""Changes the nick of a user in every channel they're in. Returns a list of those channels"""
+		oldFoldedNick = casefoldNick(oldNick)
+		user = self.usersByNick.pop(oldFoldedNick, None)
+		if user is None:
+			return []
+		channels = self.channelsByNick.pop(oldFoldedNick)
+		newFoldedNick = casefoldNick(newNick)
+		#If we still know someone else with the new nick (because we missed them quitting or changing nick), they can't be around anymore, so forget them
+		if newFoldedNick != oldFoldedNick and newFoldedNick in self.usersByNick:
+			self.removeUserFromAllChannels(newNick)
+		user.nick = newNick
+		self.usersByNick[newFoldedNick] = user
+		self.channelsByNick[newFoldedNick] = channels
+		if newFoldedNick != oldFoldedNick:
+			for channel in channels:
+				channelNicks = self.nicksByChannel[channel]
+				channelNicks.discard(oldFoldedNick)
+				channelNicks.add(newFoldedNick)
+		return list(channels)
+
+	def setUserAway(self, nick, isAway):
+		user = self.usersByNick.get(casefoldNick(nick), None)
+		if user:
+			user.isAway = isAway
+
+	def isUserInChannel(self, channel, nick):
+		return casefoldNick(nick) in self.nicksByChannel.get(channel, ())
+
+	def getUserAddress(self, nick):
+		"""Returns the full 'nick!user@host' address of the user, or None if they're not in any channel we're in"""
+		user = self.usersByNick.get(casefoldNick(nick), None)
+		if user is None:
+			return None
+		return user.address
+
+	def getChannelUserAddresses(self, channel):
+		"""Returns a list with the full 'nick!user@host' addresses of all the users in the channel"""
+		return [self.usersByNick[foldedNick].address for foldedNick in self.nicksByChannel.get(channel, ()) if foldedNick in self.usersByNick]
+
+	def getChannelUserCount(self, channel):
+		return len(self.nicksByChannel.get(channel, ()))
+
+
+class ChannelUserListView(collections.Mapping):
+	"""
+	A read-only dictionary-like view of a ChannelMembership, with the channels as keys and lists of user addresses as values,
+	so code that expects the old 'channel: list of user addresses' dictionary keeps working. The user lists are built when they're asked for
+	"""
+
+	def __init__(self, channelMembership):
+		self.channelMembership = channelMembership
+
+	def __getitem__(self, channel):
+		if not self.channelMembership.hasChannel(channel):
+			raise KeyError(channel)
+		return self.channelMembership.getChannelUserAddresses(channel)
+
+	def __contains__(self, channel):
+		return self.channelMembership.hasChannel(channel)
+
+	def __iter__(self):
+		return iter(self.channelMembership.getChannels())
+
+	def __len__(self):
+		return len(self.channelMembership.nicksByChannel)
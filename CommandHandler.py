@@ -10,6 +10,8 @@ class CommandHandler:
 	commands = {}
 	commandFunctions = {}
 	apikeys = {}
+	commandsByTriggerAndType = {}  #Keys are (messageType, trigger) tuples, values are lists of names of commands that should be checked for such a message
+	commandsForAllMessages = []  #Names of commands that set 'shouldSeeAllMessages', since they need to check every message
 
 
 	def __init__(self):
@@ -75,13 +77,22 @@ class CommandHandler:
 		"""
 		:type message: IrcMessage
 		"""
-		#First check if this user is even allowed to call commands
-		if message.bot.shouldUserBeIgnored(message.user, message.userNickname, message.userAddress):
+		#First check if this user is even allowed to call commands. Only pass the full user, so the message doesn't need to split it if nothing else needs that
+		if message.bot.shouldUserBeIgnored(message.user):
 			return
 
 		#Then check whether any of our loaded commands need to react to this message
-		for commandname, command in self.commands.iteritems():
-			if not self.isCommandAllowedForBot(message.bot, commandname):
+		# Only commands that have this message's trigger, and commands that want to see every message, need to be checked
+		if message.trigger:
+			commandnamesToCheck = self.commandsByTriggerAndType.get((message.messageType, message.trigger), [])
+			if self.commandsForAllMessages:
+				commandnamesToCheck = commandnamesToCheck + self.commandsForAllMessages
+		else:
+			commandnamesToCheck = self.commandsForAllMessages
+		#If a command (un)loads commands, the lookup lists get replaced instead of changed, so iterating over the current list is safe
+		for commandname in commandnamesToCheck:
+			command = self.commands.get(commandname, None)
+			if not command or not self.isCommandAllowedForBot(message.bot, commandname):
 				continue
 
 			if command.shouldExecute(message):
@@ -103,13 +114,33 @@ class CommandHandler:
 			message.bot.messageLogger.log("ERROR executing '{}': {}".format(commandname, str(e)), message.source)
 			self.logger.error("Exception thrown while handling command '{}' and message '{}'".format(commandname, message.rawText), exc_info=True)
 
+	def updateCommandLookup(self):
+		"""Rebuilds the lookup tables that 'handleMessage' uses to find which commands could react to a message. Should be called whenever the command list changes"""
+		commandsByTriggerAndType = {}
+		commandsForAllMessages = []
+		for commandname, command in self.commands.iteritems():
+			if command.shouldSeeAllMessages:
+				commandsForAllMessages.append(commandname)
+				continue
+			for trigger in command.triggers:
+				for messageType in command.allowedMessageTypes:
+					key = (messageType, trigger.lower())
+					if key not in commandsByTriggerAndType:
+						commandsByTriggerAndType[key] = [commandname]
+					elif commandname not in commandsByTriggerAndType[key]:
+						commandsByTriggerAndType[key].append(commandname)
+		self.commandsByTriggerAndType = commandsByTriggerAndType
+		self.commandsForAllMessages = commandsForAllMessages
+		#The bots keep track of which commands they're allowed to use, update those too
+		if GlobalStore.bothandler:
+			for bot in GlobalStore.bothandler.bots.itervalues():
+				if bot.settings.loadedSuccessfully:
+					bot.updateAllowedCommands()
+		self.logger.debug("Command lookup updated, {:,} trigger and message type combinations and {:,} commands that check all messages".format(len(commandsByTriggerAndType), len(commandsForAllMessages)))
+
 	@staticmethod
 	def isCommandAllowedForBot(bot, commandname):
-		if bot.settings['commandWhitelist'] is not None and commandname not in bot.settings['commandWhitelist']:
-			return False
-		elif bot.settings['commandBlacklist'] is not None and commandname in bot.settings['commandBlacklist']:
-			return False
-		return True
+		return commandname in bot.allowedCommandNames
 	
 	def loadCommands(self, folder='commands'):
 		modulesToIgnore = ('__init__.py', 'CommandTemplate.py')
@@ -139,6 +170,7 @@ class CommandHandler:
 			reload(loadedModule)
 			command = loadedModule.Command()
 			self.commands[name] = command
+			self.updateCommandLookup()
 			return (True, "Successfully loaded file '{}'".format(name))
 		except Exception as e:
 			self.logger.error("An error occurred while trying to load command '{}'".format(name), exc_info=True)
@@ -155,6 +187,7 @@ class CommandHandler:
 			self.commands[name].unload()
 			#And remove the reference to it
 			del self.commands[name]
+			self.updateCommandLookup()
 			#Check if any registered command functions belong to this module
 			functionsToRemove = []
 			for funcName in self.commandFunctions.keys():
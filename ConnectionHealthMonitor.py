@@ -0,0 +1,104 @@
+import collections, logging, math, time
+
+import gevent
+import gevent.event
+
+
+class ConnectionHealthMonitor(object):
+	"""
+	Regularly sends a PING to the server and measures how long the PONG reply takes, so we know how lagged the connection is.
+	If a reply takes too long, the connection is assumed to be dead, which is noticed a lot sooner than when waiting for the socket to time out
+	"""
+
+	def __init__(self, sendFunction, lagMeasuredFunction, connectionLostFunction, serverfolder):
+		"""
+		:param sendFunction: The function that sends a line to the server. It gets called with the line and a boolean indicating whether the line should be logged
+		:param lagMeasuredFunction: Gets called with the lag in seconds every time it's measured
+		:param connectionLostFunction: Gets called without arguments when a PONG reply takes too long
+		:param serverfolder: The name of the server this monitor is for, used in log messages
+		"""
+		self.logger = logging.getLogger('DideRobot')
+		self.sendFunction = sendFunction
+		self.lagMeasuredFunction = lagMeasuredFunction
+		self.connectionLostFunction = connectionLostFunction
+		self.serverfolder = serverfolder
+		self.secondsBetweenPings = 30.0  #If it's 'None', no PINGs are sent and the connection isn't monitored
+		self.maxLag = 60.0  #If a PONG reply takes longer than this many seconds, the connection is considered lost
+		self.lagMeasurements = collections.deque(maxlen=50)  #The most recent lag measurements in seconds, oldest first
+		self.pingCount = 0
+		self.pingToken = None  #The token of the PING we're waiting on a reply for, or None if we're not waiting for one
+		self.pingSentAt = None
+		self.pongReceivedEvent = gevent.event.Event()
+		self.monitorGreenlet = None
+
+	def updateSettings(self, secondsBetweenPings=30.0, maxLag=60.0, lagMeasurementCount=50):
+		self.secondsBetweenPings = secondsBetweenPings if secondsBetweenPings and secondsBetweenPings > 0 else None
+		self.maxLag = maxLag
+		if lagMeasurementCount != self.lagMeasurements.maxlen:
+			self.lagMeasurements = collections.deque(self.lagMeasurements, maxlen=max(1, lagMeasurementCount))
+
+	def start(self):
+		"""Starts monitoring the connection. Called when we're connected to the server"""
+		self.stop()
+		self.lagMeasurements.clear()
+		if self.secondsBetweenPings:
+			self.monitorGreenlet = gevent.spawn(self.monitorConnection)
+
+	def stop(self):
+		if self.monitorGreenlet:
+			self.monitorGreenlet.kill()
+			self.monitorGreenlet = None
+		self.pingToken = None
+		self.pingSentAt = None
+
+	def monitorConnection(self):
+		try:
+			while True:
+				self.pingCount += 1
+				self.pingToken = "DideRobotLagCheck{}".format(self.pingCount)
+				self.pongReceivedEvent.clear()
+				self.pingSentAt = time.time()
+				self.sendFunction("PING :" + self.pingToken, False)
+				if not self.pongReceivedEvent.wait(self.maxLag):
+					self.logger.warning("|{}| No reply to our PING within {} seconds, assuming the connection is lost".format(self.serverfolder, self.maxLag))
+					self.pingToken = None
+					self.connectionLostFunction()
+					return
+				#Don't count the time the reply took, so the PINGs stay evenly spaced
+				gevent.sleep(max(0.0, self.secondsBetweenPings - self.getLastLag()))
+		except gevent.GreenletExit:
+			pass
+		finally:
+			self.monitorGreenlet = None
+
+	def pongReceived(self, pongToken):
+		"""Called when the server replied to a PING. Replies that aren't to our most recent PING are ignored"""
+		if self.pingToken is None or pongToken != self.pingToken:
+			return
+		lag = time.time() - self.pingSentAt
+		self.pingToken = None
+		self.lagMeasurements.append(lag)
+		self.lagMeasuredFunction(lag)
+		self.pongReceivedEvent.set()
+
+	def getLastLag(self):
+		"""Returns the most recently measured lag in seconds, or None if it hasn't been measured yet"""
+		return self.lagMeasurements[-1] if self.lagMeasurements else None
+
+	def getLagPercentiles(self, percentiles=(50, 90, 99)):
+		"""
+		Returns a list with the lag in seconds at each of the provided percentiles of the recent lag measurements. So for 90, the lag that 90% of the measurements were at or below
+		:return: A list with the lag for each percentile, in the same order as the percentiles. Empty if no lag was measured yet
+		"""
+		if not self.lagMeasurements:
+			return []
+		sortedLags = sorted(self.lagMeasurements)
+		return [sortedLags[max(0, int(math.ceil(percentile / 100.0 * len(sortedLags))) - 1)] for percentile in percentiles]
+
+	def getStats(self):
+		"""Returns a short description of the measured lag, for logging or showing to admins"""
+		if not self.lagMeasurements:
+			return "No lag measured yet"
+		medianLag, highLag, highestLag = self.getLagPercentiles((50, 90, 100))
+		return "Lag is {:.3f} seconds now, {:.3f} median, {:.3f} at the 90th percentile, {:.3f} highest, over the last {:,} measurements".format(
+			self.getLastLag(), medianLag, highLag, highestLag, len(self.lagMeasurements))
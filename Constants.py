@@ -1,10 +1,17 @@
 CTCP_DELIMITER = chr(1)
-MAX_MESSAGE_LENGTH = 450  #Officially 512 including the newline characters, but let's be on the safe side
+MAX_LINE_LENGTH = 512  #Including the closing '\r\n'. Servers can say they allow longer lines with the 'LINELEN' RPL_ISUPPORT token
+DEFAULT_MAX_USERNAME_LENGTH = 11  #Used to estimate how long our own user address is, if we don't know it yet. 10 characters, plus a '~' added by the server if there's no ident
+DEFAULT_MAX_HOSTNAME_LENGTH = 63
+MAX_INCOMING_LINE_LENGTH = 8703  #Lines are 512 bytes at most, but IRCv3 message tags can add up to 8191 bytes. Longer incoming lines get skipped. Can be overridden in the settings
+SOCKET_READ_SIZE = 16384  #How many bytes to read from the server socket at most per call
 CHANNEL_PREFIXES = "#&!+.~"  #All the characters that could possibly indicate something is a channel name (usually just '#' though)
+DEFAULT_NICK_PREFIXES = "~&@%+"  #The characters that can be in front of a nick in a NAMES reply to indicate channel status, if the server doesn't tell us which ones it uses
+#The IRCv3 capabilities we ask the server for, if it supports them. They let us keep the channel user lists up to date from NAMES replies and JOIN messages, instead of having to send WHO requests
+IRCV3_CAPABILITIES = ('multi-prefix', 'extended-join', 'away-notify', 'userhost-in-names', 'message-tags', 'batch')
 #Since a grey separator is often used to separate parts of a message, provide an easy way to get one
 GREY_SEPARATOR = u' \x0314|\x0f '  #'\x03' is the 'color' control char, 14 is grey, and '\x0f' is the 'reset' character ending any decoration
 IRC_NUMERIC_TO_NAME = {"001": "RPL_WELCOME", "002": "RPL_YOURHOST", "003": "RPL_CREATED", "004": "RPL_MYINFO", "005": "RPL_ISUPPORT",
 					   "251": "RPL_LUSERCLIENT", "252": "RPL_LUSEROP", "253": "RPL_LUSERUNKNOWN", "254": "RPL_LUSERCHANNELS", "255": "RPL_LUSERME",
 					   "265": "RPL_LOCALUSERS", "266": "RPL_GLOBALUSERS", "315": "RPL_ENDOFWHO", "332": "RPL_TOPIC", "333": "RPL_TOPICWHOTIME",
 					   "352": "RPL_WHOREPLY", "353": "RPL_NAMREPLY", "366": "RPL_ENDOFNAMES", "372": "RPL_MOTD", "375": "RPL_MOTDSTART", "376": "RPL_ENDOFMOTD",
-					   "412": "ERR_NOTEXTTOSEND", "433": "ERR_NICKNAMEINUSE"}
+					   "412": "ERR_NOTEXTTOSEND", "422": "ERR_NOMOTD", "396": "RPL_HOSTHIDDEN", "433": "ERR_NICKNAMEINUSE"}
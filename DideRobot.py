@@ -8,9 +8,16 @@ import gevent.socket
 
 import Constants
 import GlobalStore
+import IrcLineParser
+import MessageSplitter
 from BotSettingsManager import BotSettingsManager
+from ChannelJoinScheduler import ChannelJoinScheduler
+from ChannelMembership import ChannelMembership, ChannelUserListView
+from ConnectionHealthMonitor import ConnectionHealthMonitor
 from IrcMessage import IrcMessage
+from LineSender import LineSender
 from MessageLogger import MessageLogger
+from SocketLineReader import SocketLineReader
 
 
 class DideRobot(object):
@@ -22,9 +29,14 @@ class DideRobot(object):
 		self.serverfolder = serverfolder
 		self.ircSocket = None
 		self.nickname = None  # Will get set once we connect, when we know if we have the nickname we want
-		self.channelsUserList = {}  # Will be a dict with joined channels as keys and a list of users in those channels as values
-		self.isUpdatingChannelsUserList = False
+		self.ownUserAndHost = None  # The 'user@host' part of our own user address, as the server shows it to others. Needed to know how long our messages can be
+		self.channelMembership = ChannelMembership()  # Keeps track of which users are in which of the channels we're in
+		self.channelsUserList = ChannelUserListView(self.channelMembership)  # A read-only dict-like view with joined channels as keys and a list of user addresses in those channels as values
 		self.isMuted = False
+		self.offeredCapabilities = set()  # The IRCv3 capabilities the server said it supports. Filled in while connecting
+		self.enabledCapabilities = set()  # The IRCv3 capabilities the server agreed to enable for us
+		self.serverSupport = {}  # What the server told us it supports in its RPL_ISUPPORT messages. Keys are the uppercase tokens, values are the token values (an empty string if it doesn't have a value)
+		self.nickPrefixes = Constants.DEFAULT_NICK_PREFIXES  # The characters that indicate channel status in front of nicks in NAMES replies. Taken from RPL_ISUPPORT if the server sends it
 
 		self.connectedAt = None  # Will be set to the timestamp on which we connect. 'None' means we're not connected
 		self.connectionManagerGreenlet = None  # This will get a reference to the greenlet keeping the connection alive. If this ends, the bot is closed down
@@ -33,11 +45,13 @@ class DideRobot(object):
 		self.maxConnectionRetries = None  # None means unlimited attempts, can be set by settings file
 
 		self.secondsBetweenLineSends = None  # If it's 'None', there's no rate limiting, otherwise it's a float of seconds between line sends
-		self.linesToSend = None  # A list with all the lines to send if there is a queue and rate limiting
-		self.lineSendingGreenlet = None  # Will store the greenlet that is currently working its way through the message queue, or is None if there is none
+		self.lineSender = LineSender(self.sendLineToServer, serverfolder)  # Queues lines if they can't be sent right away because of rate limiting
+		self.channelJoinScheduler = ChannelJoinScheduler(self.queueLineToSend, self.channelMembership.getChannels, serverfolder)  # Combines channel joins into as few lines as possible, and spreads out user list requests
+		self.connectionHealthMonitor = ConnectionHealthMonitor(self.sendLineToServer, self.lineSender.updateServerLag, self.closeLaggedConnection, serverfolder)  # Measures the lag to the server, and notices when the connection silently died
 
 		self.commandPrefix = ""  # Pulled from the settings file, separate variable because it's referenced a lot
 		self.commandPrefixLength = 0  # The length if the prefix is also often needed, prevent constant recalculation
+		self.allowedCommandNames = frozenset()  # The names of the loaded commands that are allowed to run on this server, according to the white- and blacklist
 
 		#Load the settings, and only connect to the server if that succeeded
 		self.settings = BotSettingsManager(self.serverfolder)
@@ -66,11 +80,30 @@ class DideRobot(object):
 		self.secondsBetweenLineSends = self.settings.get('minSecondsBetweenMessages', -1)
 		if self.secondsBetweenLineSends <= 0:
 			self.secondsBetweenLineSends = None
+		self.lineSender.updateSettings(self.secondsBetweenLineSends, self.settings.get('messageBurstSize', 1), self.settings.get('maxQueuedMessages', 200))
+		self.channelJoinScheduler.updateSettings(self.settings.get('maxConcurrentUserListRequests', 3))
+		self.connectionHealthMonitor.updateSettings(self.settings.get('secondsBetweenPings', 30), self.settings.get('maxLagSeconds', 60))
+
+		#The command white- and blacklist may have changed, so check which commands we're allowed to use again
+		self.updateAllowedCommands()
+
+	def updateAllowedCommands(self):
+		"""Stores which of the loaded commands are allowed on this server. Needs to be called whenever the settings or the loaded commands change"""
+		allowedCommandNames = set()
+		for commandname in GlobalStore.commandhandler.commands:
+			if self.settings.commandWhitelistSet is not None:
+				#The whitelist supercedes the blacklist
+				if commandname.lower() in self.settings.commandWhitelistSet:
+					allowedCommandNames.add(commandname)
+			elif self.settings.commandBlacklistSet is None or commandname.lower() not in self.settings.commandBlacklistSet:
+				allowedCommandNames.add(commandname)
+		self.allowedCommandNames = frozenset(allowedCommandNames)
 
 	def reloadSettings(self):
 		self.settings.reloadSettings(True)
 		if self.settings.loadedSuccessfully:
 			self.parseSettings()
+			self.messageLogger.updateLogSettings()
 			return True
 		else:
 			return False
@@ -87,7 +120,14 @@ class DideRobot(object):
 			except (gevent.socket.timeout, gevent.socket.error, gevent.socket.herror, gevent.socket.gaierror) as e:
 				self.logger.error("Unable to connect to server '{}' ({}:{}), reason: {}".format(self.serverfolder, self.settings['server'], self.settings['port'], e))
 			else:
-				#Connecting was successful, authenticate
+				#Connecting was successful. Ask which IRCv3 capabilities the server supports, registration waits until we've picked the ones we want
+				self.offeredCapabilities = set()
+				self.enabledCapabilities = set()
+				self.serverSupport = {}
+				self.nickPrefixes = Constants.DEFAULT_NICK_PREFIXES
+				self.ownUserAndHost = None
+				self.sendLineToServer("CAP LS 302")
+				#Authenticate
 				if 'password' in self.settings and len(self.settings['password']) > 0:
 					self.sendLineToServer("PASS " + self.settings['password'])
 				self.sendLineToServer("NICK {}".format(self.settings['nickname']))
@@ -99,20 +139,23 @@ class DideRobot(object):
 				self.handleConnection()
 				#If we reach here, 'handleConnection' returned, so we apparently lost the connection (either accidentally or intentionally)
 
-				#Check if we were still sending messages
-				if self.lineSendingGreenlet:
-					# Kill the message sending greenlet to prevent errors
-					self.lineSendingGreenlet.kill()
-					self.lineSendingGreenlet = None
-					#Also clear the message queue, just in case something in there caused the disconnect
-					self.linesToSend = None
+				#Stop checking the connection, it's gone
+				self.logger.info("|{}| Connection lag stats: {}".format(self.serverfolder, self.connectionHealthMonitor.getStats()))
+				self.connectionHealthMonitor.stop()
 
-				#Clear the channels and users lists
-				self.channelsUserList = {}
-				self.isUpdatingChannelsUserList = False
+				#Stop sending queued lines, since there's no connection to send them over anymore. Also clear the queue, just in case something in there caused the disconnect
+				self.logger.info("|{}| Line sender stats: {}".format(self.serverfolder, self.lineSender.getStats()))
+				self.lineSender.clear()
 
-				#Shutdown here because it only makes sense if we have been connected previously
-				self.ircSocket.shutdown(gevent.socket.SHUT_RDWR)
+				#Clear the channels and users lists, and forget about joins and user list requests that were still waiting
+				self.channelMembership.clear()
+				self.channelJoinScheduler.clear()
+
+				#Shutdown here because it only makes sense if we have been connected previously. If the connection was closed because it lagged too much, it's already shut down
+				try:
+					self.ircSocket.shutdown(gevent.socket.SHUT_RDWR)
+				except gevent.socket.error:
+					pass
 
 			# We lost the connection, so close the socket and store that we lost connection
 			self.ircSocket.close()
@@ -137,57 +180,129 @@ class DideRobot(object):
 			self.logger.info("Will try reconnecting to '{}' for attempt {} in {} seconds, max attempts is {}".format(
 				self.serverfolder, self.reconnectionAttempCount, sleepTime, self.maxConnectionRetries if self.maxConnectionRetries else "not set"))
 			gevent.sleep(sleepTime)
-		#If we ever leave this loop, the bot is shut down. Unregister ourselves
+		#If we ever leave this loop, the bot is shut down. Make sure all the logs are written, and unregister ourselves
+		self.messageLogger.closelogs()
 		GlobalStore.bothandler.unregisterBot(self.serverfolder)
 
 	def handleConnection(self):
 		#Keep reading for possible incoming messages
-		incomingData = ""
+		lineReader = SocketLineReader(self.ircSocket, self.settings.get('maxIncomingLineLength', Constants.MAX_INCOMING_LINE_LENGTH), Constants.SOCKET_READ_SIZE)
+		messageTypeFunctions = self.getMessageTypeFunctions()
 		# Set the timeout to 10 minutes, so if our computer loses connection to the server/internet, we notice
 		self.ircSocket.settimeout(600)
-		while True:
+		try:
+			# The line reader only returns completely sent messages (delimited by \r\n), and keeps any unfinished messages until the rest arrives
+			for line in lineReader.readLines():
+				#Don't let a single line we can't handle end the connection
+				try:
+					self.handleLine(line, messageTypeFunctions)
+				except Exception:
+					self.logger.error("|{}| An error occurred while handling line '{}'".format(self.serverfolder, line), exc_info=True)
+		except gevent.socket.timeout:
+			self.logger.warning("|{}| Our connection to the server timed out".format(self.serverfolder))
+			return
+		# The line reader stops when the connection is closed
+		self.logger.info("|{}| Server closed the connection".format(self.serverfolder))
+
+	def closeLaggedConnection(self):
+		"""Called when the server stopped replying to our PINGs. Shutting down the socket makes 'handleConnection' stop, after which we reconnect"""
+		if self.ircSocket:
+			self.logger.warning("|{}| Server doesn't respond anymore, reconnecting".format(self.serverfolder))
 			try:
-				incomingData += self.ircSocket.recv(2048)
-			except gevent.socket.timeout:
-				self.logger.warning("|{}| Our connection to the server timed out".format(self.serverfolder))
-				return
-			# A closed connection just makes recv return an empty string. Check for that
-			if incomingData == "":
-				self.logger.info("|{}| Server closed the connection".format(self.serverfolder))
+				self.ircSocket.shutdown(gevent.socket.SHUT_RDWR)
+			except gevent.socket.error as e:
+				self.logger.error("|{}| Error while closing lagged connection: {}".format(self.serverfolder, e))
+
+	def handleLine(self, line, messageTypeFunctions):
+		"""Parses a line received from the server, and calls the function that handles that type of message. 'messageTypeFunctions' should be the result of 'getMessageTypeFunctions'"""
+		# First deal with the simplest type of message, PING. Just reply PONG
+		if line.startswith("PING"):
+			self.queueLineToSend(line.replace("PING", "PONG", 1), True, False)
+			return
+		# Let's find out what kind of message this is!
+		parsedLine = IrcLineParser.parseLine(line)
+		if not parsedLine:
+			self.logger.warning("|{}| Received a line without a message type: '{}'".format(self.serverfolder, line))
+			return
+		#Check if we have a function to deal with this type of message
+		messageTypeFunction = messageTypeFunctions.get(parsedLine.messageType, None)
+		if messageTypeFunction:
+			messageTypeFunction(self, parsedLine.prefix, parsedLine.parameters)
+		else:
+			#Message types should be uppercase, but not every server sticks to that. Check if we know it when it's uppercase
+			messageType = Constants.IRC_NUMERIC_TO_NAME.get(parsedLine.messageType, parsedLine.messageType.upper())
+			messageTypeFunction = messageTypeFunctions.get(messageType, None)
+			if messageTypeFunction:
+				messageTypeFunction(self, parsedLine.prefix, parsedLine.parameters)
+			else:
+				#No function for this type of message, fall back to a generic function
+				self.irc_unknown_message_type(parsedLine.prefix, messageType, parsedLine.parameters)
+
+	@classmethod
+	def getMessageTypeFunctions(cls):
+		"""
+		Returns a dictionary with message types as keys and the unbound 'irc_' function that handles that message type as value.
+		Numeric message types are included both as number and as name. The dictionary is only built once per class
+		"""
+		if '_messageTypeFunctions' not in cls.__dict__:
+			messageTypeFunctions = {}
+			for attributeName in dir(cls):
+				if attributeName.startswith('irc_') and attributeName != 'irc_unknown_message_type':
+					messageTypeFunctions[attributeName[4:]] = getattr(cls, attributeName).__func__
+			for numeric, name in Constants.IRC_NUMERIC_TO_NAME.iteritems():
+				if name in messageTypeFunctions:
+					messageTypeFunctions[numeric] = messageTypeFunctions[name]
+			cls._messageTypeFunctions = messageTypeFunctions
+		return cls._messageTypeFunctions
+
+	def irc_CAP(self, prefix, params):
+		"""Called during IRCv3 capability negotiation, and when the server adds or removes capabilities later"""
+		# 'params' is [our nick or '*', subcommand, capabilities]. If a list of capabilities doesn't fit in one line, every line but the last has an extra '*' parameter before the capabilities
+		subcommand = params[1].upper()
+		capabilities = params[-1].split()
+		if subcommand == 'LS' or subcommand == 'NEW':
+			#Capabilities can have values ('sasl=PLAIN,EXTERNAL'), we only need the names
+			for capability in capabilities:
+				self.offeredCapabilities.add(capability.split('=', 1)[0])
+			if len(params) > 3 and params[2] == '*':
+				#More capabilities will follow, wait for those before requesting any
 				return
-			# Handle all completely sent messages (delimited by \r\n), leave any unfinished messages for the next loop
-			while '\r\n' in incomingData:
-				line, incomingData = incomingData.split('\r\n', 1)
-				# First deal with the simplest type of message, PING. Just reply PONG
-				if line.startswith("PING"):
-					self.sendLineToServer(line.replace("PING", "PONG", 1), False)
+			wantedCapabilities = [capability for capability in Constants.IRCV3_CAPABILITIES if capability in self.offeredCapabilities and capability not in self.enabledCapabilities]
+			if wantedCapabilities:
+				self.sendLineToServer("CAP REQ :" + " ".join(wantedCapabilities))
+			elif subcommand == 'LS':
+				self.sendLineToServer("CAP END")
+		elif subcommand == 'ACK':
+			for capability in capabilities:
+				if capability.startswith('-'):
+					self.enabledCapabilities.discard(capability[1:])
 				else:
-					# Let's find out what kind of message this is!
-					lineParts = line.split(" ")
-					# A line consists at least of 'source messageType [target] content'
-					messageSource = lineParts[0]
-					# It usually starts with a colon, remove that
-					if messageSource.startswith(":"):
-						messageSource = messageSource[1:]
-					messageType = lineParts[1]
-					#Convert numerical replies to human-readable ones, if applicable. Otherwise make it uppercase, since that's the standard
-					messageType = Constants.IRC_NUMERIC_TO_NAME.get(messageType, messageType.upper())
-					#The IRC protocol uses ':' to denote the start of a multi-word string. Join those here too, for easier parsing later
-					messageParts = lineParts[2:]
-					for messagePartIndex, messagePart in enumerate(messageParts):
-						if messagePart.startswith(':'):
-							#Join all the separate parts of the wordgroup, and remove the starting colon
-							wordgroup = " ".join(messageParts[messagePartIndex:])[1:]
-							messageParts[messagePartIndex] = wordgroup
-							messageParts = messageParts[:messagePartIndex+1]
-							break
-					#Check if we have a function to deal with this type of message
-					messageTypeFunction = getattr(self, "irc_" + messageType, None)
-					if messageTypeFunction:
-						messageTypeFunction(messageSource, messageParts)
-					else:
-						#No function for this type of message, fall back to a generic function
-						self.irc_unknown_message_type(messageSource, messageType, lineParts)
+					self.enabledCapabilities.add(capability)
+			self.logger.info("|{}| Enabled IRCv3 capabilities: {}".format(self.serverfolder, ", ".join(sorted(self.enabledCapabilities))))
+			if self.connectedAt is None:
+				self.sendLineToServer("CAP END")
+		elif subcommand == 'NAK':
+			self.logger.warning("|{}| Server refused to enable IRCv3 capabilities {}".format(self.serverfolder, ", ".join(capabilities)))
+			if self.connectedAt is None:
+				self.sendLineToServer("CAP END")
+		elif subcommand == 'DEL':
+			for capability in capabilities:
+				self.offeredCapabilities.discard(capability)
+				self.enabledCapabilities.discard(capability)
+			self.logger.info("|{}| Server removed IRCv3 capabilities {}".format(self.serverfolder, ", ".join(capabilities)))
+
+	def irc_RPL_ISUPPORT(self, prefix, params):
+		"""Called when the server tells us what it supports and what its limits are. Can be sent in multiple parts"""
+		# 'params' is [our nick, token, token, ..., 'are supported by this server']. Tokens are 'KEY', 'KEY=VALUE', or '-KEY' if a previously sent token doesn't apply anymore
+		for token in params[1:-1]:
+			if token.startswith('-'):
+				self.serverSupport.pop(token[1:].upper(), None)
+			else:
+				key, value = token.split('=', 1) if '=' in token else (token, "")
+				self.serverSupport[key.upper()] = value
+		# 'PREFIX' looks like '(ov)@+', with the channel modes between the brackets and the characters shown in front of nicks after that
+		if 'PREFIX' in self.serverSupport:
+			self.nickPrefixes = self.serverSupport['PREFIX'].split(')', 1)[-1]
 
 	def irc_RPL_WELCOME(self, source, parameters):
 		"""Called when we finished connecting to the server"""
@@ -195,60 +310,83 @@ class DideRobot(object):
 		# We successfully connected, reset the reconnection count
 		self.reconnectionAttempCount = None
 		self.connectedAt = time.time()
+		# Start keeping an eye on the connection
+		self.connectionHealthMonitor.start()
 		# Get the nickname we got assigned from the message
 		self.nickname = parameters[0]
+		# Most servers include our full user address at the end of the welcome message
+		welcomeMessageEnd = parameters[-1].rsplit(' ', 1)[-1]
+		if welcomeMessageEnd.startswith(self.nickname + '!') and '@' in welcomeMessageEnd:
+			self.ownUserAndHost = welcomeMessageEnd.split('!', 1)[1]
 		if self.nickname != self.settings['nickname']:
 			self.logger.info("|{} Nickname not available. Wanted '{}', got '{}'".format(self.serverfolder, self.settings['nickname'], self.nickname))
 		# Inform all the modules that we connected
 		message = IrcMessage("RPL_WELCOME", self, None, source, " ".join(parameters))
 		GlobalStore.commandhandler.handleMessage(message)
-		# Join the channels we should, if there are any
+		# Join the channels we should, if there are any. They're actually joined once the server has told us its limits, at the end of the message of the day
 		if len(self.settings['joinChannels']) == 0:
 			self.logger.info("|{}| No join channels specified, idling".format(self.serverfolder))
 		else:
 			for channel in self.settings['joinChannels']:
 				self.joinChannel(channel)
+		self.channelJoinScheduler.waitForServerLimits()
+
+	def irc_RPL_ENDOFMOTD(self, prefix, params):
+		#The message of the day is the last thing the server sends after welcoming us, so by now we know its limits and can start joining channels
+		self.channelJoinScheduler.setReadyToJoin(self.serverSupport)
+
+	def irc_ERR_NOMOTD(self, prefix, params):
+		#If there's no message of the day, this gets sent instead of it
+		self.channelJoinScheduler.setReadyToJoin(self.serverSupport)
 
 	def joinChannel(self, channelname):
 		if channelname[0] not in Constants.CHANNEL_PREFIXES:
 			channelname = "#" + channelname
-		if channelname in self.channelsUserList:
+		if self.channelMembership.hasChannel(channelname):
 			self.logger.warning("|{}| Asked to join '{}' but I'm already there".format(self.serverfolder, channelname))
 		else:
-			self.sendLineToServer("JOIN {}".format(channelname))
+			self.channelJoinScheduler.queueJoin(channelname)
 
 	def leaveChannel(self, channelName, leaveMessage="Leaving..."):
-		if channelName not in self.channelsUserList:
+		if not self.channelMembership.hasChannel(channelName):
 			self.logger.warning("|{}| Asked to leave '{}', but I'm not there".format(self.serverfolder, channelName))
 		else:
-			self.sendLineToServer("PART {} :{}".format(channelName, leaveMessage))
+			self.queueLineToSend("PART {} :{}".format(channelName, leaveMessage))
 
 	def setNick(self, nickname):
-		self.sendLineToServer("NICK " + nickname)
+		self.queueLineToSend("NICK " + nickname)
 
 	def irc_ERR_NICKNAMEINUSE(self, source, parameters):
 		# The nickname we want is apparently in use. Just append an underscore and try again
 		newNicknameAttempt = parameters[1] + "_"
 		self.logger.info("|{}| Requested nickname '{}' in use, retrying with nickname '{}'".format(self.serverfolder, parameters[1], newNicknameAttempt))
 		self.nickname = newNicknameAttempt
-		self.sendLineToServer("NICK " + newNicknameAttempt)
+		self.queueLineToSend("NICK " + newNicknameAttempt)
 
 	#Create a list of user addresses per channel
-	def retrieveChannelUsers(self, channel):
-		self.isUpdatingChannelsUserList = True
+	def retrieveChannelUsers(self, channel, isNamesReplyExpected=False):
+		"""
+		(Re)builds the list of users in the channel.
+		:param isNamesReplyExpected: Whether the server will send a NAMES reply for this channel without asking, which happens when we join a channel
+		"""
 		#Make sure we don't get duplicate data
-		if channel in self.channelsUserList:
-			self.channelsUserList.pop(channel)
-		self.sendLineToServer("WHO {}".format(channel))
+		self.channelMembership.removeChannel(channel)
+		#With 'userhost-in-names', a NAMES reply has the full address of every user, which is a lot less to send and parse than a WHO reply
+		# The requests are spread out, so joining a lot of channels doesn't flood us with replies
+		if 'userhost-in-names' in self.enabledCapabilities:
+			self.channelMembership.addChannel(channel)
+			self.channelJoinScheduler.requestUserList(channel, None if isNamesReplyExpected else "NAMES {}".format(channel))
+		else:
+			self.channelJoinScheduler.requestUserList(channel, "WHO {}".format(channel))
 
 	def quit(self, quitMessage=None):
 		self.shouldReconnect = False
 		#If we are connected to a server, let it know we want to quit
 		if self.connectedAt is not None:
 			if quitMessage:
-				self.sendLineToServer("QUIT :" + quitMessage)
+				self.queueLineToSend("QUIT :" + quitMessage)
 			else:
-				self.sendLineToServer("QUIT")
+				self.queueLineToSend("QUIT")
 		# If we're not connected (yet?), stop trying to connect
 		elif self.connectionManagerGreenlet:
 			self.logger.info("|{}| Asked to quit, but not connected. Stopping wait before next connection attempt".format(self.serverfolder))
@@ -266,20 +404,30 @@ class DideRobot(object):
 	def ctcp_unknown_message_type(self, ctcpType, user, messageTarget, message):
 		self.logger.info("|{}| Received unknown CTCP command '{}' on {} from {}, message '{}'".format(self.serverfolder, ctcpType, messageTarget, user, message))
 
+	def irc_PONG(self, prefix, params):
+		#The server's reply to a PING we sent. 'params' is [server, token]
+		self.connectionHealthMonitor.pongReceived(params[-1])
+
 	def irc_RPL_MOTD(self, prefix, params):
 		self.messageLogger.log("Server message of the day: " + params[1])
 
 	def irc_JOIN(self, prefix, params):
 		"""Called when a user or the bot joins a channel"""
-		# 'prefix' is the user, 'params' is a list with apparently just one entry, the channel
+		# 'prefix' is the user, 'params' is a list with just the channel. With 'extended-join', the joining user's account name ('*' if they're not logged in) and realname follow
 		message = IrcMessage('join', self, prefix, params[0])
 		self.messageLogger.log("JOIN: {nick} ({address})".format(nick=message.userNickname, address=prefix), params[0])
 		# If we just joined a channel, or if don't have a record of this channel yet, get all the users in it
-		if message.userNickname == self.nickname or params[0] not in self.channelsUserList:
+		if message.userNickname == self.nickname:
+			# This is also the most reliable way to learn how others see our user address
+			if '!' in prefix:
+				self.ownUserAndHost = prefix.split('!', 1)[1]
+			self.retrieveChannelUsers(params[0], True)
+		elif not self.channelMembership.hasChannel(params[0]):
 			self.retrieveChannelUsers(params[0])
-		# If we don't know this user yet, add it to our list
-		elif prefix not in self.channelsUserList[params[0]]:
-			self.channelsUserList[params[0]].append(prefix)
+		# Otherwise just add the user to our list
+		else:
+			account = params[1] if len(params) > 1 and params[1] != '*' else None
+			self.channelMembership.addUser(params[0], prefix, account, False if 'away-notify' in self.enabledCapabilities else None)
 		GlobalStore.commandhandler.handleMessage(message)
 
 	def irc_PART(self, prefix, params):
@@ -288,17 +436,16 @@ class DideRobot(object):
 		message = IrcMessage('part', self, prefix, params[0])
 		self.messageLogger.log("PART: {nick} ({address})".format(nick=message.userNickname, address=prefix), params[0])
 		# If a user parts before we have a proper channellist built, catch that error
-		if params[0] not in self.channelsUserList:
+		if not self.channelMembership.hasChannel(params[0]):
 			self.logger.warning("|{}| Unexpected PART, user '{}' parted from channel '{}' but we had no record of them".format(self.serverfolder, prefix, params[0]))
-			# Schedule a rebuild of the userlist
-			if not self.isUpdatingChannelsUserList:
-				self.retrieveChannelUsers(params[0])
+			# Schedule a rebuild of the userlist. If one is already scheduled for this channel, this doesn't request it again
+			self.retrieveChannelUsers(params[0])
 		# Keep track of the channels we're in
 		elif message.userNickname == self.nickname:
-			self.channelsUserList.pop(params[0])
+			self.channelMembership.removeChannel(params[0])
 		# Keep track of channel users
-		elif prefix in self.channelsUserList[params[0]]:
-			self.channelsUserList[params[0]].remove(prefix)
+		else:
+			self.channelMembership.removeUser(params[0], message.userNickname)
 		GlobalStore.commandhandler.handleMessage(message)
 
 	def irc_QUIT(self, prefix, params):
@@ -307,10 +454,8 @@ class DideRobot(object):
 		# log for every channel the user was in that they quit
 		message = IrcMessage('quit', self, prefix, None, params[0])
 		logMessage = "QUIT: {nick} ({address}): '{quitmessage}' ".format(nick=message.userNickname, address=prefix, quitmessage=params[0])
-		for channel, userlist in self.channelsUserList.iteritems():
-			if prefix in userlist:
-				self.messageLogger.log(logMessage, channel)
-				userlist.remove(prefix)
+		for channel in self.channelMembership.removeUserFromAllChannels(message.userNickname):
+			self.messageLogger.log(logMessage, channel)
 		GlobalStore.commandhandler.handleMessage(message)
 
 	def irc_KICK(self, prefix, params):
@@ -321,10 +466,9 @@ class DideRobot(object):
 		self.messageLogger.log("KICK: {} was kicked by {}, reason: '{}'".format(kickedUserNick, message.userNickname, params[-1]), params[0])
 		# Keep track of the channels we're in
 		if kickedUserNick == self.nickname:
-			if params[0] in self.channelsUserList:
-				self.channelsUserList.pop(params[0])
-		elif params[1] in self.channelsUserList[params[0]]:
-			self.channelsUserList[params[0]].remove(params[1])
+			self.channelMembership.removeChannel(params[0])
+		else:
+			self.channelMembership.removeUser(params[0], kickedUserNick)
 		GlobalStore.commandhandler.handleMessage(message)
 
 	def irc_NICK(self, prefix, params):
@@ -333,19 +477,13 @@ class DideRobot(object):
 		message = IrcMessage('nickchange', self, prefix, None, params[0])
 		oldnick = message.userNickname
 		newnick = params[0]
-		# New nick plus old address
-		newaddress = newnick + "!" + prefix.split("!", 1)[1]
 		# If it's about us, apparently a nick change was successful
 		if oldnick == self.nickname:
 			self.nickname = newnick
 			self.logger.info("|{}| Our nick got changed from '{}' to '{}'".format(self.serverfolder, oldnick, self.nickname))
-		# Log the change in every channel where it's relevant
-		for channel, userlist in self.channelsUserList.iteritems():
-			if prefix in userlist:
-				# Update the userlists for all channels this user is in
-				userlist.append(newaddress)
-				userlist.remove(prefix)
-				self.messageLogger.log("NICK CHANGE: {oldnick} changed their nick to {newnick}".format(oldnick=oldnick, newnick=newnick), channel)
+		# Update the user in all the channels they're in, and log the change in those channels
+		for channel in self.channelMembership.renameUser(oldnick, newnick):
+			self.messageLogger.log("NICK CHANGE: {oldnick} changed their nick to {newnick}".format(oldnick=oldnick, newnick=newnick), channel)
 		GlobalStore.commandhandler.handleMessage(message)
 
 	def irc_MODE(self, prefix, params):
@@ -371,16 +509,48 @@ class DideRobot(object):
 	def irc_RPL_NOTOPIC(self, prefix, params):
 		self.logger.debug("irc_RPL_NOTOPIC called, prefix is '{}', params is '{}'".format(prefix, params))
 
+	def irc_RPL_HOSTHIDDEN(self, prefix, params):
+		#Some servers hide our real host, 'params' is [own_nick, new host, 'is now your displayed host']
+		if self.ownUserAndHost and '@' in self.ownUserAndHost:
+			self.ownUserAndHost = "{}@{}".format(self.ownUserAndHost.split('@', 1)[0], params[1])
+
 	def irc_RPL_WHOREPLY(self, prefix, params):
 		#'prefix' is the server, 'params' is a list, with meaning [own_nick, channel, other_username, other_address, other_server, other_nick, flags, hops realname]
 		# Flags can be H for active or G for away, and a * for oper, + for voiced
-		if params[1] not in self.channelsUserList:
-			self.channelsUserList[params[1]] = []
-		self.channelsUserList[params[1]].append("{nick}!{username}@{address}".format(nick=params[5], username=params[2], address=params[3]))
+		self.channelMembership.addUser(params[1], "{nick}!{username}@{address}".format(nick=params[5], username=params[2], address=params[3]), isAway=params[6].startswith('G'))
 
 	def irc_RPL_ENDOFWHO(self, prefix, params):
-		self.isUpdatingChannelsUserList = False
-		self.logger.info("|{}| Userlist for channels {} collected".format(self.serverfolder, ", ".join(self.channelsUserList.keys())))
+		#'params' is [own_nick, channel, 'End of /WHO list.']
+		self.logger.info("|{}| Userlist for channel {} collected, {:,} users".format(self.serverfolder, params[1], self.channelMembership.getChannelUserCount(params[1])))
+		self.channelJoinScheduler.userListReceived(params[1])
+
+	def irc_RPL_NAMREPLY(self, prefix, params):
+		#'prefix' is the server, 'params' is [own_nick, channel type, channel, space-separated nicks]. Some servers leave out the channel type
+		# Nicks can have status characters in front of them (like '@' for ops), and with 'multi-prefix' that can be more than one
+		#Without 'userhost-in-names' the reply only has nicks, so then the user list gets built from a WHO reply instead
+		if 'userhost-in-names' not in self.enabledCapabilities:
+			return
+		channel = params[-2]
+		for userAddress in params[-1].split():
+			self.channelMembership.addUser(channel, userAddress.lstrip(self.nickPrefixes))
+
+	def irc_RPL_ENDOFNAMES(self, prefix, params):
+		#'params' is [own_nick, channel, 'End of /NAMES list.']
+		if 'userhost-in-names' in self.enabledCapabilities:
+			self.logger.info("|{}| Userlist for channel {} collected, {:,} users".format(self.serverfolder, params[1], self.channelMembership.getChannelUserCount(params[1])))
+			self.channelJoinScheduler.userListReceived(params[1])
+
+	def irc_AWAY(self, prefix, params):
+		#With 'away-notify', we get told when users in our channels go away or come back. 'prefix' is the user, 'params' has the away message, or is empty if they're back
+		self.channelMembership.setUserAway(prefix.split('!', 1)[0], len(params) > 0 and len(params[0]) > 0)
+
+	def irc_BATCH(self, prefix, params):
+		#With 'batch', related messages (like all the quits of a netsplit) are marked as belonging together. The messages themselves get handled like any other message
+		self.logger.debug("|{}| Batch {}: {}".format(self.serverfolder, params[0], " ".join(params[1:])))
+
+	def irc_TAGMSG(self, prefix, params):
+		#With 'message-tags', messages that only consist of tags (like typing notifications) can be sent. We don't use those
+		pass
 
 
 	#CTCP FUNCTIONS
@@ -478,35 +648,32 @@ class DideRobot(object):
 	def formatCtcpMessage(ctcpType, messageText):
 		return "{delim}{ctcpType} {msg}{delim}".format(delim=Constants.CTCP_DELIMITER, ctcpType=ctcpType, msg=messageText)
 
-	def sendLineFromQueue(self):
-		try:
-			while True:
-				#Verify that we're still connected and there is still a message in the queue, otherwise reset everything
-				if self.connectedAt is None or not self.linesToSend or len(self.linesToSend) == 0:
-					self.linesToSend = None
-					self.lineSendingGreenlet = None
-					break
-				#Remove the first queued message and send it
-				self.sendLineToServer(self.linesToSend.pop(0))
-				#Keep going through the message queue until it's empty
-				gevent.sleep(self.secondsBetweenLineSends)
-		except gevent.GreenletExit:
-			self.logger.info("|{}| Line sender greenlet was killed".format(self.serverfolder))
-
-	def queueLineToSend(self, lineToSend):
-		#If there's no rate limiting, there's no need for queueing either. Send the message now
-		if not self.secondsBetweenLineSends:
-			self.sendLineToServer(lineToSend)
-			return
-		#If there are no lines queued, the list is set to 'None'. Create a new list
-		if not self.linesToSend:
-			self.linesToSend = [lineToSend]
-		# Add the message to the queue
+	def queueLineToSend(self, lineToSend, isHighPriority=None, shouldLogMessage=True):
+		"""
+		Sends the line as soon as the rate limit allows it
+		:param isHighPriority: Whether the line should be sent before any queued chat output. If it's None, commands like PONG, NICK, JOIN and QUIT are high priority
+		"""
+		self.lineSender.queueLine(lineToSend, isHighPriority, shouldLogMessage)
+
+	def getMaxMessageLength(self, messageCommand, target):
+		"""
+		Returns how many bytes of message text fit in one line sent to the target. The server relays our message as ':nick!user@host PRIVMSG target :message\r\n',
+		and that whole line has to fit in the server's line length limit, so everything except the message itself is subtracted
+		"""
+		serverLineLength = self.serverSupport.get('LINELEN', "")
+		maxLength = int(serverLineLength) if serverLineLength.isdigit() else Constants.MAX_LINE_LENGTH
+		if self.ownUserAndHost:
+			userAndHostLength = len(self.ownUserAndHost)
 		else:
-			self.linesToSend.append(lineToSend)
-		# If there's not yet a greenlet clearing the message queue, create one
-		if not self.lineSendingGreenlet:
-			self.lineSendingGreenlet = gevent.spawn(self.sendLineFromQueue)
+			#We don't know our user address yet, so assume the longest one the server allows
+			maxUsernameLength = self.serverSupport.get('USERLEN', "")
+			maxHostnameLength = self.serverSupport.get('HOSTLEN', "")
+			userAndHostLength = (int(maxUsernameLength) + 1 if maxUsernameLength.isdigit() else Constants.DEFAULT_MAX_USERNAME_LENGTH) + 1 + \
+								(int(maxHostnameLength) if maxHostnameLength.isdigit() else Constants.DEFAULT_MAX_HOSTNAME_LENGTH)
+		#':' + nick + '!' + user@host + ' ' + command + ' ' + target + ' :' + message + '\r\n'
+		maxLength -= 1 + len(self.nickname or self.settings['nickname']) + 1 + userAndHostLength + 1 + len(messageCommand) + 1 + len(target) + 2 + 2
+		#Always allow a reasonable amount of text per line, even if something went wrong in the calculation
+		return max(maxLength, 100)
 
 	def sendMessage(self, target, messageText, messageType='say'):
 		#Only say something if we're not muted, or if it's a private message or a notice
@@ -522,57 +689,56 @@ class DideRobot(object):
 				target = target.encode('utf-8')
 			logtext = ""
 			messageCommand = "PRIVMSG"
+			maxMessageLength = self.getMaxMessageLength(messageCommand, target)
 			if messageType == 'action':
-				#An action is just a special type of Say
+				#An action is just a special type of Say, and every line needs to be an action, so leave room for the CTCP formatting
 				logtext += "*"
-				messageText = self.formatCtcpMessage("ACTION", messageText)
+				maxMessageLength -= len(self.formatCtcpMessage("ACTION", ""))
 			elif messageType == 'notice':
 				logtext += "[notice] "
 				messageCommand = "NOTICE"
+				maxMessageLength = self.getMaxMessageLength(messageCommand, target)
 			logtext += "{user}: {message}"
-			line = "{} {} :{}".format(messageCommand, target, messageText)
-			extraLines = None
-			#Turn newlines in this line into multiple lines
-			if '\n' in line or '\r' in line:
-				extraLines = line.splitlines()
-				line = extraLines.pop(0)
-			#Check if the line isn't too long to send
-			if len(line) >= Constants.MAX_MESSAGE_LENGTH:
-				if not extraLines:
-					extraLines = [line[Constants.MAX_MESSAGE_LENGTH:]]
+			#Split the message into lines that fit, at newlines and, if a line is too long, at a space near the limit
+			for messagePart in MessageSplitter.splitMessage(messageText, maxMessageLength):
+				if messageType == 'action':
+					messagePart = self.formatCtcpMessage("ACTION", messagePart)
+				line = "{} {} :{}".format(messageCommand, target, messagePart)
+				if target[0] not in Constants.CHANNEL_PREFIXES:
+					#If it's a PM, bypass the message queue
+					self.sendLineToServer(line)
 				else:
-					extraLines.insert(0, line[Constants.MAX_MESSAGE_LENGTH:])
-				line = line[:Constants.MAX_MESSAGE_LENGTH]
-			if target[0] not in Constants.CHANNEL_PREFIXES:
-				#If it's a PM, bypass the message queue
-				self.sendLineToServer(line)
-			else:
-				self.queueLineToSend(line)
-			self.messageLogger.log(logtext.format(user=self.nickname, message=messageText), target)
-			#Make sure any extra lines get sent too
-			if extraLines:
-				for extraLine in extraLines:
-					self.sendMessage(target, extraLine, messageType)
+					self.queueLineToSend(line)
+			#Log each line of the message once, even if it had to be sent in parts
+			for messageLine in messageText.splitlines():
+				if messageLine:
+					self.messageLogger.log(logtext.format(user=self.nickname, message=messageLine), target)
 
 
 	#USER LIST CHECKING FUNCTIONS
 	def isUserAdmin(self, user, userNick=None, userAddress=None):
-		return self.isUserInList(self.settings['admins'], user, userNick, userAddress)
+		return self.isUserInList(self.settings.adminsSet, user, userNick, userAddress)
 
 	def shouldUserBeIgnored(self, user, userNick=None, userAddress=None):
-		return self.isUserInList(self.settings['userIgnoreList'], user, userNick, userAddress)
+		return self.isUserInList(self.settings.userIgnoreSet, user, userNick, userAddress)
 
 	@staticmethod
 	def isUserInList(userlist, user, userNick=None, userAddress=None):
+		"""
+		Checks whether the full user address, the nick, or the address part is in the provided userlist
+		:param userlist: A set (or other container) with lowercase entries, like the ones the BotSettingsManager creates
+		"""
 		if user is None:
 			return False
-		if user in userlist or user.lower() in userlist:
+		user = user.lower()
+		if user in userlist:
 			return True
 		#If a usernick is provided, use that, otherwise split the full user address ourselves (if possible)
 		if '!' not in user:
 			return False
 		if userNick is None or userAddress is None:
 			userNick, userAddress = user.split('!', 1)
-		if userNick in userlist or userNick.lower() in userlist or userAddress in userlist or userAddress.lower() in userlist:
-			return True
-		return False
+		else:
+			userNick = userNick.lower()
+			userAddress = userAddress.lower()
+		return userNick in userlist or userAddress in userlist
@@ -0,0 +1,52 @@
+class FuzzyNameIndex(object):
+	"""
+	An index of names by the trigrams (three-character parts) they contain, to quickly find the names that are closest to a possibly misspelled name.
+	Names are compared case-insensitively
+	"""
+
+	def __init__(self, names):
+		"""
+		:param names: An iterable with the names to index
+		"""
+		self.names = {}  #Keys are the lowercase names, values are the names as they were provided
+		self.namesByTrigram = {}  #Keys are trigrams, values are lists of the lowercase names that contain that trigram
+		self.trigramCounts = {}  #Keys are the lowercase names, values are how many different trigrams that name has
+		for name in names:
+			lowercaseName = name.lower()
+			if lowercaseName in self.names:
+				continue
+			self.names[lowercaseName] = name
+			trigrams = self.getTrigrams(lowercaseName)
+			self.trigramCounts[lowercaseName] = len(trigrams)
+			for trigram in trigrams:
+				if trigram not in self.namesByTrigram:
+					self.namesByTrigram[trigram] = [lowercaseName]
+				else:
+					self.namesByTrigram[trigram].append(lowercaseName)
+
+	@staticmethod
+	def getTrigrams(text):
+		#Pad the text with spaces, so the start and end of words count as trigrams too, which helps with short names
+		text = u"  {} ".format(text)
+		return set(text[index:index + 3] for index in xrange(len(text) - 2))
+
+	def getClosestNames(self, name, maxResults=5, minimumSimilarity=0.3):
+		"""
+		Finds the indexed names that are most similar to the provided name. Similarity is the number of shared trigrams divided by the number of different trigrams in both names
+		:return: A list of (name, similarity) tuples, most similar first. Similarity goes from 0 (nothing in common) to 1 (identical)
+		"""
+		trigrams = self.getTrigrams(name.lower())
+		sharedTrigramCounts = {}
+		for trigram in trigrams:
+			for indexedName in self.namesByTrigram.get(trigram, ()):
+				sharedTrigramCounts[indexedName] = sharedTrigramCounts.get(indexedName, 0) + 1
+		matches = []
+		for indexedName, sharedTrigramCount in sharedTrigramCounts.iteritems():
+			similarity = float(sharedTrigramCount) / (len(trigrams) + self.trigramCounts[indexedName] - sharedTrigramCount)
+			if similarity >= minimumSimilarity:
+				matches.append((similarity, indexedName))
+		matches.sort(reverse=True)
+		return [(self.names[indexedName], similarity) for similarity, indexedName in matches[:maxResults]]
+
+	def __len__(self):
+		return len(self.names)
@@ -0,0 +1,125 @@
+class ParsedLine(object):
+	"""
+	A single line received from an IRC server, split into its parts. Message tags and the prefix are only parsed further when they're asked for,
+	since most lines don't need that
+	"""
+	__slots__ = ('rawLine', 'rawTags', 'prefix', 'messageType', 'parameters', '_tags', '_prefixParts')
+
+	def __init__(self, rawLine, rawTags, prefix, messageType, parameters):
+		self.rawLine = rawLine
+		self.rawTags = rawTags  #The unparsed IRCv3 message tags string (without the starting '@'), or None if the line had no tags
+		self.prefix = prefix  #Who or what sent the line, like 'nick!user@host' or a server name (without the starting colon). An empty string if there was no prefix, so handlers can always treat it as a string
+		self.messageType = messageType  #The message type (or command) as sent, so numeric replies are still numbers
+		self.parameters = parameters  #A list of parameters. If there's a trailing parameter (the one starting with a colon) it's the last entry, without the colon
+		#'_tags' and '_prefixParts' are left unset until they're needed, since most lines never need them
+
+	@property
+	def tags(self):
+		"""A dictionary with the IRCv3 message tags (with the escaping undone), or an empty dictionary if there aren't any"""
+		try:
+			return self._tags
+		except AttributeError:
+			self._tags = parseTags(self.rawTags) if self.rawTags else {}
+			return self._tags
+
+	def _getPrefixParts(self):
+		try:
+			return self._prefixParts
+		except AttributeError:
+			pass
+		#A user prefix looks like 'nick!user@host', a server prefix is just the server name. Some servers leave out the '!user' part
+		if not self.prefix:
+			self._prefixParts = (None, None, None)
+		else:
+			nick, hasUser, userAndHost = self.prefix.partition('!')
+			if hasUser:
+				user, hasHost, host = userAndHost.partition('@')
+				self._prefixParts = (nick, user, host if hasHost else None)
+			else:
+				nick, hasHost, host = nick.partition('@')
+				self._prefixParts = (nick, None, host if hasHost else None)
+		return self._prefixParts
+
+	@property
+	def nickname(self):
+		"""The nick (or server name) part of the prefix"""
+		return self._getPrefixParts()[0]
+
+	@property
+	def username(self):
+		return self._getPrefixParts()[1]
+
+	@property
+	def hostname(self):
+		return self._getPrefixParts()[2]
+
+	def __repr__(self):
+		return "ParsedLine({!r})".format(self.rawLine)
+
+
+_TAG_VALUE_ESCAPES = {':': ';', 's': ' ', '\\': '\\', 'r': '\r', 'n': '\n'}
+
+def unescapeTagValue(value):
+	"""Undoes the escaping IRCv3 uses in message tag values"""
+	if '\\' not in value:
+		return value
+	unescapedValue = []
+	isEscaped = False
+	for char in value:
+		if isEscaped:
+			#Unknown escapes are just the character itself, according to the spec
+			unescapedValue.append(_TAG_VALUE_ESCAPES.get(char, char))
+			isEscaped = False
+		elif char == '\\':
+			isEscaped = True
+		else:
+			unescapedValue.append(char)
+	return "".join(unescapedValue)
+
+def parseTags(rawTags):
+	"""Turns a raw IRCv3 tags string ('key1=value1;key2') into a dictionary. Tags without a value get an empty string as value"""
+	tags = {}
+	for tag in rawTags.split(';'):
+		if not tag:
+			continue
+		key, hasValue, value = tag.partition('=')
+		tags[key] = unescapeTagValue(value) if hasValue else ""
+	return tags
+
+def parseLine(line):
+	"""
+	Splits a line received from an IRC server into its parts. The format is '[@tags] [:prefix] messageType [parameters] [:trailing parameter]'
+	:return: A ParsedLine instance, or None if the line doesn't contain a message type
+	"""
+	if not line:
+		return None
+	position = 0
+	rawTags = None
+	if line[0] == '@':
+		position = line.find(' ') + 1
+		if position == 0:
+			return None
+		rawTags = line[1:position - 1]
+	prefix = ""
+	if line[position:position + 1] == ':':
+		prefixEnd = line.find(' ', position)
+		if prefixEnd == -1:
+			return None
+		prefix = line[position + 1:prefixEnd]
+		position = prefixEnd + 1
+	messageTypeEnd = line.find(' ', position)
+	if messageTypeEnd == -1:
+		messageType = line[position:]
+		parameters = []
+	else:
+		messageType = line[position:messageTypeEnd]
+		#Everything after the first ' :' is a single parameter, which can contain spaces
+		trailingStart = line.find(' :', messageTypeEnd)
+		if trailingStart == -1:
+			parameters = line[messageTypeEnd + 1:].split()
+		else:
+			parameters = line[messageTypeEnd + 1:trailingStart].split()
+			parameters.append(line[trailingStart + 2:])
+	if not messageType:
+		return None
+	return ParsedLine(line, rawTags, prefix, messageType, parameters)
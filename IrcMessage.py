@@ -4,65 +4,136 @@ import Constants
 
 
 class IrcMessage(object):
-	"""Parses incoming messages into usable parts like the command trigger"""
+	"""
+	Parses incoming messages into usable parts like the command trigger.
+	Most messages don't lead to any command being executed, so the parts are only worked out when they're first asked for
+	"""
+	__slots__ = ('messageType', 'bot', 'user', 'isPrivateMessage', '_createdAt', '_source', '_unstrippedText',
+				 '_userNickname', '_userAddress', '_rawText', '_trigger', '_message', '_messageParts')
 
 	def __init__(self, messageType, bot, user=None, source=None, rawText=""):
-		self.createdAt = time.time()
 		#MessageType is what kind of message it is. A 'say', 'action' or 'quit', for instance
 		self.messageType = messageType
 
 		self.bot = bot
 
-		#Info about the user that sent the message
+		#Info about the user that sent the message. The nickname and address get split off when they're needed
 		self.user = user
-		if self.user and '!' in self.user:
-			self.userNickname, self.userAddress = self.user.split("!", 1)
-		else:
-			self.userNickname = None
-			self.userAddress = None
 
 		#Info about the source the message came from, either a channel, or a PM from a user
-		#If there is no source provided, or the source isn't a channel, assume it's a PM
+		#If there is no source provided, or the source isn't a channel, assume it's a PM (the source is then the user's nick, which is filled in when needed)
 		if not source or source[0] not in Constants.CHANNEL_PREFIXES:
-			self.source = self.userNickname
 			self.isPrivateMessage = True
 		else:
-			self.source = source
+			self._source = source
 			self.isPrivateMessage = False
 
-		#Handle the text component, including seeing if it starts with the bot's command character
-		self.rawText = rawText
+		#The text gets parsed when the trigger or message is first requested
+		self._unstrippedText = rawText
+
+	@property
+	def createdAt(self):
+		"""The time this message was first looked at by something that needed to know. Close enough to the creation time, since messages are handled right away"""
+		try:
+			return self._createdAt
+		except AttributeError:
+			self._createdAt = time.time()
+			return self._createdAt
+
+	def _splitUser(self):
+		if self.user and '!' in self.user:
+			self._userNickname, self._userAddress = self.user.split("!", 1)
+		else:
+			self._userNickname = None
+			self._userAddress = None
+
+	@property
+	def userNickname(self):
+		try:
+			return self._userNickname
+		except AttributeError:
+			self._splitUser()
+			return self._userNickname
+
+	@property
+	def userAddress(self):
+		try:
+			return self._userAddress
+		except AttributeError:
+			self._splitUser()
+			return self._userAddress
+
+	@property
+	def source(self):
+		try:
+			return self._source
+		except AttributeError:
+			#Only private messages don't get the source set on creation
+			self._source = self.userNickname
+			return self._source
+
+	@property
+	def rawText(self):
+		try:
+			return self._rawText
+		except AttributeError:
+			self._rawText = self._unstrippedText.strip() if self._unstrippedText else self._unstrippedText
+			return self._rawText
+
+	def _parseText(self):
+		"""Handle the text component, including seeing if it starts with the bot's command character"""
 		#There isn't always text
-		if not self.rawText:
-			self.trigger = None
-			self.message = ""
-			self.messageParts = []
-			self.messagePartsLength = 0
+		if not self._unstrippedText:
+			self._trigger = None
+			self._message = ""
+			return
+		rawText = self.rawText
+		bot = self.bot
+		#Collect information about the possible command in this message
+		if rawText.startswith(bot.commandPrefix):
+			#Get the part from the end of the command prefix to the first space (the 'help' part of '!help say')
+			self._trigger = rawText[bot.commandPrefixLength:].split(" ", 1)[0].lower()
+			self._message = rawText[bot.commandPrefixLength + len(self._trigger):].lstrip()
+		#Check if the text starts with the nick of the bot, 'DideRobot: help'
+		elif bot.nickname and rawText.startswith(bot.nickname + ": ") and len(rawText) > len(bot.nickname) + 2:
+			self._trigger = rawText.split(" ", 2)[1].strip().lower()
+			self._message = rawText[len(bot.nickname) + len(self._trigger) + 3:].lstrip()  #+3 because of the colon and space
+		#In private messages we should respond too if there's no command character, because there's no other reason to PM a bot
+		elif self.isPrivateMessage:
+			self._trigger = rawText.split(" ", 1)[0].lower()
+			self._message = rawText[len(self._trigger)+1:]
 		else:
-			self.rawText = self.rawText.strip()
-			#Collect information about the possible command in this message
-			if self.rawText.startswith(bot.commandPrefix):
-				#Get the part from the end of the command prefix to the first space (the 'help' part of '!help say')
-				self.trigger = self.rawText[bot.commandPrefixLength:].split(" ", 1)[0].lower()
-				self.message = self.rawText[bot.commandPrefixLength + len(self.trigger):].lstrip()
-			#Check if the text starts with the nick of the bot, 'DideRobot: help'
-			elif bot.nickname and self.rawText.startswith(bot.nickname + ": ") and len(self.rawText) > len(bot.nickname) + 2:
-				self.trigger = self.rawText.split(" ", 2)[1].strip().lower()
-				self.message = self.rawText[len(bot.nickname) + len(self.trigger) + 3:].lstrip()  #+3 because of the colon and space
-			#In private messages we should respond too if there's no command character, because there's no other reason to PM a bot
-			elif self.isPrivateMessage:
-				self.trigger = self.rawText.split(" ", 1)[0].lower()
-				self.message = self.rawText[len(self.trigger)+1:]
-			else:
-				self.trigger = None
-				self.message = self.rawText
-
-			if self.message != "":
-				self.messageParts = self.message.split(" ")
-				self.messagePartsLength = len(self.messageParts)
-			else:
-				self.messageParts = []
-				self.messagePartsLength = 0
+			self._trigger = None
+			self._message = rawText
+
+	@property
+	def trigger(self):
+		try:
+			return self._trigger
+		except AttributeError:
+			self._parseText()
+			return self._trigger
+
+	@property
+	def message(self):
+		try:
+			return self._message
+		except AttributeError:
+			self._parseText()
+			return self._message
+
+	@property
+	def messageParts(self):
+		try:
+			return self._messageParts
+		except AttributeError:
+			message = self.message
+			self._messageParts = message.split(" ") if message != "" else []
+			return self._messageParts
+
+	@property
+	def messagePartsLength(self):
+		return len(self.messageParts)
 
 	def reply(self, replytext, messagetype=None):
 		if not messagetype:
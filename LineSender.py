@@ -0,0 +1,208 @@
+import collections, logging, time
+
+import gevent
+
+
+class LineSender(object):
+	"""
+	Sends lines to the server, no faster than the rate limit allows. The rate limit is a token bucket: sending a line uses up a token,
+	tokens come back at one per 'secondsBetweenLines', and at most 'burstSize' tokens can be saved up. So after a quiet period a few lines can be sent right away,
+	but a long reply still gets sent at the configured rate.
+	Lines that keep the connection working (PONG, NICK, JOIN, QUIT, etc.) go in a separate high-priority lane, so they never have to wait behind chat output.
+	Other lines are queued per target (channel or user), and the targets take turns using deficit round robin: each turn a target gets 'BYTES_PER_TURN' more bytes to send,
+	and it can send lines as long as it has bytes left. So a long reply in one channel doesn't hold up short replies in other channels
+	"""
+	HIGH_PRIORITY_COMMANDS = frozenset(('PONG', 'PASS', 'NICK', 'USER', 'JOIN', 'PART', 'QUIT'))
+	BYTES_PER_TURN = 512  #The maximum length of an IRC line, so every turn a target can send at least one line
+	LAG_SLOWDOWN_THRESHOLD = 2.0  #If the server takes longer than this many seconds to reply to a PING, sending gets slowed down, since the server is struggling to keep up
+	MAX_LAG_SLOWDOWN_FACTOR = 4.0
+	SECONDS_BETWEEN_LINES_WHEN_LAGGING = 1.0  #If there's no rate limit, this is the rate limit that gets slowed down when the server lags
+
+	def __init__(self, sendFunction, serverfolder):
+		"""
+		:param sendFunction: The function that actually sends a line. It gets called with the line and a boolean indicating whether the line should be logged
+		:param serverfolder: The name of the server this sender is for, used in log messages
+		"""
+		self.logger = logging.getLogger('DideRobot')
+		self.sendFunction = sendFunction
+		self.serverfolder = serverfolder
+		self.secondsBetweenLines = None  #If it's 'None', there's no rate limiting, and lines are sent right away
+		self.burstSize = 1  #How many lines can be sent at once after a quiet period
+		self.maxQueuedLines = 200  #If this many normal lines are waiting for a target, new ones get dropped, and the target gets told how many were skipped once its queue is empty
+		self.tokens = 1.0
+		self.lastTokenUpdateTime = time.time()
+		self.lagSlowdownFactor = 1.0  #How much slower than normal lines are sent, because the server is lagging
+		#The queues contain (line, shouldLogLine) tuples
+		self.highPriorityLines = collections.deque()
+		self.queuedLinesByTarget = {}  #Keys are targets (None for lines without a target), values are the queues of lines for that target
+		self.queuedLineCount = 0  #How many lines there are in all the target queues together
+		self.targetTurnOrder = collections.deque()  #The targets that have lines queued, the first one is the one whose turn it is
+		self.bytesLeftByTarget = {}  #Keys are the targets that have lines queued, values are how many bytes that target can still send before its turn ends
+		self.droppedLineCountsByTarget = {}  #Keys are targets that lines got dropped for, values are how many lines were dropped
+		self.senderGreenlet = None  #The greenlet that's working its way through the queues, or None if nothing is queued
+		#Some statistics, to check whether the rate limit settings work well
+		self.sentLineCount = 0
+		self.waitedLineCount = 0
+		self.droppedLineCount = 0
+		self.highestQueueLength = 0
+
+	def updateSettings(self, secondsBetweenLines, burstSize=1, maxQueuedLines=200):
+		self.secondsBetweenLines = secondsBetweenLines if secondsBetweenLines and secondsBetweenLines > 0 else None
+		self.burstSize = max(1, burstSize)
+		self.maxQueuedLines = max(1, maxQueuedLines)
+		self.tokens = self.burstSize
+
+	@staticmethod
+	def getLineCommand(line):
+		return line.split(' ', 1)[0].upper()
+
+	@staticmethod
+	def getLineTarget(line):
+		"""Returns who a PRIVMSG or NOTICE line is sent to, or None if it's another kind of line"""
+		lineParts = line.split(' ', 2)
+		if len(lineParts) < 3 or lineParts[0].upper() not in ('PRIVMSG', 'NOTICE'):
+			return None
+		return lineParts[1]
+
+	def updateServerLag(self, lag):
+		"""Slows down sending if the server is lagging, and goes back to the normal rate once it isn't anymore"""
+		if lag > self.LAG_SLOWDOWN_THRESHOLD:
+			lagSlowdownFactor = min(self.MAX_LAG_SLOWDOWN_FACTOR, lag / self.LAG_SLOWDOWN_THRESHOLD)
+		else:
+			lagSlowdownFactor = 1.0
+		if lagSlowdownFactor != self.lagSlowdownFactor:
+			if lagSlowdownFactor > 1.0:
+				self.logger.info("|{}| Server lag is {:.1f} seconds, sending lines {:.1f} times slower".format(self.serverfolder, lag, lagSlowdownFactor))
+			elif self.lagSlowdownFactor > 1.0:
+				self.logger.info("|{}| Server lag is back to {:.1f} seconds, sending lines at the normal rate again".format(self.serverfolder, lag))
+			self.updateTokens()
+			self.lagSlowdownFactor = lagSlowdownFactor
+
+	def getSecondsBetweenLines(self):
+		"""Returns the current number of seconds between lines, including any slowdown because of server lag, or None if there's no rate limit"""
+		if self.lagSlowdownFactor > 1.0:
+			return (self.secondsBetweenLines or self.SECONDS_BETWEEN_LINES_WHEN_LAGGING) * self.lagSlowdownFactor
+		return self.secondsBetweenLines
+
+	def updateTokens(self):
+		now = time.time()
+		secondsBetweenLines = self.getSecondsBetweenLines()
+		if secondsBetweenLines:
+			self.tokens = min(self.burstSize, self.tokens + (now - self.lastTokenUpdateTime) / secondsBetweenLines)
+		else:
+			self.tokens = self.burstSize
+		self.lastTokenUpdateTime = now
+
+	def getQueueLength(self):
+		return len(self.highPriorityLines) + self.queuedLineCount
+
+	def queueLine(self, line, isHighPriority=None, shouldLogLine=True):
+		"""
+		Sends the line right away if the rate limit allows it and nothing is waiting, and otherwise queues it
+		:param isHighPriority: Whether the line should skip ahead of normal queued lines. If it's None, it's determined from the line's command
+		"""
+		if isHighPriority is None:
+			isHighPriority = self.getLineCommand(line) in self.HIGH_PRIORITY_COMMANDS
+		#Only send right away if that doesn't skip ahead of lines that are already waiting
+		if not self.highPriorityLines and (isHighPriority or self.queuedLineCount == 0):
+			self.updateTokens()
+			if self.tokens >= 1:
+				self.tokens -= 1
+				self.sendLine(line, shouldLogLine)
+				return
+		if isHighPriority:
+			self.highPriorityLines.append((line, shouldLogLine))
+		else:
+			target = self.getLineTarget(line)
+			targetQueue = self.queuedLinesByTarget.get(target, None)
+			if targetQueue is not None and len(targetQueue) >= self.maxQueuedLines:
+				#Too much is waiting for this target already, don't make it worse. Remember who missed out, so they can be told
+				if target:
+					self.droppedLineCountsByTarget[target] = self.droppedLineCountsByTarget.get(target, 0) + 1
+				self.droppedLineCount += 1
+				if self.droppedLineCount == 1 or self.droppedLineCount % 100 == 0:
+					self.logger.warning("|{}| Send queue for '{}' is full ({:,} lines), dropped {:,} lines so far".format(self.serverfolder, target, len(targetQueue), self.droppedLineCount))
+				return
+			self.addLineToTargetQueue(target, line, shouldLogLine)
+		self.waitedLineCount += 1
+		self.highestQueueLength = max(self.highestQueueLength, self.getQueueLength())
+		#If there's not yet a greenlet sending the queued lines, create one
+		if not self.senderGreenlet:
+			self.senderGreenlet = gevent.spawn(self.sendQueuedLines)
+
+	def sendLine(self, line, shouldLogLine=True):
+		self.sendFunction(line, shouldLogLine)
+		self.sentLineCount += 1
+
+	def sendQueuedLines(self):
+		try:
+			while self.highPriorityLines or self.queuedLineCount > 0:
+				self.updateTokens()
+				if self.tokens < 1:
+					#Wait until there's a token available
+					gevent.sleep((1 - self.tokens) * self.getSecondsBetweenLines())
+					continue
+				self.tokens -= 1
+				if self.highPriorityLines:
+					self.sendLine(*self.highPriorityLines.popleft())
+				else:
+					self.sendLine(*self.getNextTargetLine())
+		except gevent.GreenletExit:
+			self.logger.info("|{}| Line sender greenlet was killed".format(self.serverfolder))
+		finally:
+			self.senderGreenlet = None
+
+	def addLineToTargetQueue(self, target, line, shouldLogLine=True):
+		targetQueue = self.queuedLinesByTarget.get(target, None)
+		if targetQueue is None:
+			targetQueue = collections.deque()
+			self.queuedLinesByTarget[target] = targetQueue
+			#A target that didn't have anything queued gets a full turn, so a short reply doesn't have to wait for a whole round of busy targets
+			self.targetTurnOrder.append(target)
+			self.bytesLeftByTarget[target] = self.BYTES_PER_TURN
+		targetQueue.append((line, shouldLogLine))
+		self.queuedLineCount += 1
+
+	def getNextTargetLine(self):
+		"""Removes the next line to send from the target queues and returns it, taking turns between the targets. Should only be called if there are lines queued"""
+		while True:
+			target = self.targetTurnOrder[0]
+			targetQueue = self.queuedLinesByTarget[target]
+			lineLength = len(targetQueue[0][0])
+			if self.bytesLeftByTarget[target] >= lineLength:
+				break
+			#This target has used up its turn. It gets more bytes for its next turn, and then it's the next target's turn
+			self.bytesLeftByTarget[target] += self.BYTES_PER_TURN
+			self.targetTurnOrder.rotate(-1)
+		self.bytesLeftByTarget[target] -= lineLength
+		lineAndShouldLog = targetQueue.popleft()
+		self.queuedLineCount -= 1
+		if not targetQueue:
+			#Nothing left for this target, so it doesn't need turns anymore
+			self.targetTurnOrder.popleft()
+			del self.queuedLinesByTarget[target]
+			del self.bytesLeftByTarget[target]
+			#If lines were skipped for this target because its queue was full, tell it how many it missed
+			droppedLineCount = self.droppedLineCountsByTarget.pop(target, 0)
+			if droppedLineCount:
+				self.addLineToTargetQueue(target, "PRIVMSG {} :[{:,} line{} skipped, there was too much to say]".format(target, droppedLineCount, 's' if droppedLineCount > 1 else ''))
+		return lineAndShouldLog
+
+	def clear(self):
+		"""Stops sending and removes everything from the queues. Called when the connection is closed, since the queued lines can't be sent anymore"""
+		if self.senderGreenlet:
+			self.senderGreenlet.kill()
+			self.senderGreenlet = None
+		self.highPriorityLines.clear()
+		self.queuedLinesByTarget = {}
+		self.queuedLineCount = 0
+		self.targetTurnOrder.clear()
+		self.bytesLeftByTarget = {}
+		self.droppedLineCountsByTarget = {}
+		self.tokens = self.burstSize
+		self.lagSlowdownFactor = 1.0
+
+	def getStats(self):
+		"""Returns a short description of how busy the queue is and has been, for logging or showing to admins"""
+		return "{:,} lines queued now, {:,} lines sent, {:,} had to wait in the queue, {:,} were dropped because the queue was full, longest queue was {:,} lines".format(
+			self.getQueueLength(), self.sentLineCount, self.waitedLineCount, self.droppedLineCount, self.highestQueueLength)
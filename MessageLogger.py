@@ -1,17 +1,25 @@
-import datetime, logging, os, re
+import datetime, logging, os, re, time
+from collections import OrderedDict
+
+import gevent
 
 import Constants
 import GlobalStore
 
 class MessageLogger(object):
-	logfiles = {}
+	logfiles = OrderedDict()  #Keys are the sanitized source names, values are the opened log files. Ordered from least to most recently written to
 	currentDay = 0
 	logfolder = None
 	bot = None
 	shouldKeepSystemLogs = True
 	shouldKeepChannelLogs = True
 	shouldKeepPrivateLogs = True
-	
+	shouldPrintToConsole = True
+	secondsBetweenFlushes = 5.0  #Logged lines are collected and written to disk in batches, at most this many seconds after they were logged
+	maxQueuedLines = 100  #If this many lines are waiting to be written, write them right away instead of waiting
+	maxOpenLogfiles = 50  #If more log files than this are open, the one that was written to longest ago gets closed. It gets reopened when it's needed again
+	maxStoredSourceNames = 1000  #If this many sanitized source names are stored, they're all forgotten, so lots of different private message users can't make it grow endlessly
+
 	def __init__(self, bot):
 		self.logger = logging.getLogger('DideRobot')
 		self.bot = bot
@@ -19,8 +27,19 @@ class MessageLogger(object):
 		self.logger.info("Creating new message logger for '{}', using logfolder '{}'".format(bot.serverfolder, self.logfolder))
 		if not os.path.exists(self.logfolder):
 				os.makedirs(self.logfolder)
+		self.queuedLines = {}  #Keys are the sanitized source names, values are lists of formatted log lines that still need to be written to that source's log
+		self.queuedLineCount = 0
+		self.flushGreenlet = None  #Set to the greenlet that will write the queued lines to disk, or None if nothing is waiting to be written
+		self.sanitizedSourceNames = {}  #Keys are source names, values are those names with any characters that aren't allowed in filenames replaced
+		self.timestampSecond = None  #The second for which 'timestamp' was created, so it only needs to be formatted once per second
+		self.timestamp = None
+		#Keep track of how often log files get opened and closed because of the open file limit, so it can be checked whether the limit is set well
+		self.logfileOpenCount = 0
+		self.logfileEvictionCount = 0
+		now = datetime.datetime.now()
+		self.currentDay = now.day
+		self.currentDateString = now.strftime("%Y-%m-%d")  #Used in the log filenames. Stored so lines still queued at the end of a day end up in that day's logs
 		self.updateLogSettings()
-		self.currentDay = datetime.datetime.now().day
 
 	def updateLogSettings(self):
 		self.logger.info("[MessageLogger] |{}| Reloading settings".format(self.bot.serverfolder))
@@ -28,6 +47,9 @@ class MessageLogger(object):
 		self.shouldKeepSystemLogs = self.bot.settings["keepSystemLogs"]
 		self.shouldKeepChannelLogs = self.bot.settings["keepChannelLogs"]
 		self.shouldKeepPrivateLogs = self.bot.settings["keepPrivateLogs"]
+		self.shouldPrintToConsole = self.bot.settings.get("printLogsToConsole", True)
+		self.secondsBetweenFlushes = self.bot.settings.get("secondsBetweenLogWrites", MessageLogger.secondsBetweenFlushes)
+		self.maxOpenLogfiles = max(1, self.bot.settings.get("maxOpenLogFiles", MessageLogger.maxOpenLogfiles))
 		#Let's not let any file handlers linger about, in case logging settings were changed
 		self.closelogs()
 
@@ -41,44 +63,102 @@ class MessageLogger(object):
 		elif source[0] not in Constants.CHANNEL_PREFIXES and not self.shouldKeepPrivateLogs:
 			return
 
-		now = datetime.datetime.now()
-		#If we're at a new day, close all the logs, since they're daily
-		if now.day != self.currentDay:
-			self.logger.info("[MessageLogger] New day, new message logs")
-			self.closelogs()
-			self.currentDay = datetime.datetime.now().day
+		#Formatting the time is relatively slow, and a lot of messages arrive in the same second, so only do it once per second
+		currentSecond = int(time.time())
+		if currentSecond != self.timestampSecond:
+			now = datetime.datetime.fromtimestamp(currentSecond)
+			#If we're at a new day, close all the logs, since they're daily. This also writes all the lines from the previous day to the previous day's logs
+			if now.day != self.currentDay:
+				self.logger.info("[MessageLogger] New day, new message logs")
+				self.closelogs()
+				self.currentDay = now.day
+				self.currentDateString = now.strftime("%Y-%m-%d")
+			self.timestampSecond = currentSecond
+			self.timestamp = now.strftime("%H:%M:%S")
 
-		timestamp = now.strftime("%H:%M:%S")
-		print "[MessageLogger] |{0}| {1} [{2}] {3}".format(self.bot.serverfolder, source, timestamp, msg)
+		if self.shouldPrintToConsole:
+			print "[MessageLogger] |{0}| {1} [{2}] {3}".format(self.bot.serverfolder, source, self.timestamp, msg)
 
 		#Remove invalid characters from the source name (like '|')
-		oldSource = source
-		source, replacementCount = re.subn(r"[^a-zA-Z0-9_]", "_", source)
-		if replacementCount > 0:
-			self.logger.debug("[MessageLogger] Replaced source '{}' with '{}' to prevent illegal-character error (changecount: {})".format(oldSource, source, replacementCount))
+		sanitizedSource = self.sanitizedSourceNames.get(source, None)
+		if sanitizedSource is None:
+			sanitizedSource, replacementCount = re.subn(r"[^a-zA-Z0-9_]", "_", source)
+			if replacementCount > 0:
+				self.logger.debug("[MessageLogger] Replaced source '{}' with '{}' to prevent illegal-character error (changecount: {})".format(source, sanitizedSource, replacementCount))
+			if len(self.sanitizedSourceNames) >= self.maxStoredSourceNames:
+				self.sanitizedSourceNames = {}
+			self.sanitizedSourceNames[source] = sanitizedSource
+
+		#Queue the line, it'll get written to disk together with other lines
+		if sanitizedSource not in self.queuedLines:
+			self.queuedLines[sanitizedSource] = ["[{0}] {1}\n".format(self.timestamp, msg)]
+		else:
+			self.queuedLines[sanitizedSource].append("[{0}] {1}\n".format(self.timestamp, msg))
+		self.queuedLineCount += 1
+		if self.queuedLineCount >= self.maxQueuedLines:
+			self.flushLogs()
+		elif not self.flushGreenlet:
+			self.flushGreenlet = gevent.spawn_later(self.secondsBetweenFlushes, self.flushLogs)
 
+	def flushLogs(self):
+		"""Writes all the queued lines to their log files"""
+		#If this isn't called from the flush greenlet itself, it isn't needed anymore
+		if self.flushGreenlet and self.flushGreenlet is not gevent.getcurrent():
+			self.flushGreenlet.kill(block=False)
+		self.flushGreenlet = None
+		if self.queuedLineCount == 0:
+			return
+		#Swap out the queue before writing, so lines logged while we're writing don't get lost
+		queuedLines = self.queuedLines
+		self.queuedLines = {}
+		self.queuedLineCount = 0
+		for source, lines in queuedLines.iteritems():
+			logfile = self.getLogfile(source)
+			if logfile:
+				logfile.write("".join(lines))
+				logfile.flush()
+
+	def getLogfile(self, source):
+		"""Returns the opened log file for the provided source, opening it if needed and closing the least recently used log file if too many are open"""
+		logfile = self.logfiles.pop(source, None)
 		#If no file has been opened for this source, open it
-		if source not in self.logfiles:
-			logfilename = "{}-{}.log".format(source, now.strftime("%Y-%m-%d"))
+		if logfile is None:
+			#Close log files until there's room for this one, starting with the one that was used longest ago
+			while len(self.logfiles) >= self.maxOpenLogfiles:
+				self.logfiles.popitem(last=False)[1].close()
+				self.logfileEvictionCount += 1
+			logfilename = "{}-{}.log".format(source, self.currentDateString)
 			try:
-				self.logfiles[source] = open(os.path.join(self.logfolder, logfilename), 'a')
+				logfile = open(os.path.join(self.logfolder, logfilename), 'a')
 			except IOError as e:
 				self.logger.error("[MessageLogger] Error while trying to open logfile '{}': {} [error number {}]".format(logfilename, e.strerror, e.errno))
-				return
-		self.logfiles[source].write("[{0}] {1}\n".format(timestamp, msg))
-		self.logfiles[source].flush()
+				return None
+			self.logfileOpenCount += 1
+		#(Re)add it at the end, so the order of the dictionary stays from least to most recently used
+		self.logfiles[source] = logfile
+		return logfile
 
 	def closelog(self, source):
 		if source in self.logfiles:
+			self.flushLogs()
 			self.logger.info("[MessageLogger] |{}| closing log '{}'".format(self.bot.serverfolder, source))
 			self.logfiles[source].close()
 			del self.logfiles[source]
 			return True
 		return False
-			
+
 	def closelogs(self):
-		self.logger.info("[MessageLogger] |{}| Closing ALL logs".format(self.bot.serverfolder))
+		#Make sure nothing that's waiting to be written gets lost
+		self.flushLogs()
+		self.logger.info("[MessageLogger] |{}| Closing ALL logs. {}".format(self.bot.serverfolder, self.getStats()))
 		for source, logfile in self.logfiles.iteritems():
 			logfile.close()
-		self.logfiles = {}
+		self.logfiles = OrderedDict()
+		#The sources that were active today may not be tomorrow, so start storing sanitized names afresh
+		self.sanitizedSourceNames = {}
 		return True
+
+	def getStats(self):
+		"""Returns a short description of how often log files had to be opened and closed, to check whether the open log file limit is set well"""
+		return "{:,} log files open now, {:,} opened so far, {:,} of them closed early because of the open log file limit of {:,}".format(
+			len(self.logfiles), self.logfileOpenCount, self.logfileEvictionCount, self.maxOpenLogfiles)
@@ -0,0 +1,86 @@
+"""
+Splits messages that are too long for a single IRC line into multiple lines. Messages are split at spaces where possible, never inside a UTF-8 character or a color code,
+and formatting (bold, colors, etc.) that's active where a message gets split is repeated at the start of the next line, so the message looks the same as it would have on one line
+"""
+
+import re
+
+
+RESET = '\x0f'
+#Bold, italic, underline, strikethrough, monospace and reverse. Each of these turns its formatting on if it's off, and off if it's on
+_TOGGLE_FORMATTING_CHARACTERS = '\x02\x1d\x1f\x1e\x11\x16'
+_FORMATTING_CODE_REGEX = re.compile(r"[\x02\x1d\x1f\x1e\x11\x16\x0f]|\x03(?:(\d{1,2})(?:,(\d{1,2}))?)?")
+_COLOR_CODE_REGEX = re.compile(r"\x03(?:\d{1,2}(?:,\d{1,2})?)?")
+_MAX_COLOR_CODE_LENGTH = 6  #'\x03', a two-digit text color, a comma, and a two-digit background color
+
+
+def getFormattingAtEnd(text):
+	"""Returns the formatting codes that turn on the formatting that's active at the end of the provided text, or an empty string if there isn't any"""
+	activeToggles = []
+	textColor = None
+	backgroundColor = None
+	for match in _FORMATTING_CODE_REGEX.finditer(text):
+		formattingCode = match.group(0)
+		if formattingCode == RESET:
+			activeToggles = []
+			textColor = None
+			backgroundColor = None
+		elif formattingCode[0] == '\x03':
+			#A color code without colors ends the coloring. A color code with only a text color keeps the background color
+			if match.group(1) is None:
+				textColor = None
+				backgroundColor = None
+			else:
+				textColor = int(match.group(1))
+				if match.group(2) is not None:
+					backgroundColor = int(match.group(2))
+		elif formattingCode in activeToggles:
+			activeToggles.remove(formattingCode)
+		else:
+			activeToggles.append(formattingCode)
+	formatting = "".join(activeToggles)
+	#Always use two digits for the colors, so a number at the start of the next line doesn't get seen as part of the color
+	if textColor is not None:
+		formatting += "\x03{:02d}".format(textColor)
+		if backgroundColor is not None:
+			formatting += ",{:02d}".format(backgroundColor)
+	return formatting
+
+def findSplitIndex(line, maxLength):
+	"""Returns where to split a line that's longer than 'maxLength' bytes, so the first part is as long as possible but still fits"""
+	splitIndex = maxLength
+	#A byte that starts with the bits '10' is the continuation of a multi-byte UTF-8 character, splitting there would break the character
+	while splitIndex > 0 and (ord(line[splitIndex]) & 0xC0) == 0x80:
+		splitIndex -= 1
+	#Split at a space if there is one, unless that would make the line a lot shorter (a space right at the split index is fine, since that gets removed)
+	spaceIndex = line.rfind(' ', 0, splitIndex + 1)
+	if spaceIndex > maxLength // 2:
+		splitIndex = spaceIndex
+	#Don't split a color code, since that would turn the color digits into text
+	colorCodeIndex = line.rfind('\x03', max(0, splitIndex - _MAX_COLOR_CODE_LENGTH), splitIndex)
+	if colorCodeIndex > -1 and _COLOR_CODE_REGEX.match(line, colorCodeIndex).end() > splitIndex:
+		splitIndex = colorCodeIndex
+	#Make sure we always make progress, even with a line full of formatting
+	return splitIndex if splitIndex > 0 else maxLength
+
+def splitMessage(message, maxLength):
+	"""
+	Splits a message into lines that are at most 'maxLength' bytes long. Newlines in the message always start a new line
+	:param message: The message to split, as a UTF-8 encoded string
+	:return: A list of lines. Empty lines are left out
+	"""
+	lines = []
+	for line in message.splitlines():
+		while len(line) > maxLength:
+			splitIndex = findSplitIndex(line, maxLength)
+			linePart = line[:splitIndex].rstrip(' ')
+			if linePart:
+				lines.append(linePart)
+			line = line[splitIndex:].lstrip(' ')
+			if not line:
+				break
+			#Continue the formatting that was active where the line got split
+			line = getFormattingAtEnd(linePart) + line
+		if line:
+			lines.append(line)
+	return lines
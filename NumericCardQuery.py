@@ -0,0 +1,177 @@
+"""
+Numeric comparisons for card searches, so searches like 'cmc: 5 or more', 'cost: <3', 'strength: 2-4' or 'power: >toughness' are possible.
+Card data stores numbers as strings, and some values aren't numbers at all ('*', 'X'). Those never match a numeric comparison
+"""
+
+import bisect, re
+
+
+_NUMBER = r"(\d+(?:\.\d+)?)"
+#Each entry is a regex for a query format, and the comparison operator it stands for. Ranges ('2-4') are handled separately
+_QUERY_FORMATS = ((re.compile(r"^(<=|>=|<|>|==|=)\s*" + _NUMBER + "$"), None),
+				  (re.compile(r"^" + _NUMBER + r"\s*\+$"), '>='),
+				  (re.compile(r"^" + _NUMBER + r"\s+or\s+(?:more|higher|greater)$"), '>='),
+				  (re.compile(r"^(?:at\s+least|minimum)\s+" + _NUMBER + "$"), '>='),
+				  (re.compile(r"^" + _NUMBER + r"\s+or\s+(?:less|lower|fewer)$"), '<='),
+				  (re.compile(r"^(?:at\s+most|maximum)\s+" + _NUMBER + "$"), '<='),
+				  (re.compile(r"^(?:more|greater|higher)\s+than\s+" + _NUMBER + "$"), '>'),
+				  (re.compile(r"^(?:less|lower|fewer)\s+than\s+" + _NUMBER + "$"), '<'))
+_RANGE_FORMAT = re.compile(r"^" + _NUMBER + r"\s*(?:-|\.\.|to)\s*" + _NUMBER + "$")
+_ATTRIBUTE_COMPARISON_FORMAT = re.compile(r"^(<=|>=|<|>|==|=|(?:more|greater|higher|less|lower|fewer)\s+than|equal\s+to)\s*([a-z]+)$")
+_WORD_OPERATORS = {'more': '>', 'greater': '>', 'higher': '>', 'less': '<', 'lower': '<', 'fewer': '<', 'equal': '='}
+
+
+def toNumber(value):
+	"""Turns a card value into a float, or returns None if it isn't a number"""
+	if value is None:
+		return None
+	try:
+		return float(value)
+	except (TypeError, ValueError):
+		return None
+
+
+class NumericQuery(object):
+	"""
+	A numeric comparison on one card attribute. It's either a range of numbers (with 'None' for an open end),
+	or a comparison with another numeric attribute of the same card
+	"""
+
+	def __init__(self, attribute, lowestValue=None, isLowestValueIncluded=True, highestValue=None, isHighestValueIncluded=True, operator=None, otherAttribute=None):
+		self.attribute = attribute
+		self.lowestValue = lowestValue
+		self.isLowestValueIncluded = isLowestValueIncluded
+		self.highestValue = highestValue
+		self.isHighestValueIncluded = isHighestValueIncluded
+		#Only used when comparing with another attribute
+		self.operator = operator
+		self.otherAttribute = otherAttribute
+
+	@staticmethod
+	def fromOperator(attribute, operator, number):
+		if operator == '<':
+			return NumericQuery(attribute, highestValue=number, isHighestValueIncluded=False)
+		elif operator == '<=':
+			return NumericQuery(attribute, highestValue=number)
+		elif operator == '>':
+			return NumericQuery(attribute, lowestValue=number, isLowestValueIncluded=False)
+		elif operator == '>=':
+			return NumericQuery(attribute, lowestValue=number)
+		return NumericQuery(attribute, lowestValue=number, highestValue=number)
+
+	def isInRange(self, number):
+		if self.lowestValue is not None and (number < self.lowestValue or (number == self.lowestValue and not self.isLowestValueIncluded)):
+			return False
+		if self.highestValue is not None and (number > self.highestValue or (number == self.highestValue and not self.isHighestValueIncluded)):
+			return False
+		return True
+
+	def matches(self, getAttributeValue):
+		"""
+		Checks whether a card matches this query
+		:param getAttributeValue: A function that gets an attribute name, and returns the value of that attribute for the card to check, or None if it doesn't have it
+		"""
+		number = toNumber(getAttributeValue(self.attribute))
+		if number is None:
+			return False
+		if self.otherAttribute is None:
+			return self.isInRange(number)
+		otherNumber = toNumber(getAttributeValue(self.otherAttribute))
+		if otherNumber is None:
+			return False
+		if self.operator == '<':
+			return number < otherNumber
+		elif self.operator == '<=':
+			return number <= otherNumber
+		elif self.operator == '>':
+			return number > otherNumber
+		elif self.operator == '>=':
+			return number >= otherNumber
+		return number == otherNumber
+
+	def getMatchingRows(self, numericColumn):
+		"""Returns a set of the row numbers in the numeric column that match this query. Comparisons with another attribute can't use a column, those return None"""
+		if self.otherAttribute is not None:
+			return None
+		return numericColumn.getRowsInRange(self.lowestValue, self.isLowestValueIncluded, self.highestValue, self.isHighestValueIncluded)
+
+	def __repr__(self):
+		if self.otherAttribute is not None:
+			return "NumericQuery({} {} {})".format(self.attribute, self.operator, self.otherAttribute)
+		return "NumericQuery({} in {}{}, {}{})".format(self.attribute, '[' if self.isLowestValueIncluded else '(', self.lowestValue,
+													   self.highestValue, ']' if self.isHighestValueIncluded else ')')
+
+
+def parseNumericQuery(attribute, query, numericAttributes):
+	"""
+	Tries to interpret a search query as a numeric comparison
+	:param attribute: The attribute the query is for
+	:param query: The (lowercase) search query, like '>=5', '5 or more', '2-4', or '>toughness'
+	:param numericAttributes: The attributes that are numeric, so comparing with them is possible
+	:return: A NumericQuery instance, or None if the query isn't a numeric comparison (so it should be treated as a regex)
+	"""
+	if attribute not in numericAttributes:
+		return None
+	query = query.strip()
+	for queryFormat, operator in _QUERY_FORMATS:
+		match = queryFormat.match(query)
+		if match:
+			if operator is None:
+				return NumericQuery.fromOperator(attribute, match.group(1), float(match.group(2)))
+			return NumericQuery.fromOperator(attribute, operator, float(match.group(1)))
+	match = _RANGE_FORMAT.match(query)
+	if match:
+		lowestValue, highestValue = sorted((float(match.group(1)), float(match.group(2))))
+		return NumericQuery(attribute, lowestValue=lowestValue, highestValue=highestValue)
+	match = _ATTRIBUTE_COMPARISON_FORMAT.match(query)
+	if match and match.group(2) in numericAttributes:
+		operator = match.group(1)
+		operator = _WORD_OPERATORS.get(operator.split(' ', 1)[0], operator)
+		return NumericQuery(attribute, operator=operator, otherAttribute=match.group(2))
+	return None
+
+def extractNumericQueries(searchDict, numericAttributes):
+	"""
+	Removes the entries from the search dictionary that are numeric comparisons, and returns those as NumericQuery instances
+	:return: A list of NumericQuery instances, one for each numeric comparison that was in the search dictionary
+	"""
+	numericQueries = []
+	for attribute, query in searchDict.items():
+		numericQuery = parseNumericQuery(attribute, query, numericAttributes)
+		if numericQuery:
+			numericQueries.append(numericQuery)
+			del searchDict[attribute]
+	return numericQueries
+
+
+class NumericColumn(object):
+	"""The numeric values of one attribute for all rows (cards) that have a numeric value, sorted, so ranges of values can be found quickly"""
+
+	def __init__(self, valuesAndRows):
+		"""
+		:param valuesAndRows: An iterable with (value, row number) tuples. Values that aren't numbers are skipped
+		"""
+		numbersAndRows = []
+		for value, rowNumber in valuesAndRows:
+			number = toNumber(value)
+			if number is not None:
+				numbersAndRows.append((number, rowNumber))
+		numbersAndRows.sort()
+		self.numbers = [number for number, rowNumber in numbersAndRows]
+		self.rows = [rowNumber for number, rowNumber in numbersAndRows]
+
+	def getRowsInRange(self, lowestValue=None, isLowestValueIncluded=True, highestValue=None, isHighestValueIncluded=True):
+		"""Returns a set of the row numbers whose value is in the provided range. A 'None' value means that end of the range is open"""
+		if lowestValue is None:
+			startIndex = 0
+		elif isLowestValueIncluded:
+			startIndex = bisect.bisect_left(self.numbers, lowestValue)
+		else:
+			startIndex = bisect.bisect_right(self.numbers, lowestValue)
+		if highestValue is None:
+			endIndex = len(self.numbers)
+		elif isHighestValueIncluded:
+			endIndex = bisect.bisect_right(self.numbers, highestValue)
+		else:
+			endIndex = bisect.bisect_left(self.numbers, highestValue)
+		return set(self.rows[startIndex:endIndex])
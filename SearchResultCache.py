@@ -0,0 +1,55 @@
+from collections import OrderedDict
+
+
+class SearchResultCache(object):
+	"""
+	Keeps the results of the most recent searches, so repeated searches don't have to go through all the data again.
+	When it's full, the search that was used longest ago is removed. Searches are stored together with the version of the data they were done on,
+	so results from older data are never returned
+	"""
+
+	def __init__(self, maxSize=100):
+		"""
+		:param maxSize: How many search results to keep at most
+		"""
+		self.maxSize = maxSize
+		self.results = OrderedDict()  #Keys are (data version, search key) tuples, values are the search results. Ordered from least to most recently used
+		self.hitCount = 0
+		self.missCount = 0
+
+	@staticmethod
+	def getSearchKey(searchDict, *extraKeyParts):
+		"""Turns a search dictionary into something that can be used as a key, so the same search always gets the same key regardless of the dictionary order"""
+		return tuple(sorted(searchDict.iteritems())) + extraKeyParts
+
+	def get(self, dataVersion, searchKey):
+		"""Returns the stored result for the search on the provided data version, or None if it isn't stored"""
+		key = (dataVersion, searchKey)
+		result = self.results.pop(key, None)
+		if result is None:
+			self.missCount += 1
+			return None
+		#(Re)add it at the end, so the order of the dictionary stays from least to most recently used
+		self.results[key] = result
+		self.hitCount += 1
+		return result
+
+	def store(self, dataVersion, searchKey, result):
+		key = (dataVersion, searchKey)
+		self.results.pop(key, None)
+		while len(self.results) >= self.maxSize > 0:
+			self.results.popitem(last=False)
+		if self.maxSize > 0:
+			self.results[key] = result
+
+	def clear(self):
+		self.results = OrderedDict()
+
+	def getStats(self):
+		"""Returns a short description of how well the cache is working, for logging"""
+		lookupCount = self.hitCount + self.missCount
+		return "{:,} of {:,} searches were cached ({:.0%}), {:,} of {:,} results stored".format(self.hitCount, lookupCount, float(self.hitCount) / lookupCount if lookupCount else 0.0,
+																									len(self.results), self.maxSize)
+
+	def __len__(self):
+		return len(self.results)
@@ -1,5 +1,7 @@
-import base64, codecs, json, logging, os, random, re
+import base64, codecs, json, logging, multiprocessing, os, random, re, sre_constants, sre_parse, time
+from collections import OrderedDict
 
+import gevent
 import requests
 
 import Constants, GlobalStore
@@ -110,37 +112,65 @@ def isAllowedPath(path):
 		return False
 	return True
 
-def getLineCount(filename):
-	#Set a default in case the file has no lines
-	linecount = -1  #'-1' so with the +1 at the end it ends up a 0 for an empty file
+#Keys are absolute filenames, values are tuples of the file's modification time, its size, and a list with the byte offset where each line starts
+_lineOffsetIndexes = {}
+
+def _getAbsoluteFilename(filename):
 	if not filename.startswith(GlobalStore.scriptfolder):
 		filename = os.path.join(GlobalStore.scriptfolder, filename)
+	return filename
+
+def getLineOffsets(filename):
+	"""
+	Returns a list with the byte offset where each line in the provided file starts, so a line can be read with a single seek.
+	The list is stored, and only rebuilt when the file's modification time or size changes. Returns None if the file can't be read
+	"""
+	filename = _getAbsoluteFilename(filename)
+	if not isAllowedPath(filename):
+		return None
+	try:
+		fileStats = os.stat(filename)
+	except OSError:
+		return None
+	storedIndex = _lineOffsetIndexes.get(filename, None)
+	if storedIndex and storedIndex[0] == fileStats.st_mtime and storedIndex[1] == fileStats.st_size:
+		return storedIndex[2]
+	lineOffsets = []
+	offset = 0
+	with open(filename, 'rb') as f:
+		for line in f:
+			lineOffsets.append(offset)
+			offset += len(line)
+	_lineOffsetIndexes[filename] = (fileStats.st_mtime, fileStats.st_size, lineOffsets)
+	return lineOffsets
+
+def getLineCount(filename):
+	filename = _getAbsoluteFilename(filename)
 	if not os.path.isfile(filename):
 		return -1
-	with codecs.open(filename, 'r', 'utf-8') as f:
-		for linecount, line in enumerate(f):
-			continue
-	return linecount + 1  #'enumerate()' starts at 0, so add one
+	lineOffsets = getLineOffsets(filename)
+	if lineOffsets is None:
+		return -1
+	return len(lineOffsets)
 
 def getLineFromFile(filename, wantedLineNumber):
 	"""Returns the specified line number from the provided file (line number starts at 0)"""
-	if not filename.startswith(GlobalStore.scriptfolder):
-		filename = os.path.join(GlobalStore.scriptfolder, filename)
+	filename = _getAbsoluteFilename(filename)
 	#Check if it's an allowed path
 	if not isAllowedPath(filename):
 		return None
 	if not os.path.isfile(filename):
 		logger.error(u"Can't read line {} from file '{}'; file does not exist".format(wantedLineNumber, filename))
 		return None
-	with codecs.open(filename, 'r', 'utf-8') as f:
-		for lineNumber, line in enumerate(f):
-			if lineNumber == wantedLineNumber:
-				return line.rstrip()
-	return None
+	lineOffsets = getLineOffsets(filename)
+	if lineOffsets is None or wantedLineNumber < 0 or wantedLineNumber >= len(lineOffsets):
+		return None
+	with open(filename, 'rb') as f:
+		f.seek(lineOffsets[wantedLineNumber])
+		return f.readline().decode('utf-8').rstrip()
 
 def getRandomLineFromFile(filename, linecount=None):
-	if not filename.startswith(GlobalStore.scriptfolder):
-		filename = os.path.join(GlobalStore.scriptfolder, filename)
+	filename = _getAbsoluteFilename(filename)
 	if not linecount:
 		linecount = getLineCount(filename)
 	if linecount <= 0:
@@ -161,6 +191,120 @@ def getAllLinesFromFile(filename):
 		return linesfile.readlines()
 
 
+def containsRegexSyntax(text):
+	"""Returns whether the text contains any characters that have a special meaning in a regex. If not, a regex of the text only matches the literal text"""
+	return re.search(r"[.^$*+?{}\[\]\\|()]", text) is not None
+
+
+#Regexes entered by users could take ages to run (like '(a+)+b', which takes exponentially longer the more a's it has to check), and since everything runs on one thread,
+# that would freeze the whole bot. So compile user regexes with 'compileUserRegex', which refuses regexes that are known to be slow,
+# and run searches with them through 'runUserRegexFunction', which runs them in a separate process with a time limit if they could still be slow
+#Even a few simple repeats can be slow ('.*.*qqq' on a lot of text, or '(a?){25}a{25}' on a short text), so only regexes without any repeats or backreferences are run without a time limit
+MAX_USER_REGEX_LENGTH = 1000
+MAX_USER_REGEX_UNBOUNDED_REPEATS = 10  #Each unbounded repeat ('*', '+', '{2,}') can make a regex slower, so too many of them in one regex isn't allowed
+USER_REGEX_TIME_LIMIT = 5.0  #How many seconds a search with a possibly slow regex may take
+MAX_STORED_USER_REGEXES = 500
+_userRegexes = OrderedDict()  #Keys are (pattern, flags) tuples, values are the compiled regex. Ordered from least to most recently used
+_potentiallySlowUserRegexes = set()  #The compiled user regexes that should be run with a time limit
+
+def _analyzeRegexPattern(parsedPattern, stats, isInUnboundedRepeat=False):
+	"""Goes through a pattern parsed by 'sre_parse', and counts the parts that can make a regex slow in the provided 'stats' dictionary"""
+	for opcode, argument in parsedPattern:
+		if opcode in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+			minCount, maxCount, subpattern = argument
+			stats['repeats'] += 1
+			isUnbounded = maxCount == sre_constants.MAXREPEAT
+			if isUnbounded:
+				stats['unboundedRepeats'] += 1
+				#An unbounded repeat inside another unbounded repeat can match the same text in a huge number of ways, which makes failing matches take exponentially long
+				if isInUnboundedRepeat:
+					stats['nestedUnboundedRepeats'] += 1
+			_analyzeRegexPattern(subpattern, stats, isInUnboundedRepeat or isUnbounded)
+		elif opcode in (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS):
+			stats['backreferences'] += 1
+			if opcode == sre_constants.GROUPREF_EXISTS:
+				for subpattern in argument[1:]:
+					if subpattern:
+						_analyzeRegexPattern(subpattern, stats, isInUnboundedRepeat)
+		elif opcode == sre_constants.BRANCH:
+			for subpattern in argument[1]:
+				_analyzeRegexPattern(subpattern, stats, isInUnboundedRepeat)
+		elif opcode in (sre_constants.SUBPATTERN, sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+			_analyzeRegexPattern(argument[-1], stats, isInUnboundedRepeat)
+
+def compileUserRegex(pattern, flags=0):
+	"""
+	Compiles a regex entered by a user. Compiled regexes are stored, so using the same regex again is quick
+	:raises re.error: If the regex isn't valid, or if it's a regex that's known to be extremely slow
+	"""
+	key = (pattern, flags)
+	regex = _userRegexes.pop(key, None)
+	if regex is None:
+		if len(pattern) > MAX_USER_REGEX_LENGTH:
+			raise re.error("regex is longer than {:,} characters".format(MAX_USER_REGEX_LENGTH))
+		stats = {'repeats': 0, 'unboundedRepeats': 0, 'nestedUnboundedRepeats': 0, 'backreferences': 0}
+		_analyzeRegexPattern(sre_parse.parse(pattern, flags), stats)
+		if stats['nestedUnboundedRepeats'] > 0:
+			raise re.error("regex contains a repeat inside a repeat (like '(a+)+'), which can take extremely long to run")
+		if stats['unboundedRepeats'] > MAX_USER_REGEX_UNBOUNDED_REPEATS:
+			raise re.error("regex contains more than {:,} repeats".format(MAX_USER_REGEX_UNBOUNDED_REPEATS))
+		regex = re.compile(pattern, flags)
+		if stats['repeats'] > 0 or stats['backreferences'] > 0:
+			_potentiallySlowUserRegexes.add(regex)
+		#Make room for the new regex by removing the one that was used longest ago
+		while len(_userRegexes) >= MAX_STORED_USER_REGEXES:
+			_potentiallySlowUserRegexes.discard(_userRegexes.popitem(last=False)[1])
+	#(Re)add it at the end, so the order of the dictionary stays from least to most recently used
+	_userRegexes[key] = regex
+	return regex
+
+def isUserRegexPotentiallySlow(regex):
+	"""Returns whether the regex, compiled by 'compileUserRegex', could take long enough to run that it should get a time limit"""
+	return regex in _potentiallySlowUserRegexes
+
+def _runFunctionInWorkerProcess(resultConnection, function, args, kwargs):
+	try:
+		result = (True, function(*args, **kwargs))
+	except Exception as e:
+		result = (False, "{}: {}".format(type(e).__name__, e))
+	resultConnection.send(result)
+	resultConnection.close()
+
+def runUserRegexFunction(regexes, function, *args, **kwargs):
+	"""
+	Calls the function, which should use the provided regexes (compiled with 'compileUserRegex') on some text, and makes sure that doesn't freeze the bot.
+	If any of the regexes could be slow, the function is called in a separate process, which gets stopped if it takes longer than 'USER_REGEX_TIME_LIMIT' seconds.
+	That process is a copy of the bot, so the function can use any data that's in memory, but it can't change anything in the bot. Its result has to be picklable
+	:return: A tuple, with as the first item a boolean indicating whether the function finished in time, and the function result or an error message as the second item
+	"""
+	if not any(isUserRegexPotentiallySlow(regex) for regex in regexes):
+		return (True, function(*args, **kwargs))
+	starttime = time.time()
+	resultReceiveConnection, resultSendConnection = multiprocessing.Pipe(False)
+	process = multiprocessing.Process(target=_runFunctionInWorkerProcess, args=(resultSendConnection, function, args, kwargs))
+	process.daemon = True
+	process.start()
+	resultSendConnection.close()
+	try:
+		#Waiting for the process to finish would block everything else, so check now and then if it's done, and let other greenlets run in between
+		while not resultReceiveConnection.poll():
+			if not process.is_alive() and not resultReceiveConnection.poll():
+				logger.error("[SharedFunctions] Regex worker process stopped without returning a result (exit code {})".format(process.exitcode))
+				return (False, "Something went wrong while running the regex")
+			if time.time() - starttime > USER_REGEX_TIME_LIMIT:
+				logger.warning(u"[SharedFunctions] Stopping regex worker process after {} seconds, regexes: {}".format(USER_REGEX_TIME_LIMIT, u"; ".join(regex.pattern for regex in regexes)))
+				process.terminate()
+				return (False, "Running the regex took too long, try a simpler one")
+			gevent.sleep(0.02)
+		success, result = resultReceiveConnection.recv()
+	finally:
+		resultReceiveConnection.close()
+		process.join()
+	if not success:
+		logger.error(u"[SharedFunctions] Error in regex worker process: {}".format(result))
+		return (False, "Something went wrong while running the regex")
+	return (True, result)
+
 def parseIsoDate(isoString, formatstring=""):
 	"""Turn an ISO 8601 formatted duration string like P1DT45M3S into something readable like "1 day, 45 minutes, 3 seconds"""
 
@@ -272,6 +416,15 @@ def shortenUrl(longUrl):
 		# 'longUrl' usually contains the original URL, but sometimes it is also the result of redirects or canonization
 		return (True, data['id'], data['longUrl'])
 
+def getMemoryUsage():
+	"""Returns how much memory this process currently uses in bytes, or None if that can't be determined on this system"""
+	try:
+		with open('/proc/self/statm', 'r') as statmFile:
+			#The second field is the resident set size in pages
+			return int(statmFile.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+	except (IOError, OSError, ValueError, IndexError):
+		return None
+
 def downloadFile(url, targetFilename, timeout=30.0):
 	try:
 		r = requests.get(url, headers={'user-agent': 'DideRobot (http://github.com/Didero/DideRobot)'}, timeout=timeout)
@@ -0,0 +1,62 @@
+import logging
+
+
+class SocketLineReader(object):
+	"""Reads data from a socket into a reusable buffer, and splits it into complete lines without copying the unhandled data around for every line"""
+
+	def __init__(self, socketToRead, maxLineLength, readSize, lineDelimiter='\r\n'):
+		self.logger = logging.getLogger('DideRobot')
+		self.socket = socketToRead
+		self.maxLineLength = maxLineLength
+		self.readSize = readSize
+		self.lineDelimiter = lineDelimiter
+		self.lineDelimiterLength = len(lineDelimiter)
+		#The buffer needs room for an unfinished line of the maximum length plus one full read
+		self.buffer = bytearray(maxLineLength + self.lineDelimiterLength + readSize)
+		self.bufferView = memoryview(self.buffer)
+		self.dataStart = 0  #Where the data that hasn't been turned into a line yet starts
+		self.dataEnd = 0  #Where the data received so far ends
+		self.isDiscardingLine = False  #Set to True when a line was too long, so everything until the next line delimiter gets skipped
+
+	def readLines(self):
+		"""
+		Generator that keeps reading from the socket, and yields each complete line (without the line delimiter) as a string.
+		It stops when the other side closes the connection. Socket errors and timeouts are passed on to the caller
+		"""
+		while True:
+			#If there isn't enough room left at the end of the buffer for a full read, move the unfinished line to the start of the buffer
+			if len(self.buffer) - self.dataEnd < self.readSize:
+				unfinishedLength = self.dataEnd - self.dataStart
+				self.buffer[0:unfinishedLength] = self.buffer[self.dataStart:self.dataEnd]
+				self.dataStart = 0
+				self.dataEnd = unfinishedLength
+			bytesRead = self.socket.recv_into(self.bufferView[self.dataEnd:], self.readSize)
+			#A closed connection makes recv return nothing
+			if bytesRead == 0:
+				return
+			#The start of the line delimiter could have been at the end of the previous read, so start searching a bit before the new data
+			searchStart = max(self.dataStart, self.dataEnd - self.lineDelimiterLength + 1)
+			self.dataEnd += bytesRead
+			while True:
+				lineEnd = self.buffer.find(self.lineDelimiter, searchStart, self.dataEnd)
+				if lineEnd == -1:
+					break
+				if self.isDiscardingLine:
+					self.isDiscardingLine = False
+				elif lineEnd - self.dataStart > self.maxLineLength:
+					self.logTooLongLine()
+				else:
+					yield self.bufferView[self.dataStart:lineEnd].tobytes()
+				self.dataStart = lineEnd + self.lineDelimiterLength
+				searchStart = self.dataStart
+			#If what's left is already longer than a line is allowed to be (plus the start of the line delimiter, which could have arrived without the rest), skip it, so it can't fill up the buffer
+			if self.dataEnd - self.dataStart > self.maxLineLength + self.lineDelimiterLength - 1:
+				if not self.isDiscardingLine:
+					self.logTooLongLine()
+					self.isDiscardingLine = True
+				#Keep the last few bytes, in case they're the start of the line delimiter
+				self.dataStart = self.dataEnd - self.lineDelimiterLength + 1
+
+	def logTooLongLine(self):
+		self.logger.warning("[SocketLineReader] Received a line longer than the maximum of {:,} bytes, skipping it. Line starts with '{}'".format(self.maxLineLength,
+																																  self.bufferView[self.dataStart:self.dataStart + 50].tobytes()))
@@ -0,0 +1,77 @@
+"""
+Compares searching through the MtG cards in the line-based JSON card file with searching through the binary card store, using the search functions of the MtG module.
+Reports the time each query takes and how much memory the process used. Each store is measured in a separate process, so the memory use doesn't mix
+Usage: python benchmarks/CardStoreBenchmark.py [--repeat N]
+The card files in the bot's 'data' folder are used. If there's no binary card store yet, it gets created from the card file first
+"""
+
+import argparse, json, os, re, resource, subprocess, sys, timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from BinaryCardStore import BinaryCardStore, BinaryCardStoreWriter
+import GlobalStore
+import NumericCardQuery
+from commands.MtGlookup import Command as MtGCommand
+
+
+#Each query is a dictionary with attributes as keys and search texts as values, like users enter them. Numeric attributes get turned into numeric comparisons like MtGlookup does
+QUERIES = (('name', {'name': 'dragon'}),
+		   ('exact name', {'name': '^lightning bolt$'}),
+		   ('type and cmc', {'type': 'creature', 'cmc': '=3'}),
+		   ('set and rarity', {'set': 'zendikar', 'rarity': 'rare'}),
+		   ('text', {'text': 'draw a card'}))
+
+
+def compileQuery(query):
+	"""Returns a dictionary with the compiled regexes of the query, and a list with its numeric comparisons"""
+	query = dict(query)
+	numericQueries = NumericCardQuery.extractNumericQueries(query, MtGCommand.numericAttributes)
+	return {attribute: re.compile(regex, re.IGNORECASE) for attribute, regex in query.iteritems()}, numericQueries
+
+def searchJsonStore(regexDict, numericQueries):
+	#'searchCardStore' removes the set regex from the dictionary, so give it a copy
+	return MtGCommand.searchCardStore(dict(regexDict), numericQueries)
+
+def searchBinaryStore(regexDict, numericQueries):
+	return MtGCommand.searchBinaryCardStore(dict(regexDict), numericQueries)
+
+def createBinaryStore(cardFilename, binaryCardStoreFilename):
+	binaryCardStoreWriter = BinaryCardStoreWriter()
+	with open(cardFilename, 'r') as jsonfile:
+		for cardline in jsonfile:
+			carddata = json.loads(cardline).values()[0]
+			binaryCardStoreWriter.addCard(carddata[0], carddata[1])
+	binaryCardStoreWriter.save(binaryCardStoreFilename)
+
+def runQueries(storeType, repeat):
+	"""Runs all the queries on one store, and prints the timing and memory results. Meant to be run in its own process"""
+	searchFunction = searchJsonStore if storeType == 'json' else searchBinaryStore
+	for queryName, query in QUERIES:
+		regexDict, numericQueries = compileQuery(query)
+		resultCount = len(searchFunction(regexDict, numericQueries))
+		#Take the best of a few runs, to reduce noise from other processes
+		bestTime = min(timeit.repeat(lambda: searchFunction(regexDict, numericQueries), number=1, repeat=repeat))
+		print "{}: '{}' query took {:.1f} ms ({:,} results)".format(storeType, queryName, bestTime * 1000, resultCount)
+	#On Linux 'ru_maxrss' is in kilobytes
+	print "{}: peak memory use {:,.1f} MB".format(storeType, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0)
+
+
+if __name__ == '__main__':
+	argparser = argparse.ArgumentParser()
+	argparser.add_argument("--repeat", type=int, default=3, help="How many times to run each query, the fastest time is reported")
+	argparser.add_argument("--storeType", choices=('json', 'binary'), help="Only measure this store type, in this process. Used internally")
+	args = argparser.parse_args()
+
+	#The MtG module looks for its card files in the 'data' folder of the bot
+	GlobalStore.scriptfolder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+	cardFilename = os.path.join(GlobalStore.scriptfolder, 'data', 'MTGcards.json')
+	binaryStoreFilename = MtGCommand.getBinaryCardStoreFilename()
+	if args.storeType:
+		runQueries(args.storeType, args.repeat)
+	else:
+		if not BinaryCardStore.isStoreFile(binaryStoreFilename):
+			print "Creating binary card store '{}'".format(binaryStoreFilename)
+			createBinaryStore(cardFilename, binaryStoreFilename)
+		print "Card file is {:,.1f} MB, binary card store is {:,.1f} MB".format(os.path.getsize(cardFilename) / 1048576.0, os.path.getsize(binaryStoreFilename) / 1048576.0)
+		for storeType in ('json', 'binary'):
+			subprocess.check_call([sys.executable, os.path.abspath(__file__), '--repeat', str(args.repeat), '--storeType', storeType])
@@ -0,0 +1,81 @@
+"""
+Feeds recorded server traffic through the IRC line parser and the message type dispatch, and reports how many lines per second it handles.
+The old way of parsing (splitting on spaces and a 'getattr' per line) is measured too, for comparison.
+Usage: python benchmarks/IrcLineParserBenchmark.py [trafficFile] [--repeat N]
+"""
+
+import argparse, logging, os, sys, timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Constants
+from DideRobot import DideRobot
+
+
+class DummyBot(DideRobot):
+	"""
+	A DideRobot without a connection, whose 'irc_' functions don't do anything, so only parsing and dispatch get measured.
+	Dispatch uses DideRobot's own 'getMessageTypeFunctions' and 'handleLine', so the benchmark measures the code the bot actually runs
+	"""
+	def __init__(self):
+		#Skip DideRobot's initialization, that loads settings and connects to a server
+		self.logger = logging.getLogger('DideRobot')
+		self.serverfolder = 'benchmark'
+
+	def queueLineToSend(self, lineToSend, isHighPriority=None, shouldLogMessage=True): pass
+	def irc_unknown_message_type(self, prefix, messageType, params): pass
+
+def _doNothing(self, prefix, params): pass
+#Replace every message type handler, so the dispatch table has the same entries as DideRobot's
+for _attributeName in dir(DideRobot):
+	if _attributeName.startswith('irc_') and _attributeName != 'irc_unknown_message_type':
+		setattr(DummyBot, _attributeName, _doNothing)
+
+
+def handleLinesOld(bot, lines):
+	"""The way DideRobot used to parse and dispatch lines"""
+	for line in lines:
+		if line.startswith("PING"):
+			continue
+		lineParts = line.split(" ")
+		messageSource = lineParts[0]
+		if messageSource.startswith(":"):
+			messageSource = messageSource[1:]
+		messageType = lineParts[1]
+		messageType = Constants.IRC_NUMERIC_TO_NAME.get(messageType, messageType.upper())
+		messageParts = lineParts[2:]
+		for messagePartIndex, messagePart in enumerate(messageParts):
+			if messagePart.startswith(':'):
+				wordgroup = " ".join(messageParts[messagePartIndex:])[1:]
+				messageParts[messagePartIndex] = wordgroup
+				messageParts = messageParts[:messagePartIndex+1]
+				break
+		messageTypeFunction = getattr(bot, "irc_" + messageType, None)
+		if messageTypeFunction:
+			messageTypeFunction(messageSource, messageParts)
+		else:
+			bot.irc_unknown_message_type(messageSource, messageType, lineParts)
+
+def handleLinesNew(bot, lines):
+	"""The way DideRobot parses and dispatches lines now"""
+	messageTypeFunctions = bot.getMessageTypeFunctions()
+	for line in lines:
+		bot.handleLine(line, messageTypeFunctions)
+
+
+if __name__ == '__main__':
+	argparser = argparse.ArgumentParser()
+	argparser.add_argument("trafficFile", nargs='?', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sampleServerTraffic.txt'),
+						   help="A file with one raw line received from an IRC server per line")
+	argparser.add_argument("--repeat", type=int, default=200, help="How many times to go through all the lines in the traffic file per measurement")
+	args = argparser.parse_args()
+
+	with open(args.trafficFile, 'rb') as trafficFile:
+		trafficLines = [l.rstrip('\r\n') for l in trafficFile if l.strip()]
+	trafficLines *= args.repeat
+	print "Parsing {:,} lines".format(len(trafficLines))
+
+	dummyBot = DummyBot()
+	for name, function in (("old", handleLinesOld), ("new", handleLinesNew)):
+		#Take the best of a few runs, to reduce noise from other processes
+		bestTime = min(timeit.repeat(lambda: function(dummyBot, trafficLines), number=1, repeat=5))
+		print "{}: {:,.0f} lines per second ({:.3f} seconds)".format(name, len(trafficLines) / bestTime, bestTime)
@@ -14,6 +14,7 @@ class Command(CommandTemplate):
 
 	aliases = {}  #Key is either "[server]" or "[server] [channel]", value is a dictionary of "aliasname: aliascommand"
 	aliasNameList = []  #A list of just the alias names, to speed up lookup
+	shouldSeeAllMessages = True  #Alias names aren't in the triggers list, so we need to check every message ourselves
 
 	def onLoad(self):
 		filepath = os.path.join(GlobalStore.scriptfolder, "data", "Aliases.json")
@@ -1,11 +1,14 @@
-import json, os, random, re, time
+import bisect, json, os, random, re, time
 import HTMLParser
 
 import gevent
 import requests
 
 from CommandTemplate import CommandTemplate
+from FuzzyNameIndex import FuzzyNameIndex
 import GlobalStore
+import NumericCardQuery
+from SearchResultCache import SearchResultCache
 import SharedFunctions
 from IrcMessage import IrcMessage
 
@@ -13,11 +16,31 @@ from IrcMessage import IrcMessage
 class Command(CommandTemplate):
 	triggers = ['netrunner', 'net']
 	helptext = "Looks up info on 'Android: Netrunner' cards. Provide a card name or regex to search for, or 'random' for a surprise. "
-	helptext += "Or use the 'search' parameter with key-value attribute pairs for more control over the search."
+	helptext += "Or use the 'search' parameter with key-value attribute pairs for more control over the search. "
+	helptext += "Numeric attributes can be compared too, like 'cost: 3 or more', 'strength: 2-4' or 'strength: >cost'."
 	scheduledFunctionTime = 5.0 * 24.0 * 3600.0  #Every 5 days, because changes don't happen often
 	callInThread = True
 
 	areCardfilesBeingUpdated = False
+	#These attributes can be searched with numeric comparisons instead of regexes
+	numericAttributes = ('advancementcost', 'agendapoints', 'baselink', 'cost', 'influence', 'influencelimit', 'memoryunits', 'minimumdecksize', 'strength', 'trash')
+	indexedAttributes = ('faction', 'type', 'setname')  #For these attributes, the card index keeps track of which cards have which value
+	maxCachedSearches = 100  #How many search results to remember, so popular searches don't have to go through the cards each time
+
+	def onLoad(self):
+		#The cards are loaded when they're first needed, and then kept in memory until the card file gets updated
+		self.cards = None  #A list of all the cards, in the order they're in the card file
+		self.cardNumbersByTitle = {}  #Keys are lowercase card titles, values are lists of the indexes of the cards with that title in the 'cards' list
+		self.sortedCardTitles = []  #A sorted list of (lowercase card title, card number) tuples, to quickly find titles that start with something
+		self.cardNumbersByAttributeValue = {}  #Keys are the 'indexedAttributes', values are dicts with each value of that attribute as key, and a list of card numbers as value
+		self.numericColumns = {}  #Keys are the 'numericAttributes', values are NumericColumn instances with the sorted values of that attribute
+		self.fuzzyTitleIndex = None  #Used to suggest card titles when a title search doesn't find anything
+		self.searchResultCache = SearchResultCache(self.maxCachedSearches)
+		self.cardDataVersion = None  #Read from the version file when it's first needed, and reset after an update. Used to make sure cached search results are from the current cards
+
+	def onUnload(self):
+		self.clearCards()
+		self.searchResultCache.clear()
 
 	def executeScheduledFunction(self):
 		if self.shouldUpdate():
@@ -89,49 +112,55 @@ class Command(CommandTemplate):
 						searchDict[correctTerm] = searchDict[wrongTerm]
 					searchDict.pop(wrongTerm)
 
-		#Turn the search strings into actual regexes
-		regexDict = {}
-		errors = []
-		for attrib, query in searchDict.iteritems():
-			try:
-				#Since the query is a string, and the card data is unicode, convert the query to unicode before turning it into a regex
-				regex = re.compile(unicode(query, encoding='utf8'), re.IGNORECASE)
-			except (re.error, SyntaxError) as e:
-				self.logError("[Netrunner] Regex error when trying to parse '{}': {}".format(query, e))
-				errors.append(attrib)
-			except UnicodeDecodeError as e:
-				self.logError("[Netrunner] Unicode error in key '{}': {}".format(attrib, e))
-				errors.append(attrib)
-			else:
-				regexDict[attrib] = regex
-		#If there were errors parsing the regular expressions, don't continue, to prevent errors further down
-		if len(errors) > 0:
-			#If there was only one search element to begin with, there's no need to specify
-			if len(searchDict) == 1:
-				message.reply("An error occurred when trying to parse your search query. Please check if it is a valid regular expression, and that there are no non-UTF8 characters")
-			#If there were more elements but only one error, specify
-			elif len(errors) == 1:
-				message.reply("An error occurred while trying to parse the query for the '{}' field. Please check if it is a valid regular expression without non-UTF8 characters".format(errors[0]))
-			#Multiple errors, list them all
-			else:
-				message.reply("Errors occurred while parsing attributes: {}. Please check your search query for errors".format(", ".join(errors)))
-			return
-
-		#All entered data is valid, look through the stored cards
-		with open(os.path.join(GlobalStore.scriptfolder, 'data', 'NetrunnerCards.json'), 'r') as jsonfile:
-			cardstore = json.load(jsonfile)
-
-		for index in xrange(0, len(cardstore)):
-			carddata = cardstore.pop(0)
+		#Popular searches are done a lot, so check if we still know the result from last time. Only the matches are stored, so random picks stay random
+		dataVersion = self.getCardDataVersion()
+		searchKey = SearchResultCache.getSearchKey(searchDict)
+		matchingCards = self.searchResultCache.get(dataVersion, searchKey) if dataVersion else None
+		if matchingCards is None:
+			#Numeric comparisons ('cost: 3 or more') aren't regexes, handle those separately. Copy the dict, since the original is needed later
+			regexSearchDict = dict(searchDict)
+			numericQueries = NumericCardQuery.extractNumericQueries(regexSearchDict, self.numericAttributes)
+
+			#Turn the search strings into actual regexes
+			regexDict = {}
+			errors = []
+			for attrib, query in regexSearchDict.iteritems():
+				try:
+					#Since the query is a string, and the card data is unicode, convert the query to unicode before turning it into a regex
+					regex = SharedFunctions.compileUserRegex(unicode(query, encoding='utf8'), re.IGNORECASE)
+				except (re.error, SyntaxError) as e:
+					self.logError("[Netrunner] Regex error when trying to parse '{}': {}".format(query, e))
+					errors.append(attrib)
+				except UnicodeDecodeError as e:
+					self.logError("[Netrunner] Unicode error in key '{}': {}".format(attrib, e))
+					errors.append(attrib)
+				else:
+					regexDict[attrib] = regex
+			#If there were errors parsing the regular expressions, don't continue, to prevent errors further down
+			if len(errors) > 0:
+				#If there was only one search element to begin with, there's no need to specify
+				if len(regexSearchDict) == 1:
+					message.reply("An error occurred when trying to parse your search query. Please check if it is a valid regular expression, and that there are no non-UTF8 characters")
+				#If there were more elements but only one error, specify
+				elif len(errors) == 1:
+					message.reply("An error occurred while trying to parse the query for the '{}' field. Please check if it is a valid regular expression without non-UTF8 characters".format(errors[0]))
+				#Multiple errors, list them all
+				else:
+					message.reply("Errors occurred while parsing attributes: {}. Please check your search query for errors".format(", ".join(errors)))
+				return
 
-			#Then check if the rest of the attributes match
-			for attrib in regexDict:
-				if attrib not in carddata or not regexDict[attrib].search(carddata[attrib]):
-					#If the wanted attribute is either not in the card, or it doesn't match, throw it out
-					break
-			#The else-block of a for-loop is executed when a for-loop isn't broken out of. So if everything matches, we get here
-			else:
-				cardstore.append(carddata)
+			#All entered data is valid, look through the stored cards
+			self.loadCards()
+			#User regexes could be really slow, so make sure the search can't freeze the bot
+			searchSuccess, matchingCards = SharedFunctions.runUserRegexFunction(regexDict.values(), self.searchCards, regexDict, numericQueries)
+			if not searchSuccess:
+				#If the search failed, 'matchingCards' is the error message
+				message.reply(matchingCards)
+				return
+			if dataVersion:
+				self.searchResultCache.store(dataVersion, searchKey, matchingCards)
+		#Copy the list, so changing it doesn't change the stored search result
+		cardstore = list(matchingCards)
 
 		numberOfCardsFound = len(cardstore)
 		#Pick a random card if needed and possible
@@ -141,6 +170,11 @@ class Command(CommandTemplate):
 
 		if numberOfCardsFound == 0:
 			replytext = "Sorry, no card matching your query was found"
+			#If a plain title search didn't find anything, the title was probably misspelled. Suggest some similar titles
+			if searchDict.keys() == ['title'] and not SharedFunctions.containsRegexSyntax(searchDict['title']):
+				closestTitles = self.getFuzzyTitleIndex().getClosestNames(searchDict['title'])
+				if closestTitles:
+					replytext += u". Did you mean: {}?".format(u"; ".join(title for title, similarity in closestTitles))
 		elif numberOfCardsFound == 1:
 			replytext = self.getFormattedCardInfo(cardstore[0], addExtendedInfo)
 		else:
@@ -184,6 +218,126 @@ class Command(CommandTemplate):
 		re.purge()  #Clear the stored regexes, since we don't need them anymore
 		message.reply(replytext)
 
+	def loadCards(self):
+		"""Loads the cards into memory and builds the lookup indexes, if that hasn't happened already"""
+		if self.cards is not None:
+			return
+		starttime = time.time()
+		with open(os.path.join(GlobalStore.scriptfolder, 'data', 'NetrunnerCards.json'), 'r') as jsonfile:
+			cards = json.load(jsonfile)
+		cardNumbersByTitle = {}
+		sortedCardTitles = []
+		cardNumbersByAttributeValue = {attribute: {} for attribute in self.indexedAttributes}
+		for cardNumber, card in enumerate(cards):
+			title = card['title'].lower()
+			if title not in cardNumbersByTitle:
+				cardNumbersByTitle[title] = [cardNumber]
+			else:
+				cardNumbersByTitle[title].append(cardNumber)
+			sortedCardTitles.append((title, cardNumber))
+			for attribute in self.indexedAttributes:
+				if attribute in card:
+					value = card[attribute]
+					if value not in cardNumbersByAttributeValue[attribute]:
+						cardNumbersByAttributeValue[attribute][value] = [cardNumber]
+					else:
+						cardNumbersByAttributeValue[attribute][value].append(cardNumber)
+		self.cardNumbersByTitle = cardNumbersByTitle
+		self.sortedCardTitles = sorted(sortedCardTitles)
+		self.cardNumbersByAttributeValue = cardNumbersByAttributeValue
+		self.numericColumns = {attribute: NumericCardQuery.NumericColumn((card.get(attribute, None), cardNumber) for cardNumber, card in enumerate(cards))
+							   for attribute in self.numericAttributes}
+		self.fuzzyTitleIndex = None
+		self.cards = cards
+		self.logInfo("[Netrunner] Loaded {:,} cards into memory in {:.2f} seconds".format(len(cards), time.time() - starttime))
+
+	def clearCards(self):
+		self.cards = None
+		self.cardNumbersByTitle = {}
+		self.sortedCardTitles = []
+		self.cardNumbersByAttributeValue = {}
+		self.numericColumns = {}
+		self.fuzzyTitleIndex = None
+
+	def getCardNumbersByTitleRegex(self, titleRegex):
+		"""
+		If the title regex is a literal title (or start of a title) anchored with '^', look the title up directly instead of checking every card
+		:return: A set of matching card numbers, or None if the regex isn't something that can be looked up directly
+		"""
+		pattern = titleRegex.pattern.lower()
+		if not pattern.startswith('^'):
+			return None
+		pattern = pattern[1:]
+		isExactTitle = pattern.endswith('$')
+		if isExactTitle:
+			pattern = pattern[:-1]
+		if not pattern or SharedFunctions.containsRegexSyntax(pattern):
+			return None
+		if isExactTitle:
+			return set(self.cardNumbersByTitle.get(pattern, ()))
+		cardNumbers = set()
+		for title, cardNumber in self.sortedCardTitles[bisect.bisect_left(self.sortedCardTitles, (pattern,)):]:
+			if not title.startswith(pattern):
+				break
+			cardNumbers.add(cardNumber)
+		return cardNumbers
+
+	def searchCards(self, regexDict, numericQueries=()):
+		"""
+		Finds the cards that match all the regexes and numeric queries. The indexes are used to only check cards that could match
+		:return: A list of the matching cards, in the same order as they're in the card file
+		"""
+		#First narrow down which cards could match, by checking each value of the indexed attributes once instead of checking every card
+		candidateCardNumbers = None
+		for attribute, regex in regexDict.iteritems():
+			if attribute == 'title':
+				matchingCardNumbers = self.getCardNumbersByTitleRegex(regex)
+				if matchingCardNumbers is None:
+					continue
+			elif attribute in self.cardNumbersByAttributeValue:
+				matchingCardNumbers = set()
+				for value, cardNumbers in self.cardNumbersByAttributeValue[attribute].iteritems():
+					if regex.search(value):
+						matchingCardNumbers.update(cardNumbers)
+			else:
+				continue
+			candidateCardNumbers = matchingCardNumbers if candidateCardNumbers is None else candidateCardNumbers & matchingCardNumbers
+			if not candidateCardNumbers:
+				return []
+		for numericQuery in numericQueries:
+			matchingCardNumbers = numericQuery.getMatchingRows(self.numericColumns[numericQuery.attribute])
+			if matchingCardNumbers is None:
+				continue
+			candidateCardNumbers = matchingCardNumbers if candidateCardNumbers is None else candidateCardNumbers & matchingCardNumbers
+			if not candidateCardNumbers:
+				return []
+		if candidateCardNumbers is None:
+			candidateCardNumbers = xrange(0, len(self.cards))
+		else:
+			candidateCardNumbers = sorted(candidateCardNumbers)
+
+		#Then check the candidates properly
+		matchingCards = []
+		for cardNumber in candidateCardNumbers:
+			carddata = self.cards[cardNumber]
+			if numericQueries and not all(numericQuery.matches(carddata.get) for numericQuery in numericQueries):
+				continue
+			for attrib in regexDict:
+				if attrib not in carddata or not regexDict[attrib].search(carddata[attrib]):
+					#If the wanted attribute is either not in the card, or it doesn't match, throw it out
+					break
+			#The else-block of a for-loop is executed when a for-loop isn't broken out of. So if everything matches, we get here
+			else:
+				matchingCards.append(carddata)
+		return matchingCards
+
+	def getFuzzyTitleIndex(self):
+		"""Returns the fuzzy index of all card titles, building it if needed"""
+		self.loadCards()
+		if self.fuzzyTitleIndex is None:
+			self.fuzzyTitleIndex = FuzzyNameIndex(card['title'] for card in self.cards)
+		return self.fuzzyTitleIndex
+
 	@staticmethod
 	def getFormattedCardInfo(card, addExtendedInfo=False):
 		cardInfoList = [u'\x02' + card['title'] + u'\x0f']  #Make title bold
@@ -268,6 +422,16 @@ class Command(CommandTemplate):
 		replytext = replytext.rstrip(separator).rstrip().encode('utf-8')
 		return replytext
 
+	def getCardDataVersion(self):
+		"""Returns a string that's different for each version of the card file, or None if there's no version file"""
+		if self.cardDataVersion is None:
+			versionfilename = os.path.join(GlobalStore.scriptfolder, 'data', 'NetrunnerCardsVersion.json')
+			if not os.path.isfile(versionfilename):
+				return None
+			with open(versionfilename) as versionfile:
+				self.cardDataVersion = unicode(json.load(versionfile).get('lastUpdateTime', None))
+		return self.cardDataVersion
+
 	def shouldUpdate(self):
 		# If we don't absolutely HAVE to update, check if our last update isn't too soon, to prevent work and traffic
 		versionfilename = os.path.join(GlobalStore.scriptfolder, 'data', 'NetrunnerCardsVersion.json')
@@ -353,6 +517,13 @@ class Command(CommandTemplate):
 		with open(os.path.join(GlobalStore.scriptfolder, 'data', 'NetrunnerCardsVersion.json'), 'w') as versionfile:
 			versionfile.write(json.dumps({'lastUpdateTime': time.time()}))
 
+		#Swap in the new cards, so they don't have to be loaded during the first search. Stored search results are from the old cards, so clear those
+		self.clearCards()
+		self.loadCards()
+		self.logInfo("[Netrunner] Clearing search result cache. " + self.searchResultCache.getStats())
+		self.searchResultCache.clear()
+		self.cardDataVersion = None
+
 		#Done! Free the file read, log the update, and report our success
 		self.areCardfilesBeingUpdated = False
 		self.logInfo("[NetRunner] Updating cards took {} seconds".format(time.time() - starttime))
@@ -12,6 +12,7 @@ class CommandTemplate(object):
 	callInThread = False
 	showInCommandList = True
 	stopAfterThisCommand = False  #Some modules might affect the command list, which leads to errors. If this is set to true and the command fires, no further commands are executed
+	shouldSeeAllMessages = False  #Normally 'shouldExecute' is only called for messages with a matching trigger and type. Set this to True if a module overrides 'shouldExecute' to check something else
 
 	scheduledFunctionTime = None  #Float, in seconds. Or None if you don't want a scheduled function
 	scheduledFunctionGreenlet = None  #The greenlet that manages the scheduled function, or None if there isn't one
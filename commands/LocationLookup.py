@@ -48,13 +48,14 @@ class Command(CommandTemplate):
 						channelname = '#' + channelname
 				if channelname not in message.bot.channelsUserList:
 					replytext = u"I'm not familiar with the channel '{}', sorry".format(channelname)
+				elif not message.bot.channelMembership.isUserInChannel(channelname, message.messageParts[0]):
+					replytext = u"I'm sorry, but I don't know who you're talking about..."
 				else:
-					nickToMatch = message.messageParts[0].lower() + '!'  #Add an exclamation mark to make sure the match is the full nick, not just the start
-					replytext = u"I'm sorry, but I don't know who you're talking about..."  #Set it in advance, in case we don't find a match
-					for channelUserAddress in message.bot.channelsUserList[channelname]:
-						if channelUserAddress.lower().startswith(nickToMatch):
-							userAddress = channelUserAddress
-							break
+					userAddress = message.bot.channelMembership.getUserAddress(message.messageParts[0])
+					#If we don't know the user's host, there's nothing to look up
+					if u'@' not in userAddress:
+						userAddress = u""
+						replytext = u"I'm sorry, I don't know where that user is connecting from"
 
 		if userAddress != u"":
 			username = userAddress.split("!", 1)[0]
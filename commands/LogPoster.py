@@ -54,6 +54,8 @@ class Command(CommandTemplate):
 			if date:
 				logfilename = "{}-{}.log".format(message.source, date.strftime("%Y-%m-%d"))
 				logfilename = os.path.join(GlobalStore.scriptfolder, "serverSettings", message.bot.serverfolder, "logs", logfilename)
+				#Logged lines are written to disk in batches, make sure the log file is up to date
+				message.bot.messageLogger.flushLogs()
 				#check if we've got a log for this channel and day
 				if not os.path.exists(logfilename):
 					replytext = u"Sorry, no log for that day was found"
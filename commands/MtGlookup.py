@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-import gc, json, os, random, re, time, zipfile
+import bisect, gc, json, multiprocessing, os, random, re, shutil, time, zipfile
 import traceback
 
 import requests
@@ -8,26 +8,79 @@ from bs4 import BeautifulSoup
 import gevent
 
 from CommandTemplate import CommandTemplate
+from BinaryCardStore import BinaryCardStore, BinaryCardStoreWriter
 import Constants
+from FuzzyNameIndex import FuzzyNameIndex
 import GlobalStore
+import NumericCardQuery
+from SearchResultCache import SearchResultCache
 import SharedFunctions
 from IrcMessage import IrcMessage
 
 
+def parseSetFilesIntoCache(cardDatasetFilename, setfilenamesAndCacheKeys):
+	"""
+	Parses the provided set files from the card dataset, and stores the result of each set in the set cache, with the cache key on the first line.
+	This isn't part of the Command class so it can be run in a separate process
+	"""
+	with zipfile.ZipFile(cardDatasetFilename, 'r') as setfilesZip:
+		for setfilename, cacheKey in setfilenamesAndCacheKeys:
+			parsedSet = Command.parseSetFile(setfilesZip.read(setfilename))
+			#Write to a temporary file first and only then move it into place, so a process that gets stopped halfway doesn't leave a cache file with a valid key but incomplete data
+			cacheFilename = Command.getSetCacheFilename(setfilename)
+			temporaryCacheFilename = cacheFilename + '.tmp'
+			with open(temporaryCacheFilename, 'w') as cacheFile:
+				cacheFile.write(json.dumps(cacheKey))
+				cacheFile.write('\n')
+				cacheFile.write(json.dumps(parsedSet))
+			#On Windows a file can't be renamed to the name of an existing file
+			if os.name == 'nt' and os.path.exists(cacheFilename):
+				os.remove(cacheFilename)
+			os.rename(temporaryCacheFilename, cacheFilename)
+
+
 class Command(CommandTemplate):
 	triggers = ['mtg', 'mtgf', 'mtgb', 'magic']
 	helptext = "Looks up info on Magic: The Gathering cards. Provide a card name or regex to search for, or 'random' for a surprise. "
 	helptext += "Use 'search' with key-value attribute pairs for more control, see http://mtgjson.com/documentation.html#cards for available attributes. "
+	helptext += "Numeric attributes can be compared too, like 'cmc: 5 or more', 'power: 2-4' or 'power: >toughness'. "
 	helptext += "{commandPrefix}mtgf adds the flavor text and sets to the output. '{commandPrefix}mtgb [setname]' opens a boosterpack"
 	scheduledFunctionTime = 172800.0  #Every other day, since it doesn't update too often
 	callInThread = True  #If a call causes a card update, make sure that doesn't block the whole bot
 
 	areCardfilesInUse = False
-	dataFormatVersion = '4.3'
+	dataFormatVersion = '4.5'
+
+	keepCardIndexInMemory = True  #If True, all cards are kept in memory with some lookup indexes, which makes searching a lot faster but uses more memory
+	indexedAttributes = ('set', 'rarity', 'type', 'colors', 'cmc')  #For these attributes, the index keeps track of which cards have which value
+	setSpecificAttributes = ('artist', 'flavor', 'multiverseid', 'number', 'rarity', 'watermark')  #These attributes are stored per set, instead of per card
+	numericAttributes = ('cmc', 'power', 'toughness', 'loyalty')  #These attributes can be searched with numeric comparisons instead of regexes
+	maxCachedSearches = 200  #How many search results to remember, so popular searches don't have to go through all the cards each time
 
 	def onLoad(self):
+		#The card index is loaded when it's first needed, so loading this module doesn't take long
+		self.cards = None  #A list of all the card data, in the same order as in the card file, so the index of a card is the same as its line number
+		self.cardNumbersByName = {}  #Keys are lowercase card names, values are the number of that card in the 'cards' list
+		self.sortedCardNames = []  #A sorted list of (lowercase card name, card number) tuples, to quickly find names that start with something
+		self.cardNumbersByAttributeValue = {}  #Keys are the 'indexedAttributes', values are dicts with each value of that attribute as key, and a list of card numbers as value
+		self.numericColumns = {}  #Keys are the 'numericAttributes', values are NumericColumn instances with the sorted values of that attribute
+		#Used to suggest card names when a name search doesn't find anything. Rebuilt when the card file changes
+		self.fuzzyNameIndex = None
+		self.fuzzyNameIndexFileTime = None
+		#The definitions are also loaded when they're first needed
+		self.definitions = None  #Keys are the terms, values are their definitions
+		self.definitionTerms = []  #All the terms, in the order they're in the definitions file
+		self.definitionTermsByWord = {}  #An index of the definition texts: keys are the words used in them, values are sets of the terms whose definition contains that word
+		self.sortedDefinitionWords = []  #The words in 'definitionTermsByWord', sorted, so the words that start with a search word can be found quickly
+		self.searchResultCache = SearchResultCache(self.maxCachedSearches)
+		self.cardDataVersion = None  #Read from the version file when it's first needed, and reset after an update. Used to make sure cached search results are from the current cards
 		GlobalStore.commandhandler.addCommandFunction(__file__, 'searchMagicTheGatheringCards', self.searchCards)
 
+	def onUnload(self):
+		self.clearCardIndex()
+		self.clearDefinitions()
+		self.searchResultCache.clear()
+
 	def executeScheduledFunction(self):
 		if not self.areCardfilesInUse and self.shouldUpdate():
 			self.updateCardFile()
@@ -41,8 +94,8 @@ class Command(CommandTemplate):
 			message.reply("This command " + self.helptext[0].lower() + self.helptext[1:].format(commandPrefix=message.bot.commandPrefix))
 			return
 
-		#If the card set is currently being updated, we probably shouldn't try loading it
-		if self.areCardfilesInUse:
+		#Updates replace the card files only when they're done, so lookups can continue during an update. Unless there aren't any card files yet
+		if self.areCardfilesInUse and not self.doNeededFilesExist():
 			message.reply("I'm currently updating my card datastore, sorry! If you try again in, oh, 10 seconds, I should be done. You'll be the first to look through the new cards!")
 			return
 
@@ -59,6 +112,8 @@ class Command(CommandTemplate):
 		if searchType == 'update' or searchType == 'forceupdate':
 			if not message.bot.isUserAdmin(message.user, message.userNickname, message.userAddress):
 				replytext = "Sorry, only admins can use my update function"
+			elif self.areCardfilesInUse:
+				replytext = "I'm already updating my card data, give me a bit"
 			elif not searchType == 'forceupdate' and not self.shouldUpdate():
 				replytext = "I've already got all the latest card data, no update is needed"
 			else:
@@ -104,8 +159,14 @@ class Command(CommandTemplate):
 		#Special case to prevent it having to load in all the cards before picking one
 		if searchType == 'random' and not searchString:
 			#Just pick a random card from all available ones
-			card = json.loads(SharedFunctions.getRandomLineFromFile(os.path.join(GlobalStore.scriptfolder, 'data', 'MTGcards.json')))
-			cardname, carddata = card.popitem()
+			if self.keepCardIndexInMemory and self.loadCardIndex():
+				carddata = random.choice(self.cards)
+			elif BinaryCardStore.isStoreFile(self.getBinaryCardStoreFilename()):
+				with BinaryCardStore(self.getBinaryCardStoreFilename()) as binaryCardStore:
+					carddata = binaryCardStore.getCard(random.randrange(binaryCardStore.cardCount))
+			else:
+				card = json.loads(SharedFunctions.getRandomLineFromFile(os.path.join(GlobalStore.scriptfolder, 'data', 'MTGcards.json')))
+				cardname, carddata = card.popitem()
 			return self.getFormattedCardInfo(carddata, extendedInfo)
 
 		#Make sure the search string is an actual string, and not None or something
@@ -117,15 +178,38 @@ class Command(CommandTemplate):
 		if not parseSuccess:
 			#If an error occurred, the second returned parameter isn't the searchdict but an error message
 			return searchDict
-		#Check if the entered search terms can be converted to the regex we need
-		parseSuccess, regexDict = self.searchDictToRegexDict(searchDict)
-		if not parseSuccess:
-			#Again, 'regexDict' is the error string if an error occurred
-			return regexDict
-		matchingCards = self.searchCardStore(regexDict)
-		#Clear the stored regexes, since we don't need them anymore
-		del regexDict
-		re.purge()
+		#Popular searches are done a lot, so check if we still know the result from last time. Only the matches are stored, so random picks stay random
+		dataVersion = self.getCardDataVersion()
+		searchKey = SearchResultCache.getSearchKey(searchDict)
+		matchingCards = self.searchResultCache.get(dataVersion, searchKey) if dataVersion else None
+		if matchingCards is None:
+			#Numeric comparisons ('cmc: 5 or more') aren't regexes, handle those separately. Copy the dict, since the original is needed later
+			regexSearchDict = dict(searchDict)
+			numericQueries = NumericCardQuery.extractNumericQueries(regexSearchDict, self.numericAttributes)
+			#Check if the entered search terms can be converted to the regex we need
+			parseSuccess, regexDict = self.searchDictToRegexDict(regexSearchDict)
+			if not parseSuccess:
+				#Again, 'regexDict' is the error string if an error occurred
+				return regexDict
+			if self.keepCardIndexInMemory and self.loadCardIndex():
+				searchFunction = self.searchCardIndex
+			elif BinaryCardStore.isStoreFile(self.getBinaryCardStoreFilename()):
+				searchFunction = self.searchBinaryCardStore
+			else:
+				searchFunction = self.searchCardStore
+			#User regexes could be really slow, so make sure the search can't freeze the bot
+			searchSuccess, matchingCards = SharedFunctions.runUserRegexFunction(regexDict.values(), searchFunction, regexDict, numericQueries)
+			#Clear the stored regexes, since we don't need them anymore
+			del regexDict
+			re.purge()
+			if not searchSuccess:
+				#If the search failed, 'matchingCards' is the error message
+				return matchingCards
+			if dataVersion:
+				self.searchResultCache.store(dataVersion, searchKey, matchingCards)
+		#If a plain name search didn't find anything, the name was probably misspelled. Suggest some similar names
+		if not matchingCards and not searchType.startswith('random') and searchDict.keys() == ['name'] and not SharedFunctions.containsRegexSyntax(searchDict['name']):
+			return self.getCardNameSuggestions(searchDict['name'])
 		#Done, show the formatted result
 		return self.formatSearchResult(matchingCards, extendedInfo, searchType.startswith('random'), resultListLength, searchDict.get('name', None), len(searchDict) > 0)
 
@@ -172,7 +256,7 @@ class Command(CommandTemplate):
 			if not isinstance(query, unicode):
 				query = unicode(query, encoding='utf8', errors='replace')
 			try:
-				regex = re.compile(query, re.IGNORECASE)
+				regex = SharedFunctions.compileUserRegex(query, re.IGNORECASE)
 			except (re.error, SyntaxError):
 				#Try parsing the string again as an escaped string, so mismatched brackets for instance aren't a problem
 				try:
@@ -202,7 +286,7 @@ class Command(CommandTemplate):
 		return (True, regexDict)
 
 	@staticmethod
-	def searchCardStore(regexDict):
+	def searchCardStore(regexDict, numericQueries=()):
 		#Get the 'setname' search separately, so we can iterate over the rest later
 		setRegex = regexDict.pop('set', None)
 		setKeys = ('artist', 'flavor', 'multiverseid', 'number', 'rarity', 'watermark')
@@ -214,6 +298,10 @@ class Command(CommandTemplate):
 			for cardlineNumber, cardline in enumerate(jsonfile):
 				cardname, carddata = json.loads(cardline).popitem()
 
+				#Numeric comparisons only use gamewide card data, so those are quick to check first
+				if numericQueries and not all(numericQuery.matches(carddata[0].get) for numericQuery in numericQueries):
+					continue
+
 				#Store how much sets we started with, so we know at the end if any sets got removed
 				setCountAtStart = len(carddata[1])
 
@@ -251,6 +339,225 @@ class Command(CommandTemplate):
 					matchingCards[carddata[0]['name']] = (cardlineNumber, setNameMatches)
 		return matchingCards
 
+	@staticmethod
+	def getBinaryCardStoreFilename():
+		return os.path.join(GlobalStore.scriptfolder, 'data', 'MTGcards.bin')
+
+	@staticmethod
+	def searchBinaryCardStore(regexDict, numericQueries=()):
+		"""Does the same as 'searchCardStore', but using the binary card store, so only the fields that are searched on get read"""
+		setRegex = regexDict.get('set', None)
+		setKeys = ('artist', 'flavor', 'multiverseid', 'number', 'rarity', 'watermark')
+		attributeRegexes = [(attribute, regex) for attribute, regex in regexDict.iteritems() if attribute != 'set']
+
+		matchingCards = {}
+		with BinaryCardStore(Command.getBinaryCardStoreFilename()) as binaryCardStore:
+			for cardNumber in xrange(binaryCardStore.cardCount):
+				if numericQueries and not all(numericQuery.matches(lambda attribute: binaryCardStore.getCardField(cardNumber, attribute)) for numericQuery in numericQueries):
+					continue
+				setRows = binaryCardStore.getSetRows(cardNumber)
+				matchingSetRows = setRows
+				if setRegex:
+					matchingSetRows = [setRow for setRow in setRows if setRegex.search(binaryCardStore.getSetField(setRow, '_setname'))]
+					if not matchingSetRows:
+						continue
+				for attribute, regex in attributeRegexes:
+					#Some data is stored in the card data, some in the set data, because it differs per set (rarity etc)
+					if attribute in setKeys:
+						matchingSetRows = [setRow for setRow in matchingSetRows if regex.search(binaryCardStore.getSetField(setRow, attribute) or u"")]
+						if not matchingSetRows:
+							break
+					else:
+						value = binaryCardStore.getCardField(cardNumber, attribute)
+						if value is None or not regex.search(value):
+							break
+				else:
+					#The card matched all search criteria. If all sets matched, don't store that, otherwise store which sets matched
+					setNameMatches = None if len(matchingSetRows) == len(setRows) else [binaryCardStore.getSetField(setRow, '_setname') for setRow in matchingSetRows]
+					matchingCards[binaryCardStore.getCardField(cardNumber, 'name')] = (cardNumber, setNameMatches)
+		return matchingCards
+
+	def loadCardIndex(self):
+		"""
+		Loads all the cards from the card file into memory, and builds the lookup indexes, if that hasn't happened already
+		:return: True if the card index is available, False if it couldn't be loaded
+		"""
+		if self.cards is not None:
+			return True
+		cardStoreFilename = os.path.join(GlobalStore.scriptfolder, 'data', 'MTGcards.json')
+		if not os.path.isfile(cardStoreFilename):
+			return False
+		starttime = time.time()
+		memoryUsageAtStart = SharedFunctions.getMemoryUsage()
+		cards = []
+		cardNumbersByName = {}
+		cardNumbersByAttributeValue = {attribute: {} for attribute in self.indexedAttributes}
+		with open(cardStoreFilename, 'r') as jsonfile:
+			for cardNumber, cardline in enumerate(jsonfile):
+				carddata = json.loads(cardline).values()[0]
+				cards.append(carddata)
+				cardNumbersByName[carddata[0]['name'].lower()] = cardNumber
+				#Store which cards have which attribute values, so searches on those attributes only have to check each value once instead of each card
+				valuesByAttribute = {'set': carddata[1].keys(), 'rarity': set(setdata['rarity'] for setdata in carddata[1].itervalues() if 'rarity' in setdata)}
+				for attribute in ('type', 'colors', 'cmc'):
+					if attribute in carddata[0]:
+						valuesByAttribute[attribute] = (carddata[0][attribute],)
+				for attribute, values in valuesByAttribute.iteritems():
+					for value in values:
+						if value not in cardNumbersByAttributeValue[attribute]:
+							cardNumbersByAttributeValue[attribute][value] = [cardNumber]
+						else:
+							cardNumbersByAttributeValue[attribute][value].append(cardNumber)
+		self.cardNumbersByName = cardNumbersByName
+		self.sortedCardNames = sorted(cardNumbersByName.iteritems())
+		self.cardNumbersByAttributeValue = cardNumbersByAttributeValue
+		self.numericColumns = {attribute: NumericCardQuery.NumericColumn((carddata[0].get(attribute, None), cardNumber) for cardNumber, carddata in enumerate(cards))
+							   for attribute in self.numericAttributes}
+		self.cards = cards
+		memoryUsageAtEnd = SharedFunctions.getMemoryUsage()
+		if memoryUsageAtStart is not None and memoryUsageAtEnd is not None:
+			memoryUsageText = "{:,.1f} MB".format((memoryUsageAtEnd - memoryUsageAtStart) / 1048576.0)
+		else:
+			memoryUsageText = "an unknown amount of memory"
+		self.logInfo("[MtG] Loaded {:,} cards into memory in {:.2f} seconds, using {}".format(len(cards), time.time() - starttime, memoryUsageText))
+		return True
+
+	def clearCardIndex(self):
+		self.cards = None
+		self.cardNumbersByName = {}
+		self.sortedCardNames = []
+		self.cardNumbersByAttributeValue = {}
+		self.numericColumns = {}
+
+	def getCardNumbersByNamePrefix(self, namePrefix):
+		"""Returns a list of the numbers of all cards whose lowercase name starts with the provided (lowercase) prefix"""
+		cardNumbers = []
+		for cardname, cardNumber in self.sortedCardNames[bisect.bisect_left(self.sortedCardNames, (namePrefix,)):]:
+			if not cardname.startswith(namePrefix):
+				break
+			cardNumbers.append(cardNumber)
+		return cardNumbers
+
+	def getCardNumbersByNameRegex(self, nameRegex):
+		"""
+		If the name regex is a literal name (or start of a name) anchored with '^', look the name up directly instead of checking every card
+		:return: A set of matching card numbers, or None if the regex isn't something that can be looked up directly
+		"""
+		pattern = nameRegex.pattern.lower()
+		if not pattern.startswith('^'):
+			return None
+		pattern = pattern[1:]
+		isExactName = pattern.endswith('$') and not pattern.endswith('\\$')
+		if isExactName:
+			pattern = pattern[:-1]
+		if not pattern or SharedFunctions.containsRegexSyntax(pattern):
+			return None
+		if isExactName:
+			return set((self.cardNumbersByName[pattern],)) if pattern in self.cardNumbersByName else set()
+		return set(self.getCardNumbersByNamePrefix(pattern))
+
+	def searchCardIndex(self, regexDict, numericQueries=()):
+		"""Does the same as 'searchCardStore', but using the card index in memory. The indexes are used to only check cards that could match"""
+		#First narrow down which cards could match, by checking each value of the indexed attributes once instead of checking every card
+		candidateCardNumbers = None
+		for attribute, regex in regexDict.iteritems():
+			if attribute == 'name':
+				matchingCardNumbers = self.getCardNumbersByNameRegex(regex)
+				if matchingCardNumbers is None:
+					continue
+			elif attribute in self.cardNumbersByAttributeValue:
+				matchingCardNumbers = set()
+				for value, cardNumbers in self.cardNumbersByAttributeValue[attribute].iteritems():
+					if regex.search(value):
+						matchingCardNumbers.update(cardNumbers)
+			else:
+				continue
+			if candidateCardNumbers is None:
+				candidateCardNumbers = matchingCardNumbers
+			else:
+				candidateCardNumbers &= matchingCardNumbers
+			if not candidateCardNumbers:
+				return {}
+		#Numeric ranges can be looked up in the sorted numeric columns
+		for numericQuery in numericQueries:
+			matchingCardNumbers = numericQuery.getMatchingRows(self.numericColumns[numericQuery.attribute])
+			if matchingCardNumbers is None:
+				continue
+			if candidateCardNumbers is None:
+				candidateCardNumbers = matchingCardNumbers
+			else:
+				candidateCardNumbers &= matchingCardNumbers
+			if not candidateCardNumbers:
+				return {}
+		if candidateCardNumbers is None:
+			candidateCardNumbers = xrange(0, len(self.cards))
+		else:
+			candidateCardNumbers = sorted(candidateCardNumbers)
+
+		#Then check the candidates properly, since set-specific attributes need to match in the same set
+		setRegex = regexDict.get('set', None)
+		attributeRegexes = [(attribute, regex) for attribute, regex in regexDict.iteritems() if attribute != 'set']
+		# A dict with cardname as key, and a tuple as value
+		#  First item in the tuple is the number of the card, second item is a list of the matching setnames (or None if all sets matched)
+		matchingCards = {}
+		for cardNumber in candidateCardNumbers:
+			carddata = self.cards[cardNumber]
+			#Comparisons between attributes ('power: >toughness') couldn't be narrowed down by the index, so check all numeric queries here
+			if numericQueries and not all(numericQuery.matches(carddata[0].get) for numericQuery in numericQueries):
+				continue
+			sets = carddata[1]
+			matchingSetnames = None  #'None' means all sets match
+			if setRegex:
+				matchingSetnames = [setname for setname in sets if setRegex.search(setname)]
+				if not matchingSetnames:
+					continue
+			for attribute, regex in attributeRegexes:
+				#Some data is stored in the card data, some in the set data, because it differs per set (rarity etc)
+				if attribute in self.setSpecificAttributes:
+					matchingSetnames = [setname for setname in (sets.iterkeys() if matchingSetnames is None else matchingSetnames)
+										if attribute in sets[setname] and regex.search(sets[setname][attribute])]
+					if not matchingSetnames:
+						break
+				elif attribute not in carddata[0] or not regex.search(carddata[0][attribute]):
+					break
+			else:
+				#The card matched all search criteria. If all sets matched, don't store that, otherwise store which sets matched
+				if matchingSetnames is not None and len(matchingSetnames) == len(sets):
+					matchingSetnames = None
+				matchingCards[carddata[0]['name']] = (cardNumber, matchingSetnames)
+		return matchingCards
+
+	def getFuzzyNameIndex(self):
+		"""Returns the fuzzy index of all card names, (re)building it if the card file changed since it was last built"""
+		cardStoreFilename = os.path.join(GlobalStore.scriptfolder, 'data', 'MTGcards.json')
+		cardFileTime = os.path.getmtime(cardStoreFilename)
+		if self.fuzzyNameIndex is None or cardFileTime != self.fuzzyNameIndexFileTime:
+			starttime = time.time()
+			if self.keepCardIndexInMemory and self.loadCardIndex():
+				cardnames = [carddata[0]['name'] for carddata in self.cards]
+			else:
+				with open(cardStoreFilename, 'r') as jsonfile:
+					cardnames = [json.loads(cardline).values()[0][0]['name'] for cardline in jsonfile]
+			self.fuzzyNameIndex = FuzzyNameIndex(cardnames)
+			self.fuzzyNameIndexFileTime = cardFileTime
+			self.logInfo("[MtG] Built fuzzy name index of {:,} card names in {:.2f} seconds".format(len(self.fuzzyNameIndex), time.time() - starttime))
+		return self.fuzzyNameIndex
+
+	def getCardNameSuggestions(self, cardname):
+		closestNames = self.getFuzzyNameIndex().getClosestNames(cardname)
+		if not closestNames:
+			return "Sorry, no card matching your query was found"
+		return u"Sorry, no card matching your query was found. Did you mean: {}?".format(u"; ".join(name for name, similarity in closestNames))
+
+	def getCardData(self, cardNumber):
+		"""Returns the data of the card with the provided number (which is also its line number in the card file)"""
+		if self.keepCardIndexInMemory and self.loadCardIndex():
+			return self.cards[cardNumber]
+		if BinaryCardStore.isStoreFile(self.getBinaryCardStoreFilename()):
+			with BinaryCardStore(self.getBinaryCardStoreFilename()) as binaryCardStore:
+				return binaryCardStore.getCard(cardNumber)
+		return json.loads(SharedFunctions.getLineFromFile(os.path.join("data", "MTGcards.json"), cardNumber)).values()[0]
+
 	def formatSearchResult(self, cardstore, addExtendedCardInfo, pickRandomCard, maxCardsToList=10, nameToMatch=None, addResultCount=True):
 		numberOfCardsFound = len(cardstore)
 
@@ -276,7 +583,7 @@ class Command(CommandTemplate):
 		if len(cardstore) == 1:
 			#Retrieve the full info on the card we found
 			linenumber, setname = cardstore.values()[0]
-			cardname, carddata = json.loads(SharedFunctions.getLineFromFile(os.path.join("data", "MTGcards.json"), linenumber)).popitem()
+			carddata = self.getCardData(linenumber)
 			replytext = self.getFormattedCardInfo(carddata, addExtendedCardInfo, setname)
 			#We may have culled the cardstore list, so there may have been more matches initially. List a count of those
 			if addResultCount and numberOfCardsFound > 1:
@@ -417,43 +724,106 @@ class Command(CommandTemplate):
 		replytext = replytext.rstrip(Constants.GREY_SEPARATOR).rstrip().encode('utf-8')
 		return replytext
 
-	@staticmethod
-	def getDefinition(message, addExtendedInfo=False):
+	def loadDefinitions(self):
+		"""
+		Loads the definitions file into memory, and builds an index of the words in the definitions, if that hasn't happened already
+		:return: True if the definitions are available, False if the definitions file doesn't exist
+		"""
+		if self.definitions is not None:
+			return True
 		definitionsFilename = os.path.join(GlobalStore.scriptfolder, 'data', 'MTGdefinitions.json')
+		if not os.path.isfile(definitionsFilename):
+			return False
+		definitions = {}
+		definitionTerms = []
+		definitionTermsByWord = {}
+		with open(definitionsFilename, 'r') as definitionsFile:
+			for line in definitionsFile:
+				term, definition = json.loads(line).popitem()
+				if term not in definitions:
+					definitionTerms.append(term)
+				definitions[term] = definition
+				for word in set(re.findall(r"\w+", definition, re.UNICODE)):
+					if word not in definitionTermsByWord:
+						definitionTermsByWord[word] = set((term,))
+					else:
+						definitionTermsByWord[word].add(term)
+		self.definitionTerms = definitionTerms
+		self.definitionTermsByWord = definitionTermsByWord
+		self.sortedDefinitionWords = sorted(definitionTermsByWord)
+		self.definitions = definitions
+		self.logInfo("[MtG] Loaded {:,} definitions into memory, with {:,} indexed words".format(len(definitions), len(definitionTermsByWord)))
+		return True
+
+	def clearDefinitions(self):
+		self.definitions = None
+		self.definitionTerms = []
+		self.definitionTermsByWord = {}
+		self.sortedDefinitionWords = []
+
+	def getDefinitionTerms(self, searchterm, searchRegex):
+		"""Returns a list of the terms that match the search regex. If there aren't any, returns the terms whose definition matches the search regex"""
+		if not SharedFunctions.containsRegexSyntax(searchterm):
+			#Checking whether a term contains the search text is a lot faster than running a regex, and gives the same result
+			possibleDefinitions = [term for term in self.definitionTerms if searchterm in term]
+		else:
+			possibleDefinitions = [term for term in self.definitionTerms if searchRegex.search(term)]
+		if len(possibleDefinitions) == 0:
+			#If nothing was found, search again, but this time check the definitions themselves
+			possibleDefinitions = self.getDefinitionTermsByText(searchterm, searchRegex)
+		return possibleDefinitions
+
+	def getDefinitionTermsByText(self, searchterm, searchRegex):
+		"""Returns a list of the terms whose definition matches the search regex"""
+		if SharedFunctions.containsRegexSyntax(searchterm):
+			termsToCheck = self.definitionTerms
+		else:
+			#Use the word index to only check the definitions that have all the words in the search text. The last word could be the start of a longer word,
+			# so for that one use all the words that start with it. Words are matched from their start, so a search starting halfway through a word won't find anything
+			termsToCheck = None
+			searchWords = re.findall(r"\w+", searchterm, re.UNICODE)
+			for searchWordIndex, searchWord in enumerate(searchWords):
+				if searchWordIndex < len(searchWords) - 1:
+					termsWithWord = self.definitionTermsByWord.get(searchWord, set())
+				else:
+					termsWithWord = set()
+					wordIndex = bisect.bisect_left(self.sortedDefinitionWords, searchWord)
+					while wordIndex < len(self.sortedDefinitionWords) and self.sortedDefinitionWords[wordIndex].startswith(searchWord):
+						termsWithWord.update(self.definitionTermsByWord[self.sortedDefinitionWords[wordIndex]])
+						wordIndex += 1
+				termsToCheck = termsWithWord if termsToCheck is None else termsToCheck & termsWithWord
+				if not termsToCheck:
+					return []
+			if termsToCheck is None:
+				termsToCheck = self.definitionTerms
+		return [term for term in termsToCheck if searchRegex.search(self.definitions[term])]
+
+	def getDefinition(self, message, addExtendedInfo=False):
+		if not self.loadDefinitions():
+			return "I don't have any definitions stored. Try updating my card data"
 
 		maxMessageLength = 300
-		possibleDefinitions = {}  #Keys are the matching terms found, values are the line they're found at for easy lookup
+		possibleDefinitions = []  #The matching terms found
 
 		searchterm = " ".join(message.messageParts[1:]).lower()
 		if searchterm == 'random':
-			randomLineNumber = random.randrange(0, SharedFunctions.getLineCount(definitionsFilename))
-			term = json.loads(SharedFunctions.getLineFromFile(definitionsFilename, randomLineNumber)).keys()[0]
-			possibleDefinitions = {term: randomLineNumber}
+			possibleDefinitions = [random.choice(self.definitionTerms)]
 		else:
 			try:
-				searchRegex = re.compile(searchterm)
+				searchRegex = SharedFunctions.compileUserRegex(searchterm)
 			except re.error:
 				return "That is not valid regex. Please check for typos, and try again"
-
-			with open(definitionsFilename, 'r') as definitionsFile:
-				for linecount, line in enumerate(definitionsFile):
-					term, definition = json.loads(line).popitem()
-					if re.search(searchRegex, term):
-						possibleDefinitions[term] = linecount
-				if len(possibleDefinitions) == 0:
-					#If nothing was found, search again, but this time check the definitions themselves
-					definitionsFile.seek(0)
-					for linecount, line in enumerate(definitionsFile):
-						term, definition = json.loads(line).popitem()
-						if re.search(searchRegex, definition):
-							possibleDefinitions[term] = linecount
+			searchSuccess, possibleDefinitions = SharedFunctions.runUserRegexFunction([searchRegex], self.getDefinitionTerms, searchterm, searchRegex)
+			if not searchSuccess:
+				#If the search failed, 'possibleDefinitions' is the error message
+				return possibleDefinitions
 
 		possibleDefinitionsCount = len(possibleDefinitions)
 		if possibleDefinitionsCount == 0:
 			return "Sorry, I don't have any info on that term. If you think it's important, poke my owner(s)!"
 		elif possibleDefinitionsCount == 1:
-			term, linenumber = possibleDefinitions.popitem()
-			definition = json.loads(SharedFunctions.getLineFromFile(definitionsFilename, linenumber)).values()[0]
+			term = possibleDefinitions[0]
+			definition = self.definitions[term]
 			replytext = "{}: {}".format(SharedFunctions.makeTextBold(term), definition)
 			#Limit the message length
 			if len(replytext) > maxMessageLength:
@@ -482,7 +852,7 @@ class Command(CommandTemplate):
 		#Multiple matching definitions found
 		else:
 			if searchterm in possibleDefinitions:
-				definition = json.loads(SharedFunctions.getLineFromFile(definitionsFilename, possibleDefinitions[searchterm])).values()[0]
+				definition = self.definitions[searchterm]
 				replytext = "{}: {}".format(SharedFunctions.makeTextBold(searchterm), definition)
 				if len(replytext) > maxMessageLength - 18:  #-18 to account for the added text later
 					replytext = replytext[:maxMessageLength-24] + ' [...]'
@@ -490,10 +860,15 @@ class Command(CommandTemplate):
 			else:
 				replytext = "Your search returned {:,} results, please be more specific".format(possibleDefinitionsCount)
 				if possibleDefinitionsCount < 10:
-					replytext += ": {}".format(u"; ".join(sorted(possibleDefinitions.keys())))
+					replytext += ": {}".format(u"; ".join(sorted(possibleDefinitions)))
 		return replytext
 
 
+	@staticmethod
+	def getMatchingSetnames(setnames, setnameRegex):
+		#Skip the list of the sets that have boosterpacks
+		return [setname for setname in setnames if setname != '_setsWithBoosterpacks' and setnameRegex.search(setname)]
+
 	@staticmethod
 	def openBoosterpack(askedSetname):
 		askedSetname = askedSetname.lower()
@@ -519,28 +894,27 @@ class Command(CommandTemplate):
 		if properSetname == u'':
 			#Setname not found literally. Try and find the closest match
 			try:
-				askedSetnameRegex = re.compile(askedSetname, re.IGNORECASE)
+				askedSetnameRegex = SharedFunctions.compileUserRegex(askedSetname, re.IGNORECASE)
 			except re.error:
 				askedSetnameRegex = re.compile(re.escape(askedSetname), re.IGNORECASE)
-			for setname in setdata:
-				#Skip the list of the sets that have boosterpacks
-				if setname == '_setsWithBoosterpacks':
+			searchSuccess, matchingSetnames = SharedFunctions.runUserRegexFunction([askedSetnameRegex], Command.getMatchingSetnames, setdata.keys(), askedSetnameRegex)
+			if not searchSuccess:
+				return (False, matchingSetnames)
+			for setname in matchingSetnames:
+				#Match found! If we hadn't found a match previously, store this name
+				if properSetname == u'':
+					properSetname = setname
+				#If we previously found a set and the current set doesn't have a booster, don't claim we found two sets
+				elif 'booster' not in setdata[setname]:
 					continue
-				if askedSetnameRegex.search(setname):
-					#Match found! If we hadn't found a match previously, store this name
-					if properSetname == u'':
-						properSetname = setname
-					#If we previously found a set and the current set doesn't have a booster, don't claim we found two sets
-					elif 'booster' not in setdata[setname]:
-						continue
-					#If the previously found set doesn't have a booster but this one does, store the current set as the found one
-					elif 'booster' not in setdata[properSetname]:
-						properSetname = setname
-					#Both matching sets we found contain boosters. Inform the user of the conflict
-					else:
-						#A match has been found previously. We can't make a boosterpack from two sets, so show an error
-						return (False, u"That setname matches at least two sets, '{}' and '{}'. I can't make a boosterpack from more than one set. "
-									   u"Please be a bit more specific".format(setname, properSetname))
+				#If the previously found set doesn't have a booster but this one does, store the current set as the found one
+				elif 'booster' not in setdata[properSetname]:
+					properSetname = setname
+				#Both matching sets we found contain boosters. Inform the user of the conflict
+				else:
+					#A match has been found previously. We can't make a boosterpack from two sets, so show an error
+					return (False, u"That setname matches at least two sets, '{}' and '{}'. I can't make a boosterpack from more than one set. "
+								   u"Please be a bit more specific".format(setname, properSetname))
 		#If we still haven't found anything, give up
 		if properSetname == u'':
 			return (False, "I'm sorry, I don't know the set '{}'. Did you make a typo?".format(askedSetname))
@@ -548,6 +922,7 @@ class Command(CommandTemplate):
 		if 'booster' not in setdata[properSetname]:
 			return (False, "The set '{}' doesn't have booster packs, according to my data. Sorry".format(properSetname))
 		boosterRarities = setdata[properSetname]['booster']
+		boosterCardsLineNumber = setdata[properSetname].get('_boosterCardsLineNumber', None)
 
 		#Resolve any random choices (in the '_choice' field). It's a list of lists, since there can be multiple cards with choices
 		if '_choice' in boosterRarities:
@@ -571,37 +946,13 @@ class Command(CommandTemplate):
 		#Name exists, get the proper spelling, since in other places setnames aren't lower-case
 		properSetname = setdata[properSetname]['name']
 
-		#Check if we need to collect some special-case types too instead of just rarities
-		typesToCollect = []  #This will become a tuple with the first entry being the type in text and the second entry the compiled regex
-		defaultRarities = ('common', 'uncommon', 'rare', 'mythic rare', '_choice')
-		for rarity in boosterRarities:
-			if rarity not in defaultRarities:
-				typesToCollect.append((rarity, re.compile(rarity, re.IGNORECASE)))
-		collectTypes = True if len(typesToCollect) > 0 else False
-
-		#A dictionary with the found cards, sorted by rarity
-		possibleCards = {}
-		#First fill in the required rarities
-		for rarity in boosterRarities:
-			possibleCards[rarity.lower()] = []
-
-		#Get all cards from that set
-		with open(os.path.join(GlobalStore.scriptfolder, 'data', 'MTGcards.json'), 'r') as jsonfile:
-			for cardline in jsonfile:
-				cardname, carddata = json.loads(cardline).popitem()
-				if properSetname not in carddata[1]:
-					continue
-				#Skip cards whose number ends with 'b', since they're the backside of doublefaced cards or the upside-down part of split cards
-				if 'number' in carddata[0] and carddata[0]['number'].endswith('b'):
-					continue
-				if collectTypes:
-					for typeName, typeRegex in typesToCollect:
-						if typeRegex.search(carddata[0]['type']):
-							possibleCards[typeName].append(carddata[0]['name'])
-							continue
-				rarity = carddata[1][properSetname]['rarity'].lower()
-				if rarity in boosterRarities:
-					possibleCards[rarity].append(carddata[0]['name'])
+		#The cards that can be in each booster slot are collected when the card data is updated. Older card data doesn't have those, so collect them now
+		if boosterCardsLineNumber is not None:
+			possibleCards = json.loads(SharedFunctions.getLineFromFile(os.path.join(GlobalStore.scriptfolder, 'data', 'MTGboosterCards.json'), boosterCardsLineNumber))
+		else:
+			possibleCards, slotTypeRegexes = Command.createBoosterCardPools(boosterRarities)
+			for cardname, cardtype, cardnumber, rarity in Command.getCardsInSet(properSetname):
+				Command.addCardToBoosterCardPools(possibleCards, slotTypeRegexes, cardname, cardtype, cardnumber, rarity)
 
 		#Some sets don't have basic lands, but need them in their boosterpacks (Gatecrash f.i.) Fix that
 		#TODO: Handle rarities properly, a 'land' shouldn't be a 'basic land' but a land from that set
@@ -626,6 +977,53 @@ class Command(CommandTemplate):
 			replytext += "{}: {}. ".format(SharedFunctions.makeTextBold(rarity.encode('utf-8').capitalize()), cardlist)
 		return (True, replytext)
 
+	@staticmethod
+	def createBoosterCardPools(boosterRarities):
+		"""
+		Creates the lists to store which cards can be in each slot of a set's booster packs. Slots are either rarities or card types
+		:return: A dict with the slot names as keys and empty lists as values, and a list of (slot name, type regex) tuples for the slots that are card types
+		"""
+		boosterSlots = set(rarity.lower() for rarity in boosterRarities if rarity != '_choice')
+		for rarityOptions in boosterRarities.get('_choice', []):
+			boosterSlots.update(rarity.lower() for rarity in rarityOptions)
+		defaultRarities = ('common', 'uncommon', 'rare', 'mythic rare')
+		slotTypeRegexes = [(slot, re.compile(slot, re.IGNORECASE)) for slot in boosterSlots if slot not in defaultRarities]
+		return {slot: [] for slot in boosterSlots}, slotTypeRegexes
+
+	@staticmethod
+	def addCardToBoosterCardPools(boosterCardPools, slotTypeRegexes, cardname, cardtype, cardnumber, rarity):
+		"""Adds the card to the lists of the booster slots it can be in, if any. The pools and regexes should be made with 'createBoosterCardPools'"""
+		#Skip cards whose number ends with 'b', since they're the backside of doublefaced cards or the upside-down part of split cards
+		if cardnumber and cardnumber.endswith('b'):
+			return
+		for slot, typeRegex in slotTypeRegexes:
+			if typeRegex.search(cardtype):
+				boosterCardPools[slot].append(cardname)
+		rarity = rarity.lower()
+		if rarity in boosterCardPools:
+			boosterCardPools[rarity].append(cardname)
+
+	@staticmethod
+	def getCardsInSet(setname):
+		"""
+		Generator that yields the name, type, number and rarity in the provided set of each card in that set.
+		Uses the binary card store if it's available, since then the rest of the card data doesn't need to be read
+		"""
+		if BinaryCardStore.isStoreFile(Command.getBinaryCardStoreFilename()):
+			with BinaryCardStore(Command.getBinaryCardStoreFilename()) as binaryCardStore:
+				for cardNumber in xrange(binaryCardStore.cardCount):
+					for setRow in binaryCardStore.getSetRows(cardNumber):
+						if binaryCardStore.getSetField(setRow, '_setname') == setname:
+							yield (binaryCardStore.getCardField(cardNumber, 'name'), binaryCardStore.getCardField(cardNumber, 'type'),
+								   binaryCardStore.getCardField(cardNumber, 'number'), binaryCardStore.getSetField(setRow, 'rarity'))
+							break
+		else:
+			with open(os.path.join(GlobalStore.scriptfolder, 'data', 'MTGcards.json'), 'r') as jsonfile:
+				for cardline in jsonfile:
+					cardname, carddata = json.loads(cardline).popitem()
+					if setname in carddata[1]:
+						yield (carddata[0]['name'], carddata[0]['type'], carddata[0].get('number', None), carddata[1][setname]['rarity'])
+
 	def downloadCardDataset(self):
 		url = "http://mtgjson.com/json/AllSetFilesWindows.zip"  # Use the Windows version to keep it multi-platform (Windows can't handle files named 'CON')
 		cardzipFilename = os.path.join(GlobalStore.scriptfolder, 'data', url.split('/')[-1])
@@ -644,6 +1042,17 @@ class Command(CommandTemplate):
 		latestVersion = latestVersion.replace('"', '')  #Version is a quoted string, remove the quotes
 		return (True, latestVersion)
 
+	def getCardDataVersion(self):
+		"""Returns a string that's different for each version of the card files, or None if there's no version file"""
+		if self.cardDataVersion is None:
+			versionFilename = os.path.join(GlobalStore.scriptfolder, 'data', 'MTGversion.json')
+			if not os.path.isfile(versionFilename):
+				return None
+			with open(versionFilename, 'r') as versionfile:
+				versiondata = json.load(versionfile)
+			self.cardDataVersion = u"{}/{}/{}".format(versiondata.get('formatVersion', None), versiondata.get('dataVersion', None), versiondata.get('lastUpdateTime', None))
+		return self.cardDataVersion
+
 	@staticmethod
 	def doNeededFilesExist():
 		for fn in ('cards', 'definitions', 'sets', 'version'):
@@ -675,14 +1084,37 @@ class Command(CommandTemplate):
 		return False
 
 	def updateCardFile(self, shouldUpdateDefinitions=True):
-		starttime = time.time()
-		cardStoreFilename = os.path.join(GlobalStore.scriptfolder, 'data', 'MTGcards.json')
-		gamewideCardStoreFilename = os.path.join(GlobalStore.scriptfolder, 'data', 'MTGcards_gamewide.json')
-		setStoreFilename = os.path.join(GlobalStore.scriptfolder, 'data', 'MTGsets.json')
-		definitionsFilename = os.path.join(GlobalStore.scriptfolder, 'data', 'MTGdefinitions.json')
-
+		dataFolder = os.path.join(GlobalStore.scriptfolder, 'data')
+		#All the new files get written to a staging folder first, and only replace the current files when they're all done
+		# That way lookups can keep using the current files during the update
+		stagingFolder = os.path.join(dataFolder, 'MTGupdate')
 		#Inform everything that we're going to be changing the card files
 		self.areCardfilesInUse = True
+		try:
+			return self.createUpdatedCardFiles(dataFolder, stagingFolder, shouldUpdateDefinitions)
+		except Exception:
+			self.logError("[MtG] An error occurred while updating the card database", exc_info=True)
+			return (False, "Something went wrong while updating my card database, sorry. The error has been logged")
+		finally:
+			#Make sure a failed update doesn't block future updates, and that its partial files don't get used
+			self.areCardfilesInUse = False
+			if os.path.exists(stagingFolder):
+				shutil.rmtree(stagingFolder, ignore_errors=True)
+
+	def createUpdatedCardFiles(self, dataFolder, stagingFolder, shouldUpdateDefinitions):
+		"""
+		Downloads the latest card data and turns it into the files we need, and replaces the current files with them. Called by 'updateCardFile', which cleans up if this fails
+		:return: A tuple with a boolean indicating whether the update succeeded, and a message describing the result
+		"""
+		starttime = time.time()
+		cardStoreFilename = os.path.join(stagingFolder, 'MTGcards.json')
+		gamewideCardStoreFilename = os.path.join(stagingFolder, 'MTGcards_gamewide.json')
+		binaryCardStoreFilename = os.path.join(stagingFolder, os.path.basename(self.getBinaryCardStoreFilename()))
+		setStoreFilename = os.path.join(stagingFolder, 'MTGsets.json')
+		boosterCardsFilename = os.path.join(stagingFolder, 'MTGboosterCards.json')
+		definitionsFilename = os.path.join(stagingFolder, 'MTGdefinitions.json')
+		versionFilename = os.path.join(stagingFolder, 'MTGversion.json')
+
 		self.logInfo("[MtG] Updating card database!")
 
 		#Download the wrongly-formatted (for our purposes) card data
@@ -692,34 +1124,18 @@ class Command(CommandTemplate):
 		else:
 			cardDatasetFilename = result
 
+		if os.path.exists(stagingFolder):
+			shutil.rmtree(stagingFolder)
+		os.makedirs(stagingFolder)
+
+		#Parse the set files into the format we need. Sets that haven't changed since the last update are already parsed in the cache
+		setfilenames = self.parseSetFilesIntoCache(cardDatasetFilename)
+
 		#Set up the dicts we're going to store our data in
 		newcardstore = {}
 		setstore = {'_setsWithBoosterpacks': []}
-		#Since definitions from cards get written to file immediately, just keep a list of which keywords we already stored
-		definitions = []
-		#Lists of what to do with certain set keys
-		setKeysToRemove = ('border', 'magicRaritiesCodes', 'mkm_id', 'mkm_name', 'oldCode', 'onlineOnly', 'translations')
-		raritiesToRemove = ('checklist', 'double faced', 'draft-matters', 'foil', 'marketing', 'power nine', 'timeshifted purple')
-		raritiesToRename = {'land': 'basic land', 'urza land': 'land — urza’s'}  #Non-standard rarities are interpreted as regexes for type
-		rarityPrefixesToRemove = {'foil ': 5, 'timeshifted ': 12}  #The numbers are the string length, saves a lot of 'len()' calls
-		#Lists of what to do with certain card keys
-		keysToRemove = ('border', 'colorIdentity', 'id', 'imageName', 'mciNumber', 'releaseDate', 'reserved', 'starter', 'subtypes', 'supertypes', 'timeshifted', 'types', 'variations')
-		keysToFormatNicer = ('flavor', 'manacost', 'text')
-		layoutTypesToRemove = ('normal', 'phenomenon', 'plane', 'scheme', 'vanguard')
-		listKeysToMakeString = ('colors', 'names')
-		setSpecificCardKeys = ('artist', 'flavor', 'multiverseid', 'number', 'rarity', 'watermark')
-
-		# This function will be called on the 'keysToFormatNicer' keys
-		#  Made into a function, because it's used in two places
-		def formatNicer(text):
-			#Remove brackets around mana cost
-			if '{' in text:
-				text = text.replace('}{', ' ').replace('{', '').replace('}', '')
-			#Replace newlines with spaces. If the sentence ends in a letter, add a period
-			text = re.sub('(?<=\w)\n', '. ', text).replace('\n', ' ')
-			#Prevent double spaces
-			text = re.sub(' {2,}', ' ', text).strip()
-			return text
+		#Since definitions from cards get written to file immediately, just keep track of which keywords we already stored
+		definitions = set()
 
 		#Reference to a temporary file where we will store gamewide JSON-parsed card info (Like card text, CMC)
 		# This way we don't have to keep that in memory during the entire loop
@@ -730,181 +1146,85 @@ class Command(CommandTemplate):
 		if shouldUpdateDefinitions:
 			definitionsFile = open(definitionsFilename, 'w')
 
-		#Go through each file in the sets zip (Saves memory compared to downloading the single file with all the sets)
-		with zipfile.ZipFile(cardDatasetFilename, 'r') as setfilesZip:
-			#Go through each file in the sets zip
-			for setfilename in setfilesZip.namelist():
-				# Keep numbers as strings, saves on converting them back later
-				setData = json.loads(setfilesZip.read(setfilename), parse_int=lambda x: x, parse_float=lambda x: x)
-				#Put the cardlist in a separate variable, so we can store all the set information easily
-				cardlist = setData.pop('cards')
-				#Clean up the set data a bit
-				for setKeyToRemove in setKeysToRemove:
-					if setKeyToRemove in setData:
-						del setData[setKeyToRemove]
-				#The 'booster' set field is a bit verbose, make that shorter and easier to use
-				if 'booster' in setData:
-					originalBoosterList = setData.pop('booster')
-					countedBoosterData = {}
-					try:
-						for rarity in originalBoosterList:
-							#If the entry is a list, it's a list of possible choices for that card
-							#  ('['rare', 'mythic rare']' means a booster pack contains a rare OR a mythic rare)
-							if isinstance(rarity, list):
-								#Remove useless options here too
-								for rarityToRemove in raritiesToRemove:
-									if rarityToRemove in rarity:
-										rarity.remove(rarityToRemove)
-								#Rename 'wrongly' named rarites
-								for r in raritiesToRename:
-									if r in rarity:
-										rarity.remove(r)
-										rarity.append(raritiesToRename[r])
-								#Check if any of the choices have a prefix that needs to be removed (use a copy so we can delete elements in the loop)
-								for choice in rarity[:]:
-									for rp in rarityPrefixesToRemove:
-										if choice.startswith(rp):
-											#Remove the original choice...
-											rarity.remove(choice)
-											newRarity = choice[rarityPrefixesToRemove[rp]:]
-											#...and put in the choice without the prefix, if it's not there already
-											if newRarity not in rarity:
-												rarity.append(newRarity)
-								#If we removed all options and just have an empty list now, replace it with a rare
-								if len(rarity) == 0:
-									rarity = 'rare'
-								#If we've removed all but one option, it's not a choice anymore, so treat it like a 'normal' rarity
-								elif len(rarity) == 1:
-									rarity = rarity[0]
-								else:
-									#If it's still a list, keep it like that
-									if '_choice' not in countedBoosterData:
-										countedBoosterData['_choice'] = [rarity]
-									else:
-										countedBoosterData['_choice'].append(rarity)
-									#...but don't do any of the other stuff
-									continue
-							#Some keys are dumb and useless ('marketing'). Ignore those
-							if rarity in raritiesToRemove:
-								continue
-							#Here the rarity for a basic land is called 'land', while in the cards themselves it's 'basic land'. Correct that
-							for rarityToRename in raritiesToRename:
-								if rarity == rarityToRename:
-									rarity = raritiesToRename[rarity]
-							#Remove any useless prefixes like 'foil'
-							for rp in rarityPrefixesToRemove:
-								if rarity.startswith(rp):
-									rarity = rarity[rarityPrefixesToRemove[rp]:]
-							#Finally, count the rarity
-							if rarity not in countedBoosterData:
-								countedBoosterData[rarity] = 1
-							else:
-								countedBoosterData[rarity] += 1
-					except Exception as e:
-						self.logError("Error while parsing booster field of set '{}' ({}): {!r}".format(setData['name'], setfilename, e))
-					else:
-						#If no parsing error occurred, add the parsed booster data
-						setData['booster'] = countedBoosterData
-						# Keep a list of sets that have booster packs
-						setstore['_setsWithBoosterpacks'].append(setData['name'].lower())
-				setstore[setData['name'].lower()] = setData
-
-				#Pop off cards when we need them, to save on memory
-				for cardcount in xrange(0, len(cardlist)):
-					card = cardlist.pop()
-					cardname = card['name'].lower()  #lowering the keys makes searching easier later, especially when comparing against the literal searchstring
-
-					#Make flavor text read better
-					if 'flavor' in card:
-						card['flavor'] = formatNicer(card['flavor'])
-					#New and already listed cards need their set info stored
-					#TODO: Some sets have multiple cards with the same name but a different artist (f.i. land cards). Handle that
-					setSpecificCardData = {}
-					for setSpecificKey in setSpecificCardKeys:
-						if setSpecificKey in card:
-							setSpecificCardData[setSpecificKey] = card.pop(setSpecificKey)
-					#Don't add it to newcardstore yet, so we can check if it's in there already or not
-					# But do the loop now so the set-specific keys are removed from the card dict
-
-					#If the card isn't in the store yet, parse its data
-					if cardname not in newcardstore:
-						#Remove some useless data to save some space, memory and time
-						for keyToRemove in keysToRemove:
-							if keyToRemove in card:
-								del card[keyToRemove]
-
-						#No need to store there's nothing special about the card's layout or if the special-ness is already evident from the text
-						if card['layout'] in layoutTypesToRemove:
-							del card['layout']
-
-						#The 'Colors' field benefits from some ordering, for readability.
-						if 'colors' in card:
-							card['colors'] = sorted(card['colors'])
-
-						#Remove the current card from the list of names this card also contains (for flip cards)
-						# (Saves on having to remove it later, and the presence of this field shows it's in there too)
-						if 'names' in card:
-							card['names'].remove(card['name'])
-
-						#Make sure all stored values are strings, that makes searching later much easier
-						for attrib in listKeysToMakeString:
-							if attrib in card:
-								card[attrib] = u"; ".join(card[attrib])
-
-						#Make 'manaCost' lowercase, since we make the searchstring lowercase too, and we don't want to miss this
-						if 'manaCost' in card:
-							card['manacost'] = card['manaCost']
-							del card['manaCost']
-
-						#Get possible term definitions from this card's text, if needed
-						if shouldUpdateDefinitions and 'text' in card:
-							definitionsFromCard = self.parseKeywordDefinitionsFromCardText(card['text'], card['name'], definitions)
-							#Write the found definitions to file immediately, and store that we found them
-							for term, definition in definitionsFromCard.iteritems():
+		#Combine the parsed sets, in the same order as they're in the card dataset
+		for setfilename in setfilenames:
+			with open(self.getSetCacheFilename(setfilename), 'r') as setCacheFile:
+				#The first line is the cache key, the parsed set is on the second line
+				setCacheFile.readline()
+				try:
+					parsedSet = json.loads(setCacheFile.readline())
+				except ValueError:
+					#Remove the broken cache file, so the next update parses the set again instead of failing on it again
+					setCacheFile.close()
+					os.remove(self.getSetCacheFilename(setfilename))
+					raise
+			setData = parsedSet['setData']
+			if parsedSet['boosterParseError']:
+				self.logError("Error while parsing booster field of set '{}' ({}): {}".format(setData['name'], setfilename, parsedSet['boosterParseError']))
+			elif 'booster' in setData:
+				# Keep a list of sets that have booster packs
+				setstore['_setsWithBoosterpacks'].append(setData['name'].lower())
+			setstore[setData['name'].lower()] = setData
+
+			for cardname, card, setSpecificCardData, definitionsFromCard in parsedSet['cards']:
+				#Only the first time a card is encountered its gamewide data gets stored
+				if cardname not in newcardstore:
+					#Write the found definitions to file immediately, and store that we found them
+					if shouldUpdateDefinitions:
+						for term, definition in definitionsFromCard.iteritems():
+							if term not in definitions:
 								definitionsFile.write(json.dumps({term: definition}))
 								definitionsFile.write('\n')
-								definitions.append(term)
-
-						#Clean text up a bit to make it display better
-						for keyToFormat in keysToFormatNicer:
-							if keyToFormat in card:
-								card[keyToFormat] = formatNicer(card[keyToFormat])
-
-						#To make searching easier later, without all sorts of key checking, make sure the 'text' key always exists
-						if 'text' not in card:
-							card['text'] = u""
+								definitions.add(term)
 
-						#Save the data to file for now, we'll add all the set-specific data later
-						gamewideCardStoreFile.write(json.dumps({cardname: card}))
-						gamewideCardStoreFile.write('\n')
+					#Save the data to file for now, we'll add all the set-specific data later
+					gamewideCardStoreFile.write(json.dumps({cardname: card}))
+					gamewideCardStoreFile.write('\n')
 
-						#Store that we already parsed the gamewide card data, and make a dict for the set-specific data
-						newcardstore[cardname] = {}
+					#Store that we already parsed the gamewide card data, and make a dict for the set-specific data
+					newcardstore[cardname] = {}
 
-					#NOW store the set-specific info in the cardstore, so we can be sure the dict exists
-					newcardstore[cardname][setData['name']] = setSpecificCardData
+				#NOW store the set-specific info in the cardstore, so we can be sure the dict exists
+				newcardstore[cardname][setData['name']] = setSpecificCardData
 
-				#Don't hog the execution thread for too long, give it up after each set
-				gevent.idle()
+			#Don't hog the execution thread for too long, give it up after each set
+			gevent.idle()
 
 		#Make sure all the data is flushed to disk
 		gamewideCardStoreFile.close()
 
-		#First delete the original files
-		if os.path.exists(cardStoreFilename):
-			os.remove(cardStoreFilename)
-		if os.path.exists(setStoreFilename):
-			os.remove(setStoreFilename)
-		#Save the new databases to disk
+		#Collect which cards can be in each slot of each set's booster packs, so opening a booster pack doesn't need to go through all the cards
+		boosterCardPoolsBySetname = {}  #Keys are the set names as they're used in the card data, values are tuples with the pools and type regexes
+		for setKey, setData in setstore.iteritems():
+			if setKey != '_setsWithBoosterpacks' and 'booster' in setData:
+				boosterCardPoolsBySetname[setData['name']] = self.createBoosterCardPools(setData['booster'])
+		#Save the new databases to disk. The binary card store contains the same cards in the same order, but is faster to search through
+		binaryCardStoreWriter = BinaryCardStoreWriter()
 		with open(cardStoreFilename, 'w') as cardfile:
 			gamewideCardStoreFile = open(gamewideCardStoreFilename, 'r')
 			#Go through each card's game-wide data and append the set-specific data to it
 			for line in gamewideCardStoreFile:
 				cardname, gamewideCardData = json.loads(line).popitem()
+				setSpecificCardData = newcardstore.pop(cardname)
 				#Write each card's as a separate JSON file so we can go through it line by line instead of having to load it all at once
-				cardfile.write(json.dumps({cardname: [gamewideCardData, newcardstore.pop(cardname)]}))
+				cardfile.write(json.dumps({cardname: [gamewideCardData, setSpecificCardData]}))
 				cardfile.write('\n')
+				binaryCardStoreWriter.addCard(gamewideCardData, setSpecificCardData)
+				for setname, setSpecificData in setSpecificCardData.iteritems():
+					if setname in boosterCardPoolsBySetname:
+						boosterCardPools, slotTypeRegexes = boosterCardPoolsBySetname[setname]
+						self.addCardToBoosterCardPools(boosterCardPools, slotTypeRegexes, gamewideCardData['name'], gamewideCardData['type'],
+													   gamewideCardData.get('number', None), setSpecificData['rarity'])
 			gamewideCardStoreFile.close()
+		binaryCardStoreWriter.save(binaryCardStoreFilename)
+		del binaryCardStoreWriter
+		#Store each set's booster card pools on a separate line, and store that line number in the set data, so only the pools of one set need to be read
+		with open(boosterCardsFilename, 'w') as boosterCardsFile:
+			for lineNumber, (setname, (boosterCardPools, slotTypeRegexes)) in enumerate(boosterCardPoolsBySetname.iteritems()):
+				boosterCardsFile.write(json.dumps(boosterCardPools))
+				boosterCardsFile.write('\n')
+				setstore[setname.lower()]['_boosterCardsLineNumber'] = lineNumber
+		del boosterCardPoolsBySetname
 		with open(setStoreFilename, 'w') as setsfile:
 			setsfile.write(json.dumps(setstore))
 
@@ -915,7 +1235,7 @@ class Command(CommandTemplate):
 		del setstore
 
 		#Store the new version data
-		with open(os.path.join(GlobalStore.scriptfolder, 'data', 'MTGversion.json'), 'w') as versionFile:
+		with open(versionFilename, 'w') as versionFile:
 			versionFile.write(json.dumps({'formatVersion': self.dataFormatVersion, 'dataVersion': self.getLatestVersionNumber()[1], 'lastUpdateTime': time.time()}))
 
 		replytext = "MtG card database successfully updated (Changelog: http://mtgjson.com/changelog.html)"
@@ -930,6 +1250,7 @@ class Command(CommandTemplate):
 			for term, definition in downloadedDefinitions.iteritems():
 				definitionsFile.write(json.dumps({term: definition}))
 				definitionsFile.write('\n')
+			definitionsFile.close()
 			#And (try to) clean up the memory used
 			del definitions
 			del downloadedDefinitions
@@ -937,14 +1258,263 @@ class Command(CommandTemplate):
 		#Since we don't need the cardfile anymore now, delete it
 		os.remove(cardDatasetFilename)
 
+		#Everything is ready, replace the current files with the new ones. The version file goes last, so if something goes wrong before that, the next update check redoes it all
+		for filename in sorted(os.listdir(stagingFolder), key=lambda fn: fn == os.path.basename(versionFilename)):
+			targetFilename = os.path.join(dataFolder, filename)
+			#On Windows a file can't be renamed to the name of an existing file. Elsewhere renaming replaces the existing file in one go, so readers never see a missing file
+			if os.name == 'nt' and os.path.exists(targetFilename):
+				os.remove(targetFilename)
+			os.rename(os.path.join(stagingFolder, filename), targetFilename)
+		os.rmdir(stagingFolder)
+		#The card index, definitions and search results in memory are from the old files, so they need to be reloaded
+		self.clearCardIndex()
+		self.clearDefinitions()
+		self.logInfo("[MtG] Clearing search result cache. " + self.searchResultCache.getStats())
+		self.searchResultCache.clear()
+		self.cardDataVersion = None
+
 		#Updating apparently uses up RAM that Python doesn't clear up soon or properly. Force it to
 		re.purge()
 		gc.collect()
 
 		self.areCardfilesInUse = False
 		self.logInfo("[MtG] updating database took {} seconds".format(time.time() - starttime))
+		if self.keepCardIndexInMemory:
+			self.loadCardIndex()
 		return (True, replytext)
 
+	@staticmethod
+	def getSetCacheFilename(setfilename):
+		return os.path.join(GlobalStore.scriptfolder, 'data', 'MTGsetCache', os.path.splitext(os.path.basename(setfilename))[0] + '.json')
+
+	def parseSetFilesIntoCache(self, cardDatasetFilename):
+		"""
+		Makes sure the set cache contains the parsed data of each set in the downloaded card dataset.
+		Sets are only parsed if their content changed since the last update, and they're parsed in separate processes, so all processor cores can be used
+		:return: The list of set filenames in the card dataset, in the order they're in the dataset
+		"""
+		starttime = time.time()
+		setCacheFolder = os.path.dirname(self.getSetCacheFilename('set.json'))
+		if not os.path.exists(setCacheFolder):
+			os.makedirs(setCacheFolder)
+		#Check which sets changed, by comparing the checksum and size the zip file stores for each set file with those of the cached parsed set
+		setfilenames = []
+		setsToParse = []  #A list of (set filename, cache key) tuples
+		with zipfile.ZipFile(cardDatasetFilename, 'r') as setfilesZip:
+			for zipInfo in setfilesZip.infolist():
+				setfilenames.append(zipInfo.filename)
+				cacheKey = "{}-{:08x}-{}".format(self.dataFormatVersion, zipInfo.CRC, zipInfo.file_size)
+				if self.getCachedSetKey(zipInfo.filename) != cacheKey:
+					setsToParse.append((zipInfo.filename, cacheKey))
+		#Remove the cached sets that aren't in the dataset anymore
+		currentCacheFilenames = set(os.path.basename(self.getSetCacheFilename(setfilename)) for setfilename in setfilenames)
+		for cacheFilename in os.listdir(setCacheFolder):
+			if cacheFilename not in currentCacheFilenames:
+				os.remove(os.path.join(setCacheFolder, cacheFilename))
+
+		parsedSetCount = len(setsToParse)
+		if setsToParse:
+			try:
+				processCount = min(multiprocessing.cpu_count(), len(setsToParse))
+			except NotImplementedError:
+				processCount = 1
+			if processCount > 1:
+				processes = []
+				for processIndex in xrange(processCount):
+					process = multiprocessing.Process(target=parseSetFilesIntoCache, args=(cardDatasetFilename, setsToParse[processIndex::processCount]))
+					process.start()
+					processes.append(process)
+				#Wait for the processes to finish without blocking the rest of the bot
+				while any(process.is_alive() for process in processes):
+					gevent.sleep(0.25)
+				for process in processes:
+					process.join()
+					if process.exitcode != 0:
+						self.logError("[MtG] A set parsing process stopped with exit code {}, parsing its sets again here".format(process.exitcode))
+			#Parse anything that wasn't parsed successfully yet (or everything, if there's only one process) here
+			setsToParse = [(setfilename, cacheKey) for setfilename, cacheKey in setsToParse if self.getCachedSetKey(setfilename) != cacheKey]
+			if setsToParse:
+				parseSetFilesIntoCache(cardDatasetFilename, setsToParse)
+		self.logInfo("[MtG] Parsed {:,} of {:,} sets in {:.2f} seconds, the rest hadn't changed since the last update".format(parsedSetCount, len(setfilenames), time.time() - starttime))
+		return setfilenames
+
+	@staticmethod
+	def getCachedSetKey(setfilename):
+		"""Returns the cache key the cached parsed data of the provided set file was stored with, or None if there's no valid cached data for that set"""
+		cacheFilename = Command.getSetCacheFilename(setfilename)
+		if not os.path.isfile(cacheFilename):
+			return None
+		try:
+			with open(cacheFilename, 'r') as cacheFile:
+				#The cache key is stored on the first line, so the rest doesn't need to be loaded to check it
+				return json.loads(cacheFile.readline())
+		except ValueError:
+			return None
+
+	@staticmethod
+	def parseSetFile(setFileContents):
+		"""
+		Turns the contents of a set file from the card dataset into the set data and card data we store
+		:return: A dictionary with the set data under 'setData', a list with a [cardname, gamewide card data, set-specific card data, definitions from the card] list per card
+			under 'cards', and the error that happened while parsing the booster data under 'boosterParseError' (or None if there wasn't any)
+		"""
+		#Lists of what to do with certain set keys
+		setKeysToRemove = ('border', 'magicRaritiesCodes', 'mkm_id', 'mkm_name', 'oldCode', 'onlineOnly', 'translations')
+		raritiesToRemove = ('checklist', 'double faced', 'draft-matters', 'foil', 'marketing', 'power nine', 'timeshifted purple')
+		raritiesToRename = {'land': 'basic land', 'urza land': 'land — urza’s'}  #Non-standard rarities are interpreted as regexes for type
+		rarityPrefixesToRemove = {'foil ': 5, 'timeshifted ': 12}  #The numbers are the string length, saves a lot of 'len()' calls
+		#Lists of what to do with certain card keys
+		keysToRemove = ('border', 'colorIdentity', 'id', 'imageName', 'mciNumber', 'releaseDate', 'reserved', 'starter', 'subtypes', 'supertypes', 'timeshifted', 'types', 'variations')
+		keysToFormatNicer = ('flavor', 'manacost', 'text')
+		layoutTypesToRemove = ('normal', 'phenomenon', 'plane', 'scheme', 'vanguard')
+		listKeysToMakeString = ('colors', 'names')
+		setSpecificCardKeys = ('artist', 'flavor', 'multiverseid', 'number', 'rarity', 'watermark')
+
+		# This function will be called on the 'keysToFormatNicer' keys
+		#  Made into a function, because it's used in two places
+		def formatNicer(text):
+			#Remove brackets around mana cost
+			if '{' in text:
+				text = text.replace('}{', ' ').replace('{', '').replace('}', '')
+			#Replace newlines with spaces. If the sentence ends in a letter, add a period
+			text = re.sub('(?<=\w)\n', '. ', text).replace('\n', ' ')
+			#Prevent double spaces
+			text = re.sub(' {2,}', ' ', text).strip()
+			return text
+
+		# Keep numbers as strings, saves on converting them back later
+		setData = json.loads(setFileContents, parse_int=lambda x: x, parse_float=lambda x: x)
+		#Put the cardlist in a separate variable, so we can store all the set information easily
+		cardlist = setData.pop('cards')
+		boosterParseError = None
+		#Clean up the set data a bit
+		for setKeyToRemove in setKeysToRemove:
+			if setKeyToRemove in setData:
+				del setData[setKeyToRemove]
+		#The 'booster' set field is a bit verbose, make that shorter and easier to use
+		if 'booster' in setData:
+			originalBoosterList = setData.pop('booster')
+			countedBoosterData = {}
+			try:
+				for rarity in originalBoosterList:
+					#If the entry is a list, it's a list of possible choices for that card
+					#  ('['rare', 'mythic rare']' means a booster pack contains a rare OR a mythic rare)
+					if isinstance(rarity, list):
+						#Remove useless options here too
+						for rarityToRemove in raritiesToRemove:
+							if rarityToRemove in rarity:
+								rarity.remove(rarityToRemove)
+						#Rename 'wrongly' named rarites
+						for r in raritiesToRename:
+							if r in rarity:
+								rarity.remove(r)
+								rarity.append(raritiesToRename[r])
+						#Check if any of the choices have a prefix that needs to be removed (use a copy so we can delete elements in the loop)
+						for choice in rarity[:]:
+							for rp in rarityPrefixesToRemove:
+								if choice.startswith(rp):
+									#Remove the original choice...
+									rarity.remove(choice)
+									newRarity = choice[rarityPrefixesToRemove[rp]:]
+									#...and put in the choice without the prefix, if it's not there already
+									if newRarity not in rarity:
+										rarity.append(newRarity)
+						#If we removed all options and just have an empty list now, replace it with a rare
+						if len(rarity) == 0:
+							rarity = 'rare'
+						#If we've removed all but one option, it's not a choice anymore, so treat it like a 'normal' rarity
+						elif len(rarity) == 1:
+							rarity = rarity[0]
+						else:
+							#If it's still a list, keep it like that
+							if '_choice' not in countedBoosterData:
+								countedBoosterData['_choice'] = [rarity]
+							else:
+								countedBoosterData['_choice'].append(rarity)
+							#...but don't do any of the other stuff
+							continue
+					#Some keys are dumb and useless ('marketing'). Ignore those
+					if rarity in raritiesToRemove:
+						continue
+					#Here the rarity for a basic land is called 'land', while in the cards themselves it's 'basic land'. Correct that
+					for rarityToRename in raritiesToRename:
+						if rarity == rarityToRename:
+							rarity = raritiesToRename[rarity]
+					#Remove any useless prefixes like 'foil'
+					for rp in rarityPrefixesToRemove:
+						if rarity.startswith(rp):
+							rarity = rarity[rarityPrefixesToRemove[rp]:]
+					#Finally, count the rarity
+					if rarity not in countedBoosterData:
+						countedBoosterData[rarity] = 1
+					else:
+						countedBoosterData[rarity] += 1
+			except Exception as e:
+				#This can run in a separate process, so leave logging the error to whatever combines the parsed sets
+				boosterParseError = repr(e)
+			else:
+				#If no parsing error occurred, add the parsed booster data
+				setData['booster'] = countedBoosterData
+
+		parsedCards = []
+		#Pop off cards when we need them, to save on memory
+		for cardcount in xrange(0, len(cardlist)):
+			card = cardlist.pop()
+			cardname = card['name'].lower()  #lowering the keys makes searching easier later, especially when comparing against the literal searchstring
+
+			#Make flavor text read better
+			if 'flavor' in card:
+				card['flavor'] = formatNicer(card['flavor'])
+			#TODO: Some sets have multiple cards with the same name but a different artist (f.i. land cards). Handle that
+			setSpecificCardData = {}
+			for setSpecificKey in setSpecificCardKeys:
+				if setSpecificKey in card:
+					setSpecificCardData[setSpecificKey] = card.pop(setSpecificKey)
+
+			#Which set's gamewide data gets used for a card is only known when all sets are combined, so parse the gamewide data for every card here
+			#Remove some useless data to save some space, memory and time
+			for keyToRemove in keysToRemove:
+				if keyToRemove in card:
+					del card[keyToRemove]
+
+			#No need to store there's nothing special about the card's layout or if the special-ness is already evident from the text
+			if card['layout'] in layoutTypesToRemove:
+				del card['layout']
+
+			#The 'Colors' field benefits from some ordering, for readability.
+			if 'colors' in card:
+				card['colors'] = sorted(card['colors'])
+
+			#Remove the current card from the list of names this card also contains (for flip cards)
+			# (Saves on having to remove it later, and the presence of this field shows it's in there too)
+			if 'names' in card:
+				card['names'].remove(card['name'])
+
+			#Make sure all stored values are strings, that makes searching later much easier
+			for attrib in listKeysToMakeString:
+				if attrib in card:
+					card[attrib] = u"; ".join(card[attrib])
+
+			#Make 'manaCost' lowercase, since we make the searchstring lowercase too, and we don't want to miss this
+			if 'manaCost' in card:
+				card['manacost'] = card['manaCost']
+				del card['manaCost']
+
+			#Get possible term definitions from this card's text. Which ones are new is checked when the sets are combined
+			definitionsFromCard = Command.parseKeywordDefinitionsFromCardText(card['text'], card['name']) if 'text' in card else {}
+
+			#Clean text up a bit to make it display better
+			for keyToFormat in keysToFormatNicer:
+				if keyToFormat in card:
+					card[keyToFormat] = formatNicer(card[keyToFormat])
+
+			#To make searching easier later, without all sorts of key checking, make sure the 'text' key always exists
+			if 'text' not in card:
+				card['text'] = u""
+
+			parsedCards.append([cardname, card, setSpecificCardData, definitionsFromCard])
+		return {'setData': setData, 'cards': parsedCards, 'boosterParseError': boosterParseError}
+
 	@staticmethod
 	def parseKeywordDefinitionsFromCardText(cardtext, cardname, existingDefinitions=None):
 		newDefinitions = {}
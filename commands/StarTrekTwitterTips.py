@@ -59,19 +59,26 @@ class Command(CommandTemplate):
 			#Search terms provided! Go through all the tweets to find matches
 			regex = None
 			try:
-				regex = re.compile(searchterm, re.IGNORECASE)
+				regex = SharedFunctions.compileUserRegex(searchterm, re.IGNORECASE)
 			except (re.error, SyntaxError):
 				self.logWarning("[STtip] '{}' is an invalid regular expression. Using it literally".format(searchterm))
-			for i in xrange(0, len(tweets)):
-				#Take a tweet from the start, and only put it back at the end if it matches the regex
-				tweet = tweets.pop(0)
-				if regex and regex.search(tweet) or searchterm in tweet:
-					tweets.append(tweet)
+			if regex:
+				#User regexes could be really slow, so make sure the search can't freeze the bot
+				searchSuccess, tweets = SharedFunctions.runUserRegexFunction([regex], self.getMatchingTweets, tweets, searchterm, regex)
+				if not searchSuccess:
+					#If the search failed, 'tweets' is the error message
+					return (False, tweets)
+			else:
+				tweets = self.getMatchingTweets(tweets, searchterm)
 		if len(tweets) == 0:
 			return (False, "Sorry, no tweets matching your search were found")
 		else:
 			return (True, tweets)
 
+	@staticmethod
+	def getMatchingTweets(tweets, searchterm, regex=None):
+		return [tweet for tweet in tweets if regex and regex.search(tweet) or searchterm in tweet]
+
 	def getTip(self, name='random', searchterm=None):
 		name = name.lower()
 		if name == 'random':
@@ -407,10 +407,15 @@ class Command(CommandTemplate):
 					stringToMatchAgainst = variableDict[grammarParts[0]]
 				else:
 					stringToMatchAgainst = grammarParts[0]
-				#Make sure we un-escape the regex, so it can use characters like < and | without messing up our parsing
-				regex = re.compile(re.sub(r"/(.)", r"\1", grammarParts[1]), flags=re.DOTALL)  # DOTALL so it can handle newlines in messages properly
 				try:
-					if re.search(regex, stringToMatchAgainst):
+					#Make sure we un-escape the regex, so it can use characters like < and | without messing up our parsing
+					regex = SharedFunctions.compileUserRegex(re.sub(r"/(.)", r"\1", grammarParts[1]), flags=re.DOTALL)  # DOTALL so it can handle newlines in messages properly
+					#Grammar files and parameters can come from users, so make sure a slow regex can't freeze the bot
+					matchSuccess, isMatch = SharedFunctions.runUserRegexFunction([regex], lambda: regex.search(stringToMatchAgainst) is not None)
+					if not matchSuccess:
+						#If the match failed, 'isMatch' is the error message
+						return (False, u"Error: {}".format(isMatch))
+					if isMatch:
 						replacement = grammarParts[2]
 					else:
 						replacement = grammarParts[3]
@@ -476,8 +481,12 @@ class Command(CommandTemplate):
 				else:
 					try:
 						#Unescape any characters inside the regex (like < and |)
-						regex = re.compile(re.sub(r"/(.)", r"\1", grammarParts[1]), flags=re.DOTALL)  #DOTALL so it can handle newlines in messages properly
-						replacement = re.sub(regex, grammarParts[2], replacement)
+						regex = SharedFunctions.compileUserRegex(re.sub(r"/(.)", r"\1", grammarParts[1]), flags=re.DOTALL)  #DOTALL so it can handle newlines in messages properly
+						#Grammar files and parameters can come from users, so make sure a slow regex can't freeze the bot
+						replaceSuccess, replacement = SharedFunctions.runUserRegexFunction([regex], regex.sub, grammarParts[2], replacement)
+						if not replaceSuccess:
+							#If the replacement failed, 'replacement' is the error message
+							return (False, u"Error: {}".format(replacement))
 					except re.error as e:
 						return (False, u"Error while parsing regular expression '{}' with replacement string '{}' ({})".format(grammarParts[1], grammarParts[2], e.message))
 			elif fieldKey == u"_choose":
@@ -0,0 +1,17 @@
+from CommandTemplate import CommandTemplate
+from IrcMessage import IrcMessage
+
+
+class Command(CommandTemplate):
+	triggers = ['lag']
+	helptext = "Shows how long the server takes to respond to the bot, how busy the bot's message queue is, and how many log files it has had to open"
+	adminOnly = True
+
+	def execute(self, message):
+		"""
+		:type message: IrcMessage
+		"""
+		lagStats = message.bot.connectionHealthMonitor.getStats()
+		if message.bot.lineSender.lagSlowdownFactor > 1.0:
+			lagStats += ". Sending messages {:.1f} times slower because of the lag".format(message.bot.lineSender.lagSlowdownFactor)
+		message.reply(u"{}. Message queue: {}. Logs: {}".format(lagStats, message.bot.lineSender.getStats(), message.bot.messageLogger.getStats()), "say")
@@ -6,6 +6,7 @@ from IrcMessage import IrcMessage
 class Command(CommandTemplate):
 	"""A module that responds with basic info when just the bot's name is said"""
 	helptext = "SAY MY NAME- I mean, if you just say my name, I'll give you some basic info about myself"
+	shouldSeeAllMessages = True  #There's no trigger, we respond to just the nick being said
 
 	def shouldExecute(self, message):
 		if message.messageType != 'say':
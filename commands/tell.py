@@ -14,6 +14,7 @@ class Command(CommandTemplate):
 	tellsFileLocation = os.path.join(GlobalStore.scriptfolder, "data", "tells.json")
 	storedTells = {}
 	maxTellsAtATime = 4
+	shouldSeeAllMessages = True  #We need to check every message to see if the speaker has tells waiting
 
 	def onLoad(self):
 		if os.path.exists(self.tellsFileLocation):
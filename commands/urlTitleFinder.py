@@ -15,6 +15,7 @@ class Command(CommandTemplate):
 	helptext = "Shows the title of the page somebody just posted a link to"
 	showInCommandList = False
 	callInThread = True  #We can't know how slow sites are, so prevent the bot from locking up on slow sites
+	shouldSeeAllMessages = True  #URLs can appear anywhere in a message, not just as the trigger
 
 	def shouldExecute(self, message):
 		if message.messageType != 'say':